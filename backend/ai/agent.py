@@ -1,12 +1,26 @@
-from typing import List
-
-from openai import OpenAI
+import json
+from functools import cache
+from typing import Dict, List, Tuple
 
 from ai.generate_checks_embeddings import docs_by_check_type
-from constants import OPENAI_API_KEY
+from ai.providers import llm_providers
+from constants import OPENAI_API_KEY, OPENAI_BASE_URL, ANSWER_CACHE_EMBEDDING_MODEL
 from models import Message, CheckType
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+@cache
+def openai_client():
+    # created on the first embedding: importing openai is slow and the API key isn't needed to start.
+    # Completions go through ai.providers
+    from openai import OpenAI
+    return OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+
+
+async def close_openai_clients():
+    if openai_client.cache_info().currsize:
+        openai_client().close()
+        openai_client.cache_clear()
+    await llm_providers.close()
 
 
 def create_system_prompt(results: str, check_type: CheckType) -> dict[str, str]:
@@ -45,41 +59,103 @@ def create_context_messages(system_message: dict[str, str], messages_from_db: Li
     return messages
 
 
-def get_agent_response(check_type: CheckType, results: str, messages, question: str, attachment_url: str | None):
+async def get_agent_response(check_type: CheckType, results: str, messages, question: str,
+                             attachment_url: str | None):
     prompt = create_system_prompt(results, check_type)
     messages = create_context_messages(prompt, messages, question, attachment_url)
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        stream=False
-    )
-    return response.choices[0].message.content
+    # a user waits for the answer, a late first token is hedged
+    completion = await llm_providers.complete(messages, hedge=True)
+    return completion.content
 
 
-def get_agent_response_stream(check_type: CheckType, results: str, messages, question: str, attachment_url: str | None):
+async def get_agent_response_stream(check_type: CheckType, results: str, messages, question: str,
+                                    attachment_url: str | None):
     prompt = create_system_prompt(results, check_type)
     messages = create_context_messages(prompt, messages, question, attachment_url)
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        stream=True
-    )
+    async for part in llm_providers.stream(messages, hedge=True):
+        yield part
+
 
-    for chunk in response:
-        yield chunk.choices[0].delta.content
+def get_embedding(text: str) -> List[float]:
+    response = openai_client().embeddings.create(model=ANSWER_CACHE_EMBEDDING_MODEL, input=text)
+    return response.data[0].embedding
 
 
 def trim_results(results: str, max_length: int = 4000) -> str:
     return results[:max_length] + "..." if len(results) > max_length else results
 
 
-def get_agent_check_summary_response(results: str, check_type: CheckType):
+def create_check_summary_messages(results: str, check_type: CheckType) -> List[dict]:
     prompt = create_system_prompt(results, check_type)
     summary_prompt = f"Make 1 paragraph (maximum 150 words) of summary for check results"
-    messages = [prompt, {"role": "user", "content": summary_prompt}]
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        stream=False
+    return [prompt, {"role": "user", "content": summary_prompt}]
+
+
+async def get_agent_check_summary_response(results: str, check_type: CheckType):
+    messages = create_check_summary_messages(results, check_type)
+    completion = await llm_providers.complete(messages)
+    return completion.content
+
+
+async def get_agent_check_diff_summary_response(changes: str, previous_summary: str, check_type: CheckType):
+    prompt = create_system_prompt(changes, check_type)
+    summary_prompt = (
+        f"The results are the changes since the previous run of this check, which was summarized as:\n"
+        f"{previous_summary}\n"
+        f"Make 1 paragraph (maximum 150 words) of summary for the current state, focus on what changed"
     )
-    return response.choices[0].message.content
+    messages = [prompt, {"role": "user", "content": summary_prompt}]
+    completion = await llm_providers.complete(messages)
+    return completion.content
+
+
+def create_checkup_summary_messages(results_by_check_type: Dict[CheckType, str]) -> List[dict]:
+    """One prompt for all checks of a checkup, the instructions are sent once instead of once per check"""
+    sections = "\n\n".join(
+        f"## Check {check_type.value}\nCheck descriptions:\n{docs_by_check_type[check_type]}\nResults:\n{results}"
+        for check_type, results in results_by_check_type.items())
+    return [
+        {
+            "role": "system",
+            "content": (
+                f"You are a helpful cybersecurity assistant, you always use security standards in your answers. "
+                f"Analyze the following security check results of one website and suggest solutions.\n\n{sections}"
+            )
+        },
+        {
+            "role": "user",
+            "content": (
+                "Make 1 paragraph (maximum 150 words) of summary for the results of every check, "
+                "and an executive summary (maximum 120 words) of the most important findings across all checks"
+            )
+        },
+    ]
+
+
+def checkup_summary_format(check_types: List[CheckType]) -> dict:
+    paragraphs = {check_type.value: {"type": "string"} for check_type in check_types}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "checkup_summary",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "checks": {"type": "object", "properties": paragraphs, "required": list(paragraphs),
+                               "additionalProperties": False},
+                    "executive_summary": {"type": "string"},
+                },
+                "required": ["checks", "executive_summary"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+async def get_agent_checkup_summary_response(results_by_check_type: Dict[CheckType, str]) -> Tuple[dict, dict]:
+    """Summaries of all checks and the executive summary in one structured output call, with the token usage"""
+    messages = create_checkup_summary_messages(results_by_check_type)
+    completion = await llm_providers.complete(messages,
+                                              response_format=checkup_summary_format(list(results_by_check_type)))
+    return json.loads(completion.content), completion.usage
@@ -0,0 +1,175 @@
+import hashlib
+import math
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter
+
+from ai.agent import get_embedding
+from constants import ANSWER_CACHE_ENABLED, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_SIMILARITY
+from lib.tracing import run_in_executor, span
+
+ANSWER_CACHE_REQUESTS = Counter(
+    "planspiegel_answer_cache_requests_total",
+    "Chat answer cache lookups by check type and result (exact, similar, miss, bypass)",
+    ["check_type", "result"],
+)
+
+
+def normalize_question(question: str) -> str:
+    """'  Which ports are OPEN?? ' -> 'which ports are open'"""
+    return re.sub(r"\s+", " ", question).strip().strip("?!. ").lower()
+
+
+def results_scope(check_type: str, results: str) -> str:
+    return hashlib.sha256(f"{check_type}\n{results}".encode()).hexdigest()
+
+
+def cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    embedding: Optional[List[float]]
+    expires_at: float
+
+
+@dataclass
+class AnswerProbe:
+    """A lookup, store() reuses its key and embedding for the answer of a miss"""
+    check_type: str
+    scope: str
+    question: str
+    embedding: Optional[List[float]] = None
+    answer: Optional[str] = None
+    similarity: float = 0.0
+
+
+@dataclass
+class AnswerCacheStats:
+    requests: Dict[str, int] = field(default_factory=lambda: {"exact": 0, "similar": 0, "miss": 0, "bypass": 0})
+    evicted: int = 0
+
+
+class AnswerCache:
+    """
+    Answers of the model by check results and question, in process.
+
+    An entry belongs to the hash of check type + results, and matches a question with the same
+    normalized text or, within the same results, an embedding at least `similarity` close.
+    Entries expire after their TTL, the least recently used are evicted above max_entries.
+    Only questions without chat history or attachment are cacheable, the caller bypasses the others.
+    """
+
+    def __init__(self, max_entries: int, ttl: int, similarity: float,
+                 embed: Callable[[str], List[float]] = get_embedding):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.embed = embed
+        # (scope, normalized question) -> answer, least recently used first
+        self.entries: OrderedDict[Tuple[str, str], CachedAnswer] = OrderedDict()
+        self.questions_by_scope: Dict[str, set] = {}
+        self.counts = AnswerCacheStats()
+
+    def count(self, check_type: str, result: str):
+        self.counts.requests[result] += 1
+        ANSWER_CACHE_REQUESTS.labels(check_type, result).inc()
+
+    def bypass(self, check_type: str):
+        self.count(check_type, "bypass")
+
+    async def lookup(self, check_type: str, results: str, question: str) -> AnswerProbe:
+        probe = AnswerProbe(check_type=check_type, scope=results_scope(check_type, results),
+                            question=normalize_question(question))
+        with span("answer_cache.lookup", check_type=check_type) as lookup_span:
+            cached = self._get((probe.scope, probe.question))
+            if cached is not None:
+                probe.answer, probe.similarity = cached.answer, 1.0
+            elif self.questions_by_scope.get(probe.scope):
+                # only results that were asked about before are worth an embedding
+                probe.embedding = await self._embedding(probe.question)
+                if probe.embedding is not None:
+                    self._nearest(probe)
+            result = "miss" if probe.answer is None else "exact" if probe.similarity == 1.0 else "similar"
+            lookup_span.attributes.update(result=result, similarity=round(probe.similarity, 4))
+        self.count(check_type, result)
+        return probe
+
+    async def store(self, probe: AnswerProbe, answer: str, ttl: int | None = None):
+        if not answer:
+            return
+        if probe.embedding is None:
+            probe.embedding = await self._embedding(probe.question)
+        key = (probe.scope, probe.question)
+        self.entries[key] = CachedAnswer(answer=answer, embedding=probe.embedding,
+                                         expires_at=time.monotonic() + (ttl or self.ttl))
+        self.entries.move_to_end(key)
+        self.questions_by_scope.setdefault(probe.scope, set()).add(probe.question)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+            self.counts.evicted += 1
+
+    def _get(self, key: Tuple[str, str]) -> Optional[CachedAnswer]:
+        cached = self.entries.get(key)
+        if cached is None:
+            return None
+        if cached.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return cached
+
+    def _nearest(self, probe: AnswerProbe):
+        best = None
+        now = time.monotonic()
+        for question in self.questions_by_scope.get(probe.scope, ()):
+            cached = self.entries[(probe.scope, question)]
+            if cached.embedding is None or cached.expires_at <= now:
+                continue
+            similarity = cosine(probe.embedding, cached.embedding)
+            if similarity >= self.similarity and similarity > probe.similarity:
+                probe.answer, probe.similarity, best = cached.answer, similarity, question
+        if best is not None:
+            # only the entry that answered counts as used
+            self.entries.move_to_end((probe.scope, best))
+
+    def _remove(self, key: Tuple[str, str]):
+        self.entries.pop(key, None)
+        questions = self.questions_by_scope.get(key[0])
+        if questions is not None:
+            questions.discard(key[1])
+            if not questions:
+                del self.questions_by_scope[key[0]]
+
+    async def _embedding(self, question: str) -> Optional[List[float]]:
+        try:
+            return await run_in_executor(None, self.embed, question)
+        except Exception as e:
+            # without an embedding the entry still matches the same question
+            print(f"[answer_cache] embedding failed: {e}")
+            return None
+
+    def stats(self) -> dict:
+        requests = self.counts.requests
+        cacheable = requests["exact"] + requests["similar"] + requests["miss"]
+        return {
+            "enabled": ANSWER_CACHE_ENABLED,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "similarity": self.similarity,
+            "requests": dict(requests),
+            "evicted": self.counts.evicted,
+            "hit_rate": round((requests["exact"] + requests["similar"]) / cacheable, 4) if cacheable else None,
+        }
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY)
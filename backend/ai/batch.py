@@ -0,0 +1,180 @@
+import asyncio
+import csv
+import io
+import time
+from typing import List
+
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Request
+from pydantic import BaseModel, Field
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette import status
+from starlette.responses import StreamingResponse
+
+from ai.chat import schedule_check, load_checkup_json
+from ai.summary import checkup_summaries
+from auth import verify_jwt, TokenDataFulfilled
+from constants import BATCH_MAX_URLS, BATCH_CHECKUP_CONCURRENCY, BATCH_FEED_POLL_SECONDS, RATE_LIMIT_BATCH_COST, \
+    RATE_LIMIT_BATCH_URL_COST, QUOTA_SCAN_MINUTES_PER_DAY, BATCH_FEED_STALL_SECONDS
+from lib.postgres_db import yield_db, db_session
+from lib.rate_limit import charge_user, daily_quota
+from lib.response_cache import response_cache, checkup_key
+from lib.tracing import span
+from lib.utils import extract_hostname
+from models import CheckupBatch, CheckupBatchProgress, CheckupDB, CheckDB, db_save_checkup_batch, \
+    db_checkup_batch_by_id, db_check_statuses_by_batch_id, batch_progress
+
+router = APIRouter()
+
+# keeps references to the running batch pipelines
+batch_tasks: set[asyncio.Task] = set()
+
+
+# region BATCH LOGIC
+def clean_urls(urls: List[str]) -> List[str]:
+    """Stripped urls without duplicates, in their order"""
+    cleaned = list(dict.fromkeys(url.strip() for url in urls if url and url.strip()))
+    if not cleaned:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="There are no urls to check")
+    if len(cleaned) > BATCH_MAX_URLS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Too many urls: {len(cleaned)}, maximum is {BATCH_MAX_URLS}")
+    invalid = [url for url in cleaned if extract_hostname(url) is None]
+    if invalid:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid urls: {invalid[:10]}")
+    return cleaned
+
+
+def urls_from_csv(content: bytes) -> List[str]:
+    """The "url" column if the CSV has a header with it, the first column otherwise"""
+    try:
+        rows = [row for row in csv.reader(io.StringIO(content.decode("utf-8-sig"))) if row]
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid CSV: {e}")
+    if not rows:
+        return []
+
+    header = [cell.strip().lower() for cell in rows[0]]
+    column = header.index("url") if "url" in header else 0
+    if "url" in header:
+        rows = rows[1:]
+    return [row[column] for row in rows if len(row) > column]
+
+
+async def run_batch_pipeline(batch_id: int, user_id: int, checkups: List[tuple[CheckupDB, List[CheckDB]]]):
+    """
+    At most BATCH_CHECKUP_CONCURRENCY checkups of the batch are in progress,
+    the next one starts when all checks of a previous one are finished.
+    Checks still wait for admission like every other check.
+    """
+    pending = iter(checkups)
+
+    async def worker():
+        for checkup_dbo, check_dbos in pending:
+            checkup = checkup_dbo.to_pydantic()
+            checkup_summaries.expect(checkup.checkup_id, [check_dbo.check_type for check_dbo in check_dbos], user_id)
+            await asyncio.gather(*[schedule_check(check_dbo, checkup, user_id) for check_dbo in check_dbos],
+                                 return_exceptions=True)
+
+    with span("checkup_batch", batch_id=batch_id, checkups=len(checkups)):
+        await asyncio.gather(*[worker() for _ in range(min(BATCH_CHECKUP_CONCURRENCY, len(checkups)))])
+    print("[run_batch_pipeline] finish", batch_id)
+
+
+async def create_checkup_batch(request: Request, urls: List[str], user_id: int,
+                               db: AsyncSession) -> CheckupBatchProgress:
+    await charge_user(request, "start_checkup_batch", user_id,
+                      RATE_LIMIT_BATCH_COST + RATE_LIMIT_BATCH_URL_COST * len(urls))
+    batch, checkups = await db_save_checkup_batch(user_id, urls, db=db)
+
+    task = asyncio.create_task(run_batch_pipeline(batch.batch_id, user_id, checkups))
+    batch_tasks.add(task)
+    task.add_done_callback(batch_tasks.discard)
+
+    return batch_progress(batch, {checkup.checkup_id: [check.status for check in checks]
+                                  for checkup, checks in checkups})
+
+
+async def assure_batch_belongs_to_user(user_id: int, batch_id: int, db: AsyncSession) -> CheckupBatch:
+    batch = await db_checkup_batch_by_id(batch_id, db=db)
+    if batch is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This batch doesn't exist")
+    if batch.owner_id != user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="This batch belongs to the different user")
+    return batch
+
+
+async def finished_checkup_json(user_id: int, checkup_id: int, db: AsyncSession) -> bytes:
+    cached = await response_cache.get(checkup_key(checkup_id))
+    if cached is not None:
+        return cached["body"].encode()
+    _, _, body = await load_checkup_json(user_id, checkup_id, db)
+    return body
+
+
+# endregion
+
+# region ROUTES
+class CreateCheckupBatchRequest(BaseModel):
+    urls: List[str] = Field(default=["https://planspiegel-landing.vercel.app/"])
+
+
+# a batch runs BATCH_CHECKUP_CONCURRENCY checkups at a time, its scans count against the daily quota as they run,
+# the rate limit is charged by create_checkup_batch() once the urls are known
+BATCH_LIMITS = [Depends(daily_quota("start_checkup_batch", "scan_seconds", QUOTA_SCAN_MINUTES_PER_DAY * 60))]
+
+
+@router.post("/checkups/batch", response_model=CheckupBatchProgress, status_code=status.HTTP_202_ACCEPTED,
+             description="start a checkup for every url", dependencies=BATCH_LIMITS)
+async def start_checkup_batch(request: CreateCheckupBatchRequest, http_request: Request,
+                              user: TokenDataFulfilled = Depends(verify_jwt), db=Depends(yield_db)):
+    return await create_checkup_batch(http_request, clean_urls(request.urls), user.sub, db=db)
+
+
+@router.post("/checkups/batch/csv", response_model=CheckupBatchProgress, status_code=status.HTTP_202_ACCEPTED,
+             description="start a checkup for every url of the CSV, the 'url' column or the first one",
+             dependencies=BATCH_LIMITS)
+async def start_checkup_batch_from_csv(http_request: Request, file: UploadFile = File(...),
+                                       user: TokenDataFulfilled = Depends(verify_jwt), db=Depends(yield_db)):
+    return await create_checkup_batch(http_request, clean_urls(urls_from_csv(await file.read())), user.sub, db=db)
+
+
+@router.get("/checkups/batch/{batch_id}", response_model=CheckupBatchProgress, description="aggregate progress")
+async def get_checkup_batch(batch_id: int, user: TokenDataFulfilled = Depends(verify_jwt), db=Depends(yield_db)):
+    batch = await assure_batch_belongs_to_user(user.sub, batch_id, db=db)
+    return batch_progress(batch, await db_check_statuses_by_batch_id(batch_id, db=db))
+
+
+@router.get("/checkups/batch/{batch_id}/results",
+            description="NDJSON feed, a line per finished checkup, ends when the whole batch is finished "
+                        "or its checks stopped making progress")
+async def get_checkup_batch_results(batch_id: int, user: TokenDataFulfilled = Depends(verify_jwt),
+                                    db=Depends(yield_db)):
+    batch = await assure_batch_belongs_to_user(user.sub, batch_id, db=db)
+
+    async def feed():
+        sent = set()
+        previous_statuses, changed_at = None, time.monotonic()
+        while True:
+            # a short unit of work per poll, no connection is held while waiting
+            lines = []
+            async with db_session() as _db:
+                statuses = await db_check_statuses_by_batch_id(batch_id, db=_db)
+                if statuses != previous_statuses:
+                    previous_statuses, changed_at = statuses, time.monotonic()
+                for checkup_id, check_statuses in statuses.items():
+                    if checkup_id not in sent and all(check_status.is_final for check_status in check_statuses):
+                        lines.append(await finished_checkup_json(user.sub, checkup_id, _db) + b"\n")
+                        sent.add(checkup_id)
+            for line in lines:
+                yield line
+            if len(sent) >= batch.total_checkups:
+                return
+            if time.monotonic() - changed_at > BATCH_FEED_STALL_SECONDS:
+                # e.g. the process running the batch stopped, the feed can be requested again
+                print(f"[batch_feed] {batch_id} made no progress for {BATCH_FEED_STALL_SECONDS}s, the feed ends")
+                return
+            await asyncio.sleep(BATCH_FEED_POLL_SECONDS)
+
+    return StreamingResponse(feed(), media_type="application/x-ndjson")
+
+# endregion
@@ -1,40 +1,53 @@
 import asyncio
-from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from typing import List
 
-import requests
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, Form
-from pydantic import BaseModel, Field
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.utils import simpleSplit
-from reportlab.pdfgen import canvas
-from reportlab.platypus import Image
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, Form, Request
+from pydantic import BaseModel, Field, TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 from starlette.responses import StreamingResponse, JSONResponse
 
-from ai.agent import get_agent_response, get_agent_response_stream, get_agent_check_summary_response
+from ai.agent import get_agent_response, get_agent_response_stream, get_agent_check_diff_summary_response
+from ai.answer_cache import answer_cache
+from ai.gateway import llm_gateway, Priority, estimate_tokens
+from ai.summary import checkup_summaries
 from auth import verify_jwt, TokenDataFulfilled
-from checks.cookies import sync_start_cookies_check
-from checks.lighthouse import sync_get_lighthouse_report, filter_lighthouse_report_for_summary
-from checks.network import sync_start_network_check, filter_network_report_for_summary
+from checks.cookies import start_cookies_check
+from checks.diff import diff_check_results
+from checks.lighthouse import get_lighthouse_report
+from checks.network import start_network_check
 from checks.scan_ports import start_check_ports
 from checks.technologies import sync_start_technologies_check
-from lib.google_storage import upload_attachment
-from lib.postgres_db import yield_db, return_db
-from lib.utils import extract_hostname
+from constants import ANSWER_CACHE_ENABLED, RATE_LIMIT_CHECKUP_COST, RATE_LIMIT_MESSAGE_COST, \
+    QUOTA_LLM_TOKENS_PER_DAY, QUOTA_SCAN_MINUTES_PER_DAY
+from lib.admission import admission
+from lib.cancellation import checkup_cancellation
+from lib.metrics import track_stage, register_gauge
+from lib.postgres_db import yield_db, db_session
+from lib.rate_limit import rate_limit, daily_quota, daily_usage
+from lib.response_cache import response_cache, checkup_key, check_key, json_response_with_etag, etag_for, \
+    join_ids, split_ids
+from lib.storage import store_upload
+from lib.single_flight import single_flight, flight_key
+from lib.tracing import span, run_in_executor
+from lib.utils import extract_hostname, dumps_with_raw_json
 from models import Checkup, CheckupDB, db_save_checkup, db_checkups_by_user_id, CheckDB, CheckType, db_save_check, \
     db_save_chat, ChatDB, db_messages_by_chat_id, db_checkup_by_id, db_save_message, MessageDB, \
     Message, SenderType, Check, db_check_by_id, CheckStatus, db_complete_check_with_results, db_append_message_content, \
-    db_complete_check_with_failure, db_delete_messages_by_chat_id
+    db_complete_check_with_failure, db_delete_messages_by_chat_id, db_update_check_status, check_row_to_json, \
+    db_check_json_row_by_id, db_check_json_rows_by_checkup_id, db_last_checkup_by_hostname, db_cancel_checks, \
+    db_checkup_owner_and_check
 
 router = APIRouter()
 
 
 # region CHECK LOGIC
-async def assure_checkup_belongs_to_user(user_id: int, checkup_id: int, db: AsyncSession) -> Checkup:
-    checkup = await db_checkup_by_id(checkup_id, db=db)
+async def assure_checkup_belongs_to_user(user_id: int, checkup_id: int, db: AsyncSession,
+                                        with_checks: bool = True) -> Checkup:
+    checkup = await db_checkup_by_id(checkup_id, db=db, with_checks=with_checks)
     if checkup is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This check doesn't exist")
 
@@ -44,119 +57,304 @@ async def assure_checkup_belongs_to_user(user_id: int, checkup_id: int, db: Asyn
 
 
 async def assure_check_belongs_to_user(user_id: int, checkup_id: int, check_id: int, db: AsyncSession):
-    checkup = await assure_checkup_belongs_to_user(user_id, checkup_id, db)
+    # finished checkups are authorized from the response cache, the others with one small query
+    cached = await response_cache.get(checkup_key(checkup_id))
+    if cached is not None:
+        owner_id, check_in_checkup = int(cached["owner_id"]), check_id in split_ids(cached["check_ids"])
+    else:
+        owner_and_check = await db_checkup_owner_and_check(checkup_id, check_id, db=db)
+        if owner_and_check is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This check doesn't exist")
+        owner_id, check_in_checkup = owner_and_check
 
-    found = any(check.check_id == check_id for check in checkup.checks)
-    if not found:
+    if owner_id != user_id or not check_in_checkup:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="This check belongs to the different user")
 
 
+def queue_position_of(row) -> int | None:
+    return admission.queue_position(row.check_id) if row.status == CheckStatus.QUEUED else None
+
+
+async def load_checkup_json(user_id: int, checkup_id: int, db: AsyncSession) -> tuple[Checkup, list, bytes]:
+    """
+    Checkup response built around the stored results JSON, without decoding it.
+    Finished checkups go to the response cache.
+    """
+    checkup = await assure_checkup_belongs_to_user(user_id, checkup_id, db, with_checks=False)
+    rows = await db_check_json_rows_by_checkup_id(checkup_id, db=db)
+    checks_json = b"[" + b",".join(check_row_to_json(row, queue_position_of(row)) for row in rows) + b"]"
+    body = dumps_with_raw_json(checkup.model_dump(mode="json", exclude={"checks"}), {"checks": checks_json})
+
+    if rows and all(row.status.is_final for row in rows):
+        await response_cache.set(checkup_key(checkup_id), {
+            "owner_id": str(checkup.owner_id),
+            "check_ids": join_ids([row.check_id for row in rows]),
+            "body": body.decode(),
+            "etag": etag_for(body),
+        })
+    return checkup, rows, body
+
+
 executor = ThreadPoolExecutor()
+# keeps references to the background check tasks
+check_tasks: set[asyncio.Task] = set()
+
+register_gauge("planspiegel_admission_slots", "Check slots per check type and state (capacity, running, queued)",
+               ["check_type", "state"],
+               lambda: [((check_type, state), value)
+                        for check_type, slots in admission.stats().items() for state, value in slots.items()])
+register_gauge("planspiegel_executor_queue_depth", "Check functions waiting for a thread of the check executor", [],
+               lambda: [((), executor._work_queue.qsize())])
+register_gauge("planspiegel_check_tasks", "Checks in progress in this process (queued, running or summarising)", [],
+               lambda: [((), len(check_tasks))])
 
-async def start_check(db: AsyncSession, checkup: Checkup, check_type: CheckType):
+
+async def start_check(db: AsyncSession, checkup: Checkup, check_type: CheckType, user_id: int,
+                      previous_check: Check | None = None):
     # CHECK
-    check_dbo = CheckDB(check_type=check_type, checkup_id=checkup.checkup_id, status=CheckStatus.RUNNING)
+    check_dbo = CheckDB(check_type=check_type, checkup_id=checkup.checkup_id, status=CheckStatus.QUEUED)
     check = await db_save_check(check_dbo, db=db)
     # CHAT
     chat_dbo = ChatDB(check_id=check.check_id)
     await db_save_chat(chat_dbo, db=db)
-    await db.close()
     check.chat = chat_dbo
 
-    # START CHECK IN PARALLEL
-    async def update_check_callback(_future, _check_dbo):
-        print("[update_check_callback] callback!", _check_dbo.check_type, _check_dbo.checkup_id, _check_dbo.check_id)
-        results = _future.result()
-        results_for_summary = results
-
-        _loop = asyncio.get_event_loop()
-        match _check_dbo.check_type:
-            case CheckType.LIGHTHOUSE:
-                results_for_summary = await _loop.run_in_executor(None, filter_lighthouse_report_for_summary,
-                                                                  results_for_summary)
-            case CheckType.NETWORK:
-                results_for_summary = await _loop.run_in_executor(None, filter_network_report_for_summary,
-                                                                  results_for_summary)
-        results_description = await _loop.run_in_executor(None, get_agent_check_summary_response,
-                                                          str(results_for_summary), _check_dbo.check_type)
-        _db = return_db()
-        async with _db:
-            await db_complete_check_with_results(_check_dbo, results, results_description, db=_db)
-
-    async def update_check_failed_callback(_future, _check_dbo, exception):
-        print("[update_check_failed_callback] callback!", _check_dbo.check_type, _check_dbo.checkup_id,
-              _check_dbo.check_id)
-        _db = return_db()
-        async with _db:
-            await db_complete_check_with_failure(_check_dbo, {"exception": str(exception)}, db=_db)
-
-    def on_complete(_future: Future[dict]):
-        exception = future.exception()
-        if exception:
-            asyncio.create_task(update_check_failed_callback(_future, check_dbo, exception))
-        else:
-            asyncio.create_task(update_check_callback(_future, check_dbo))
+    # WAIT FOR A SLOT, THEN START CHECK IN PARALLEL
+    schedule_check(check_dbo, checkup, user_id, previous_check)
+    check.queue_position = admission.queue_position(check.check_id)
+    print("[start_check] finish", checkup.checkup_id, check_type)
+    return check
+
 
-    loop = asyncio.get_running_loop()
+def schedule_check(check_dbo: CheckDB, checkup: Checkup, user_id: int,
+                   previous_check: Check | None = None) -> asyncio.Task:
+    """Queues a saved check for an admission slot and runs it in the background"""
+    slot = admission.enqueue(check_dbo.check_type.value, user_id, check_dbo.check_id)
+    task = asyncio.create_task(run_check(check_dbo, checkup, user_id, slot, previous_check))
+    check_tasks.add(task)
+    task.add_done_callback(check_tasks.discard)
+    checkup_cancellation.track(checkup.checkup_id, check_dbo.check_type.value, task)
+    return task
+
+
+async def run_check(check_dbo: CheckDB, checkup: Checkup, user_id: int, slot: asyncio.Future,
+                    previous_check: Check | None = None):
+    with span("run_check", check_type=check_dbo.check_type.value, check_id=check_dbo.check_id,
+              checkup_id=checkup.checkup_id, recheck=previous_check is not None):
+        await run_check_traced(check_dbo, checkup, user_id, slot, previous_check)
+
+
+async def run_check_traced(check_dbo: CheckDB, checkup: Checkup, user_id: int, slot: asyncio.Future,
+                           previous_check: Check | None = None):
+    check_type = check_dbo.check_type
+    # the slot belongs to run_exclusive once it started or was given up by attach, otherwise it is given up at the end
+    slot_taken = False
+
+    async def run_exclusive() -> dict:
+        nonlocal slot_taken
+        # the run may outlive this check if it is cancelled while other checks wait for the run
+        slot_taken = True
+        try:
+            with track_stage(check_type.value, "queue"):
+                await slot
+        except asyncio.CancelledError:
+            # the slot may have been granted right before the cancellation
+            admission.withdraw(check_type.value, user_id, check_dbo.check_id, slot)
+            raise
+        try:
+            async with db_session() as _db:
+                await db_update_check_status(check_dbo, CheckStatus.RUNNING, db=_db)
+            with track_stage(check_type.value, "check") as check_span:
+                results = await execute_check(check_type, checkup.url)
+        finally:
+            admission.release(check_type.value, user_id)
+        # the daily scan quota, checks that joined this run don't count
+        await daily_usage.add("scan_seconds", user_id, check_span.duration)
+        # a recheck summarises only the delta, see complete_outcome
+        results_description = None
+        if previous_check is None:
+            try:
+                results_description = await checkup_summaries.summarize(checkup.checkup_id, check_type, results,
+                                                                        user_id)
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # the summary of the cancelled checkup was dropped, the checks that joined this run summarise
+                # on their own
+        return {"results": results, "results_description": results_description}
+
+    async def attach():
+        nonlocal slot_taken
+        # waiting for an identical check of another checkup doesn't need an own slot
+        admission.withdraw(check_type.value, user_id, check_dbo.check_id, slot)
+        slot_taken = True
+        async with db_session() as _db:
+            await db_update_check_status(check_dbo, CheckStatus.RUNNING, db=_db)
 
+    try:
+        if await checkup_cancellation.is_cancelled(checkup.checkup_id):
+            # cancelled before the check started, e.g. a later checkup of a batch
+            return
+        outcome, _ = await single_flight.do(flight_key(check_type.value, checkup.url), run_exclusive,
+                                            on_follow=attach)
+        outcome = await complete_outcome(outcome, check_type, previous_check, checkup.checkup_id, user_id)
+    except Exception as exception:
+        await update_check_failed_callback(check_dbo, exception)
+        return
+    finally:
+        if not slot_taken:
+            # still queued, or granted to a check that was cancelled before its run started
+            admission.withdraw(check_type.value, user_id, check_dbo.check_id, slot)
+        # failed, or summarised by the checkup of a shared run, the batch of this checkup doesn't wait for it
+        checkup_summaries.withdraw(checkup.checkup_id, check_type)
+
+    await update_check_callback(outcome, check_dbo)
+
+
+async def execute_check(check_type: CheckType, url: str) -> dict:
     match check_type:
         case CheckType.SCAN_PORTS:
-            host = extract_hostname(checkup.url)
-            future = loop.run_in_executor(executor, start_check_ports, host)
-            future.add_done_callback(on_complete)
+            # sockets on the shared loop, bounded by the scanner's connection budget
+            return await start_check_ports(extract_hostname(url))
         case CheckType.LIGHTHOUSE:
-            future = loop.run_in_executor(executor, sync_get_lighthouse_report, checkup.url)
-            future.add_done_callback(on_complete)
+            # waits for its subprocess on the shared loop, a cancelled check kills the process tree
+            return await get_lighthouse_report(url)
         case CheckType.COOKIE:
-            future = loop.run_in_executor(executor, sync_start_cookies_check, checkup.url)
-            future.add_done_callback(on_complete)
+            # Mostly waiting for the scanner, so it runs on the shared loop instead of a thread
+            return await start_cookies_check(url)
         case CheckType.TECHNOLOGIES:
-            future = loop.run_in_executor(executor, sync_start_technologies_check, checkup.url)
-            future.add_done_callback(on_complete)
+            cancelled = threading.Event()
+            try:
+                return await run_in_executor(executor, sync_start_technologies_check, url, cancelled)
+            except asyncio.CancelledError:
+                # the thread stops before its next request
+                cancelled.set()
+                raise
         case CheckType.NETWORK:
-            future = loop.run_in_executor(executor, sync_start_network_check, checkup.url)
-            future.add_done_callback(on_complete)
-    print("[start_check] finish", checkup.checkup_id, check_type)
-    return check
+            return await start_network_check(url)
+    raise ValueError(f"Unknown check type: {check_type}")
+
+
+async def complete_outcome(outcome: dict, check_type: CheckType, previous_check: Check | None,
+                           checkup_id: int, user_id: int | None = None) -> dict:
+    """
+    Summary of the check: the delta to the previous run for a recheck, the full results otherwise.
+    Unchanged rechecks reuse the previous summary without asking the LLM.
+    """
+    if previous_check is None:
+        if outcome["results_description"] is None:
+            # the shared run was a recheck of another checkup, or its checkup was cancelled
+            results_description = await checkup_summaries.summarize(checkup_id, check_type, outcome["results"],
+                                                                    user_id)
+            return {**outcome, "results_description": results_description}
+        return outcome
+
+    with track_stage(check_type.value, "diff"):
+        results_diff = await run_in_executor(None, diff_check_results, check_type, previous_check.results,
+                                             outcome["results"])
+    results_diff["previous_check_id"] = previous_check.check_id
+
+    if not results_diff["changed"]:
+        return {**outcome, "results_description": previous_check.results_description, "results_diff": results_diff}
+
+    changes = str(results_diff["changes"])
+    with track_stage(check_type.value, "summary"):
+        results_description = await llm_gateway.call(Priority.BACKGROUND, user_id,
+                                                     estimate_tokens(changes, previous_check.results_description),
+                                                     get_agent_check_diff_summary_response, changes,
+                                                     previous_check.results_description, check_type)
+    return {**outcome, "results_description": results_description, "results_diff": results_diff}
+
+
+async def update_check_callback(outcome: dict, _check_dbo: CheckDB):
+    print("[update_check_callback] callback!", _check_dbo.check_type, _check_dbo.checkup_id, _check_dbo.check_id)
+    with track_stage(_check_dbo.check_type.value, "db_update"):
+        async with db_session() as _db:
+            await db_complete_check_with_results(_check_dbo, outcome["results"], outcome["results_description"],
+                                                 db=_db, results_diff=outcome.get("results_diff"))
+
+
+async def update_check_failed_callback(_check_dbo: CheckDB, exception: BaseException):
+    print("[update_check_failed_callback] callback!", _check_dbo.check_type, _check_dbo.checkup_id,
+          _check_dbo.check_id)
+    async with db_session() as _db:
+        await db_complete_check_with_failure(_check_dbo, {"exception": str(exception)}, db=_db)
+
+
+async def start_checkup_checks(checkup: Checkup, user_id: int, previous_checkup: Checkup | None = None) -> List[Check]:
+    # only completed checks with a summary can be diffed, the others run as usual
+    previous = {check.check_type: check for check in (previous_checkup.checks if previous_checkup else None) or []
+                if check.status == CheckStatus.COMPLETED and check.results_description}
+
+    # fresh checks are summarised together, rechecks summarise their own delta
+    checkup_summaries.expect(checkup.checkup_id, [check_type for check_type in CheckType if check_type not in previous],
+                             user_id)
+
+    # the trace of a checkup starts here, check tasks and their worker threads are its children
+    with span("start_checkup", checkup_id=checkup.checkup_id):
+        async with db_session() as _db_ports:
+            check_ports = await start_check(_db_ports, checkup, CheckType.SCAN_PORTS, user_id,
+                                            previous.get(CheckType.SCAN_PORTS))
+
+        async with db_session() as _db_lighthouse:
+            check_lighthouse = await start_check(_db_lighthouse, checkup, CheckType.LIGHTHOUSE, user_id,
+                                                 previous.get(CheckType.LIGHTHOUSE))
+
+        async with db_session() as _db3:
+            check_technologies = await start_check(_db3, checkup, CheckType.TECHNOLOGIES, user_id,
+                                                   previous.get(CheckType.TECHNOLOGIES))
+
+        async with db_session() as _db4:
+            check_cookie = await start_check(_db4, checkup, CheckType.COOKIE, user_id, previous.get(CheckType.COOKIE))
+
+        async with db_session() as _db_network:
+            check_network = await start_check(_db_network, checkup, CheckType.NETWORK, user_id,
+                                              previous.get(CheckType.NETWORK))
+        # if is_running_in_docker():
+        #     print("uncomment CheckType.NETWORK for PROD")
+        #     await start_check(db, checkup, CheckType.NETWORK)
+
+        # To get attached checks
+        return with_queue_positions([check_ports, check_lighthouse, check_network, check_technologies, check_cookie])
+
+
+async def create_checkup(url: str, user_id: int, recheck: bool, db: AsyncSession) -> Checkup:
+    """Saves a checkup and starts its checks, a recheck compares with the last checkup of the hostname"""
+    previous_checkup = None
+    if recheck:
+        hostname = extract_hostname(url)
+        if hostname is not None:
+            previous_checkup = await db_last_checkup_by_hostname(user_id, hostname, db=db)
+
+    checkup_dbo = CheckupDB(url=url, owner_id=user_id,
+                            previous_checkup_id=previous_checkup.checkup_id if previous_checkup else None)
+    checkup = await db_save_checkup(checkup_dbo, db=db)
+
+    checkup.checks = await start_checkup_checks(checkup, user_id, previous_checkup)
+    return checkup
+
+
+def with_queue_positions(checks: List[Check] | None) -> List[Check] | None:
+    for check in checks or []:
+        if check.status == CheckStatus.QUEUED:
+            check.queue_position = admission.queue_position(check.check_id)
+    return checks
 
 # endregion
 
 # region ROUTES
 class CreateCheckupRequest(BaseModel):
     url: str = Field(default="https://planspiegel-landing.vercel.app/")
+    # compare with the last checkup of the same hostname and summarise only the changes
+    recheck: bool = Field(default=False)
 
 
-@router.post("/checkups", response_model=Checkup, description="start a checkup")
+@router.post("/checkups", response_model=Checkup, description="start a checkup",
+             dependencies=[Depends(rate_limit("start_checkup", RATE_LIMIT_CHECKUP_COST)),
+                           Depends(daily_quota("start_checkup", "scan_seconds", QUOTA_SCAN_MINUTES_PER_DAY * 60))])
 async def start_checkup(request: CreateCheckupRequest, user: TokenDataFulfilled = Depends(verify_jwt),
                         db=Depends(yield_db)):
-    checkup_dbo = CheckupDB(url=request.url, owner_id=user.sub)
-    checkup = await db_save_checkup(checkup_dbo, db=db)
-
-    _db_ports = return_db()
-    async with _db_ports:
-        check_ports = await start_check(_db_ports, checkup, CheckType.SCAN_PORTS)
-
-    _db_lighthouse = return_db()
-    async with _db_lighthouse:
-        check_lighthouse = await start_check(_db_lighthouse, checkup, CheckType.LIGHTHOUSE)
-
-    _db3 = return_db()
-    async with _db3:
-        check_technologies = await start_check(_db3, checkup, CheckType.TECHNOLOGIES)
-
-    _db4 = return_db()
-    async with _db4:
-        check_cookie = await start_check(_db4, checkup, CheckType.COOKIE)
-
-    _db_network = return_db()
-    async with _db_network:
-        check_network = await start_check(_db_network, checkup, CheckType.NETWORK)
-    # if is_running_in_docker():
-    #     print("uncomment CheckType.NETWORK for PROD")
-    #     await start_check(db, checkup, CheckType.NETWORK)
-
-    # To get attached checks
-    checkup.checks = [check_ports, check_lighthouse, check_network, check_technologies, check_cookie]
+    checkup = await create_checkup(request.url, user.sub, request.recheck, db=db)
     print("[start_checkup] RESPOND", checkup.checkup_id)
     return checkup
 
@@ -167,26 +365,67 @@ async def get_user_checkups(user: TokenDataFulfilled = Depends(verify_jwt), db=D
 
 
 @router.get("/checkups/{checkup_id}", response_model=Checkup)
-async def get_checkup_by_id(checkup_id: int, user: TokenDataFulfilled = Depends(verify_jwt), db=Depends(yield_db)):
-    return await assure_checkup_belongs_to_user(user.sub, checkup_id, db)
+async def get_checkup_by_id(request: Request, checkup_id: int, user: TokenDataFulfilled = Depends(verify_jwt),
+                            db=Depends(yield_db)):
+    cached = await response_cache.get(checkup_key(checkup_id), route="get_checkup_by_id")
+    if cached is not None:
+        if int(cached["owner_id"]) != user.sub:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                                detail="This check belongs to the different user")
+        return json_response_with_etag(request, cached["body"], cached["etag"])
+
+    _, _, body = await load_checkup_json(user.sub, checkup_id, db)
+    return json_response_with_etag(request, body)
+
+
+@router.post("/checkups/{checkup_id}/cancel", response_model=Checkup,
+             description="cancel the checks of a checkup that aren't finished, in every process")
+async def cancel_checkup(request: Request, checkup_id: int, user: TokenDataFulfilled = Depends(verify_jwt),
+                         db=Depends(yield_db)):
+    await assure_checkup_belongs_to_user(user.sub, checkup_id, db=db, with_checks=False)
+    with span("cancel_checkup", checkup_id=checkup_id) as cancel_span:
+        # the summary first, the cancelled checks would otherwise let the batch start without them
+        checkup_summaries.cancel(checkup_id)
+        cancelled_tasks = await checkup_cancellation.cancel(checkup_id)
+        cancelled_checks = await db_cancel_checks(checkup_id, db=db)
+        cancel_span.attributes.update(tasks=cancelled_tasks, checks=cancelled_checks)
+    print("[cancel_checkup]", checkup_id, "checks:", cancelled_checks, "tasks here:", cancelled_tasks)
+
+    _, _, body = await load_checkup_json(user.sub, checkup_id, db)
+    return json_response_with_etag(request, body)
 
 
 @router.get("/checkups/{checkup_id}/checks/{check_id}", response_model=Check, description="Check status")
-async def get_check_by_id(checkup_id: int, check_id: int, user: TokenDataFulfilled = Depends(verify_jwt),
-                          db=Depends(yield_db)):
+async def get_check_by_id(request: Request, checkup_id: int, check_id: int,
+                          user: TokenDataFulfilled = Depends(verify_jwt), db=Depends(yield_db)):
     await assure_check_belongs_to_user(user.sub, checkup_id, check_id, db=db)
-    return await db_check_by_id(check_id, db=db)
+    cached = await response_cache.get(check_key(check_id), route="get_check_by_id")
+    if cached is not None:
+        return json_response_with_etag(request, cached["body"], cached["etag"])
+
+    row = await db_check_json_row_by_id(check_id, db=db)
+    body = check_row_to_json(row, queue_position_of(row))
+    if row.status.is_final:
+        await response_cache.set(check_key(check_id), {"body": body.decode(), "etag": etag_for(body)})
+    return json_response_with_etag(request, body)
+
+
+messages_adapter = TypeAdapter(List[Message])
 
 
 @router.get("/checkups/{checkup_id}/checks/{check_id}/chats/{chat_id}/messages", response_model=List[Message])
-async def get_messages(checkup_id: int, check_id: int, chat_id: int, user: TokenDataFulfilled = Depends(verify_jwt),
-                       db=Depends(yield_db)):
+async def get_messages(request: Request, checkup_id: int, check_id: int, chat_id: int,
+                       user: TokenDataFulfilled = Depends(verify_jwt), db=Depends(yield_db)):
     await assure_check_belongs_to_user(user.sub, checkup_id, check_id, db=db)
-    return await db_messages_by_chat_id(chat_id, db=db)
+    # not cached, a streamed answer changes with every chunk
+    messages = await db_messages_by_chat_id(chat_id, db=db)
+    return json_response_with_etag(request, messages_adapter.dump_json(messages))
 
 
 @router.post("/checkups/{checkup_id}/checks/{check_id}/chats/{chat_id}/messages",
-             description="Send message to AI agent")
+             description="Send message to AI agent",
+             dependencies=[Depends(rate_limit("send_message", RATE_LIMIT_MESSAGE_COST)),
+                           Depends(daily_quota("send_message", "llm_tokens", QUOTA_LLM_TOKENS_PER_DAY))])
 async def send_message(checkup_id: int, check_id: int, chat_id: int,
                        question: str = Form("Which ports are open?"),
                        use_stream: bool = Form(False),
@@ -205,16 +444,17 @@ async def send_message(checkup_id: int, check_id: int, chat_id: int,
                             detail=f"The question size is unacceptable: {len(question)}")
 
     # ATTACHMENTS
-    attachment_url = None
+    attachment_url, model_attachment_url = None, None
     if file and not isinstance(file, str):
         # base64_encoded_file = await get_base64_from_upload(file)
         # if base64_encoded_file:
         #     attachment_url = base64_encoded_file
         #     print("attachment_url", attachment_url)
-        file_content = await file.read()
-        if file_content:
-            attachment_url = upload_attachment(file.filename, file.content_type, file_content)
-            print("attachment_url", attachment_url)
+        attachment = await store_upload(file)
+        if attachment:
+            attachment_url = attachment.url
+            model_attachment_url = attachment.model_url or attachment.url
+            print("attachment_url", attachment_url, "deduplicated" if attachment.deduplicated else "")
 
     # MESSAGES
     messages = await db_messages_by_chat_id(chat_id, db=db)
@@ -223,18 +463,44 @@ async def send_message(checkup_id: int, check_id: int, chat_id: int,
     user_message_dbo = MessageDB(content=question, chat_id=chat_id, attachment_url=attachment_url)
     await db_save_message(user_message_dbo, db=db)
 
+    # ANSWER CACHE
+    probe = None
+    if ANSWER_CACHE_ENABLED:
+        # an answer depends on the history and the attachment, only the first plain question is cacheable
+        if messages or model_attachment_url:
+            answer_cache.bypass(check.check_type.value)
+        else:
+            probe = await answer_cache.lookup(check.check_type.value, results, question)
+    cached_answer = probe.answer if probe else None
+    estimate = estimate_tokens(results, question, *[message.content for message in messages])
+
     if use_stream:
         ai_message_dbo = MessageDB(content="", chat_id=chat_id, sender_type=SenderType.ASSISTANT)
         await db_save_message(ai_message_dbo, db=db)
 
         async def stream_response():
-            for part in get_agent_response_stream(check.check_type, results, messages, question, attachment_url):
+            if cached_answer is not None:
+                await db_append_message_content(ai_message_dbo, cached_answer, db=db)
+                yield cached_answer
+                return
+            parts = []
+            async for part in llm_gateway.stream(Priority.INTERACTIVE, user.sub, estimate, get_agent_response_stream,
+                                                 check.check_type, results, messages, question,
+                                                 model_attachment_url):
                 await db_append_message_content(ai_message_dbo, part, db=db)
+                parts.append(part or "")
                 yield part
+            if probe is not None:
+                await answer_cache.store(probe, "".join(parts))
 
         return StreamingResponse(stream_response(), media_type="text/event-stream")
     else:
-        ai_answer = get_agent_response(check.check_type, results, messages, question, attachment_url)
+        ai_answer = cached_answer
+        if ai_answer is None:
+            ai_answer = await llm_gateway.call(Priority.INTERACTIVE, user.sub, estimate, get_agent_response,
+                                               check.check_type, results, messages, question, model_attachment_url)
+            if probe is not None:
+                await answer_cache.store(probe, ai_answer)
         ai_message_dbo = MessageDB(content=ai_answer, chat_id=chat_id, sender_type=SenderType.ASSISTANT)
         await db_save_message(ai_message_dbo, db=db)
         return JSONResponse({"ai_answer": ai_answer})
@@ -251,6 +517,7 @@ async def clear_chat_history(checkup_id: int, check_id: int, chat_id: int,
 # endregion
 
 # region PDF Report
+# reportlab is imported by the functions, only the PDF route needs it
 
 def draw_section_header(c, title, x, y):
     c.setFont("Helvetica-Bold", 12)
@@ -265,6 +532,7 @@ def draw_text(c, text, x, y):
 
 
 def wrap_and_draw_text(c, text, x, y, line_width=500):
+    from reportlab.lib.utils import simpleSplit
     lines = simpleSplit(text, 'Helvetica', 10, line_width)
     for line in lines:
         c.drawString(x, y, line)
@@ -273,6 +541,8 @@ def wrap_and_draw_text(c, text, x, y, line_width=500):
 
 
 def add_image_to_pdf(c, img_url, x, y, max_width=500):
+    import requests
+    from reportlab.platypus import Image
     try:
         response = requests.get(img_url, stream=True)
         if response.status_code == 200:
@@ -406,7 +676,19 @@ def common_network_data(c, y_position, check_data, title):
         c.showPage()
 
 
+def port_status_text(port: int, service: dict | None) -> str:
+    if service is None:
+        # scans without service detection
+        return "Secure (Standard Web Traffic)" if port in [80, 443] else "Unknown service"
+    label = {True: "Secure", False: "Insecure"}.get(service.get("secure"), "Unknown")
+    name = service.get("service") or "unknown service"
+    if service.get("product"):
+        name = f"{name}, {service['product']}"
+    return f"{label} ({name}) - {service.get('assessment', '')}"
+
+
 def create_report(c, check_data, y_position):
+    from reportlab.lib.utils import simpleSplit
     logo_path = "/assets/Planspiegel.png"
     add_logo(c, logo_path, 50, 740)
 
@@ -480,13 +762,16 @@ def create_report(c, check_data, y_position):
         # Results Section - scan_ports
         if (str(check_data.get('check_type')) == "CheckType.SCAN_PORTS"):
             open_ports = check_data.get("results", {}).get("open_ports", [])
+            services = {service["port"]: service for service in check_data.get("results", {}).get("services", [])}
             if open_ports:
                 draw_section_header(c, "Scan Results", 50, y_position)
                 y_position -= 20
                 for port in open_ports:
-                    status_text = "Secure (Standard Web Traffic)" if port in [80, 443] else "Insecure"
-                    draw_text(c, f"Port {port}: {status_text}", 50, y_position)
-                    y_position -= 15
+                    status_text = port_status_text(port, services.get(port))
+                    y_position = wrap_and_draw_text(c, f"Port {port}: {status_text}", 50, y_position)
+                    if y_position < 50:
+                        c.showPage()
+                        y_position = 750
             y_position -= 30
         # cookie
         # Header Section
@@ -613,20 +898,31 @@ def create_report(c, check_data, y_position):
 async def pdf_report(checkup_id: int, user: TokenDataFulfilled = Depends(verify_jwt), db=Depends(yield_db)):
     checkup = await assure_checkup_belongs_to_user(user.sub, checkup_id, db=db)
     # return checkup
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
 
     pdf_buffer = BytesIO()
     c = canvas.Canvas(pdf_buffer, pagesize=letter)
     c.setFont("Helvetica", 10)
 
     y_position = 750
+    if checkup.summary:
+        draw_section_header(c, f"Executive summary: {checkup.url}", 50, y_position)
+        wrap_and_draw_text(c, checkup.summary, 50, y_position - 25)
+        c.showPage()
+
     for check in checkup.checks:
-        pdf_content = ""
         if check.status == CheckStatus.FAILED:
             pdf_content = f"error with exception: {str(check.results)}"
-        if check.status == CheckStatus.RUNNING:
-            pdf_content = f"status: is running"
+        elif check.status in (CheckStatus.CREATED, CheckStatus.QUEUED):
+            pdf_content = "status: is queued"
+        elif check.status == CheckStatus.RUNNING:
+            pdf_content = "status: is running"
+        elif check.status == CheckStatus.CANCELLED:
+            pdf_content = "status: cancelled"
         else:
-            pdf_content = check.results_description
+            # create_report splits the description into sentences
+            pdf_content = check.results_description or "no summary"
 
         check_data = {
             "url": checkup.url,
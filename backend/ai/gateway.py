@@ -0,0 +1,353 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from prometheus_client import Counter, Histogram
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from constants import LLM_GATEWAY_ENABLED, LLM_TOKENS_PER_MINUTE, LLM_REQUESTS_PER_MINUTE, LLM_BACKGROUND_SHARE, \
+    LLM_MAX_RETRIES
+from lib.metrics import register_gauge
+from lib.rate_limit import daily_usage
+from lib.redis_db import redis_for_checks
+from lib.tracing import span
+
+LLM_QUEUE_WAIT = Histogram(
+    "planspiegel_llm_queue_wait_seconds",
+    "Time an LLM request waited for the shared token and request budget, by priority",
+    ["priority"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+LLM_TOKENS = Counter(
+    "planspiegel_llm_tokens_total",
+    "Tokens of the LLM completions by priority and kind (prompt, completion)",
+    ["priority", "kind"],
+)
+LLM_RETRIES = Counter(
+    "planspiegel_llm_retries_total",
+    "LLM requests repeated after a rate limit (rate_limited) or a failure of the API (error)",
+    ["priority", "reason"],
+)
+
+# token bucket of the OpenAI account, refilled continuously up to one minute of budget.
+# Returns "0" and takes the tokens and one request if the budget allows it, otherwise the seconds to wait.
+# Background requests leave a reserve of the budget to interactive ones.
+RESERVE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local tpm, rpm = tonumber(ARGV[1]), tonumber(ARGV[2])
+local tokens, share = tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'requests', 'at', 'paused_until')
+local elapsed = math.max(now - (tonumber(state[3]) or now), 0)
+local available_tokens = math.min(tpm, (tonumber(state[1]) or tpm) + elapsed * tpm / 60)
+local available_requests = math.min(rpm, (tonumber(state[2]) or rpm) + elapsed * rpm / 60)
+local paused_until = tonumber(state[4]) or 0
+local wait = paused_until - now
+local reserve = 1 - share
+local token_wait = (math.min(tokens, tpm * share) + tpm * reserve - available_tokens) / (tpm / 60)
+local request_wait = (1 + rpm * reserve - available_requests) / (rpm / 60)
+wait = math.max(wait, token_wait, request_wait)
+if wait <= 0 then
+    available_tokens = available_tokens - tokens
+    available_requests = available_requests - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', available_tokens, 'requests', available_requests, 'at', now)
+redis.call('EXPIRE', KEYS[1], 120)
+return tostring(math.max(wait, 0))
+"""
+# nobody gets budget until the retry-after of a rate limited request is over
+PAUSE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local paused_until = now + tonumber(ARGV[1])
+if paused_until > (tonumber(redis.call('HGET', KEYS[1], 'paused_until')) or 0) then
+    redis.call('HSET', KEYS[1], 'paused_until', paused_until)
+    redis.call('EXPIRE', KEYS[1], 120)
+end
+"""
+BUDGET_KEY = "llm-gateway:budget"
+# longest wait between two reservation attempts, a new request can move to the head of the queue meanwhile
+MAX_POLL_SECONDS = 1.0
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # chat answers a user waits for
+    BACKGROUND = 1  # check summaries
+
+
+@dataclass
+class Usage:
+    """Tokens of the completions of one gateway call, recorded by ai.providers"""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    reported: bool = False
+
+
+current_usage: contextvars.ContextVar[Optional[Usage]] = contextvars.ContextVar("current_usage", default=None)
+
+
+def record_usage(usage) -> None:
+    """Adds the usage of an OpenAI response to the current gateway call, if there is one"""
+    current = current_usage.get()
+    if current is None or usage is None:
+        return
+    current.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+    current.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+    current.reported = True
+
+
+def estimate_tokens(*texts: Any, completion: int = 400) -> int:
+    """~4 characters per token of the prompt plus the expected completion, the gateway settles the difference"""
+    return sum(len(str(text)) for text in texts if text) // 4 + completion
+
+
+def retry_after(exception: BaseException) -> Optional[float]:
+    """Seconds to wait before repeating a failed completion, None if it shouldn't be repeated"""
+    status_code = getattr(exception, "status_code", None)
+    if status_code == 429:
+        headers = getattr(getattr(exception, "response", None), "headers", None) or {}
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                return float(headers["retry-after"])
+        except ValueError:
+            pass
+        return 0.0
+    # what the OpenAI client repeats itself: timeouts, conflicts, server errors and lost connections
+    if status_code in (408, 409) or (status_code or 0) >= 500 or \
+            type(exception).__name__ in ("APIConnectionError", "APITimeoutError"):
+        return 0.0
+    return None
+
+
+@dataclass(order=True)
+class LlmRequest:
+    priority: int
+    sequence: int
+    tokens: int = field(compare=False)
+    granted: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False, default_factory=time.monotonic)
+
+
+class LlmGateway:
+    """
+    One budget of tokens and requests per minute for the completions of all API processes.
+
+    A request waits in the queue of its process until the shared budget in Redis allows its
+    estimated tokens; interactive requests go before background ones, which also leave a reserve
+    of the budget to them. A rate limited request pauses the budget of all processes for its
+    retry-after and is queued again. After the call the estimate is settled with the reported usage,
+    which is also counted per user.
+    """
+
+    def __init__(self, redis: Redis, tokens_per_minute: int, requests_per_minute: int, background_share: float,
+                 max_retries: int, enabled: bool = True):
+        self.redis = redis
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.background_share = background_share
+        self.max_retries = max_retries
+        self.enabled = enabled
+        self.queue: List[LlmRequest] = []
+        self.sequence = itertools.count()
+        self.wakeup: Optional[asyncio.Event] = None
+        self.dispatcher: Optional[asyncio.Task] = None
+        self.requests: Dict[str, int] = {priority.name.lower(): 0 for priority in Priority}
+        self.waited: Dict[str, float] = {priority.name.lower(): 0.0 for priority in Priority}
+        self.retries = 0
+        self.tokens = 0
+
+    async def call(self, priority: Priority, user_id: Optional[int], estimate: int, fn: Callable[..., Awaitable],
+                   *args) -> Any:
+        """await fn(*args) once the budget allows it, repeated after rate limits and API failures"""
+        if not self.enabled:
+            return await fn(*args)
+        for attempt in itertools.count():
+            await self.acquire(priority, estimate)
+            usage = Usage()
+            token = current_usage.set(usage)
+            error = None
+            try:
+                result = await fn(*args)
+            except Exception as e:
+                error = e
+            finally:
+                # also when the caller is cancelled, the reservation is settled
+                current_usage.reset(token)
+                await self.settle(priority, user_id, estimate, usage)
+            if error is None:
+                return result
+            await self.backoff(priority, error, attempt)
+
+    async def stream(self, priority: Priority, user_id: Optional[int], estimate: int,
+                     fn: Callable[..., AsyncIterator], *args) -> AsyncIterator:
+        """Parts of the async generator fn(*args), a failure before the first part is repeated"""
+        if not self.enabled:
+            async for part in fn(*args):
+                yield part
+            return
+        usage = Usage()
+        token = current_usage.set(usage)
+        iterator, reserved = None, False
+        try:
+            for attempt in itertools.count():
+                await self.acquire(priority, estimate)
+                reserved = True
+                iterator = fn(*args)
+                try:
+                    # the request is sent when the generator starts
+                    part = await anext(iterator, StopAsyncIteration)
+                    break
+                except Exception as e:
+                    iterator, reserved = None, False
+                    await self.settle(priority, user_id, estimate, usage)
+                    usage = Usage()
+                    current_usage.set(usage)
+                    await self.backoff(priority, e, attempt)
+            while part is not StopAsyncIteration:
+                yield part
+                part = await anext(iterator, StopAsyncIteration)
+        finally:
+            # also when the reader stops early or is cancelled: the response is closed and the tokens settled
+            if iterator is not None:
+                await iterator.aclose()
+            if reserved:
+                await self.settle(priority, user_id, estimate, usage)
+            current_usage.reset(token)
+
+    async def acquire(self, priority: Priority, tokens: int):
+        request = LlmRequest(priority=priority, sequence=next(self.sequence), tokens=tokens,
+                             granted=asyncio.get_running_loop().create_future())
+        heapq.heappush(self.queue, request)
+        self._start_dispatcher()
+        self.wakeup.set()
+        with span("llm.queue", priority=priority.name.lower(), tokens=tokens):
+            try:
+                await request.granted
+            except asyncio.CancelledError:
+                if request.granted.done() and not request.granted.cancelled():
+                    # granted while the waiter was cancelled, nobody uses the reservation
+                    await self.refund(tokens)
+                raise
+            finally:
+                # a cancelled waiter is skipped by the dispatcher
+                request.granted.cancel()
+        waited = time.monotonic() - request.enqueued_at
+        self.requests[priority.name.lower()] += 1
+        self.waited[priority.name.lower()] += waited
+        LLM_QUEUE_WAIT.labels(priority.name.lower()).observe(waited)
+
+    def _start_dispatcher(self):
+        if self.dispatcher is None or self.dispatcher.done() or \
+                self.dispatcher.get_loop() is not asyncio.get_running_loop():
+            self.wakeup = asyncio.Event()
+            self.dispatcher = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        """Grants the head of the queue whenever the shared budget allows it"""
+        while self.queue:
+            head = self.queue[0]
+            if head.granted.done():
+                heapq.heappop(self.queue)
+                continue
+            wait = await self.reserve(head.priority, head.tokens)
+            if wait <= 0:
+                heapq.heappop(self.queue)
+                if not head.granted.done():
+                    head.granted.set_result(None)
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), min(wait, MAX_POLL_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+
+    async def reserve(self, priority: Priority, tokens: int) -> float:
+        """0 if the tokens and one request were taken from the shared budget, the seconds to wait otherwise"""
+        share = 1.0 if priority == Priority.INTERACTIVE else self.background_share
+        try:
+            wait = await self.redis.eval(RESERVE_SCRIPT, 1, BUDGET_KEY, self.tokens_per_minute,
+                                         self.requests_per_minute, tokens, share)
+        except RedisError as e:
+            # without Redis the requests go through as they did before the gateway
+            print(f"[llm_gateway] reserve failed: {e}")
+            return 0.0
+        return float(wait)
+
+    async def refund(self, tokens: int):
+        """Gives the tokens and the request of an unused reservation back to the shared budget"""
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.hincrbyfloat(BUDGET_KEY, "tokens", tokens)
+                pipe.hincrbyfloat(BUDGET_KEY, "requests", 1)
+                await pipe.execute()
+        except RedisError as e:
+            print(f"[llm_gateway] refund failed: {e}")
+
+    async def backoff(self, priority: Priority, exception: Exception, attempt: int):
+        """Raises the exception if the request shouldn't be repeated, otherwise waits for the next attempt"""
+        delay = retry_after(exception)
+        if delay is None or attempt >= self.max_retries:
+            raise exception
+        self.retries += 1
+        rate_limited = getattr(exception, "status_code", None) == 429
+        LLM_RETRIES.labels(priority.name.lower(), "rate_limited" if rate_limited else "error").inc()
+        # exponential without a retry-after, 0.5s, 1s, 2s, ...
+        delay = delay or 0.5 * 2 ** attempt
+        print(f"[llm_gateway] {type(exception).__name__}, attempt {attempt + 1} repeated in {delay:.2f}s")
+        if rate_limited:
+            try:
+                await self.redis.eval(PAUSE_SCRIPT, 1, BUDGET_KEY, delay)
+            except RedisError as e:
+                print(f"[llm_gateway] pause failed: {e}")
+        await asyncio.sleep(delay)
+
+    async def settle(self, priority: Priority, user_id: Optional[int], estimate: int, usage: Usage):
+        """Gives back the unused part of the estimate (or takes the excess) and accounts the tokens to the user"""
+        used = usage.prompt_tokens + usage.completion_tokens if usage.reported else estimate
+        LLM_TOKENS.labels(priority.name.lower(), "prompt").inc(usage.prompt_tokens)
+        LLM_TOKENS.labels(priority.name.lower(), "completion").inc(usage.completion_tokens)
+        self.tokens += used
+        if used != estimate:
+            try:
+                await self.redis.hincrbyfloat(BUDGET_KEY, "tokens", estimate - used)
+            except RedisError as e:
+                print(f"[llm_gateway] settle failed: {e}")
+        if user_id is not None:
+            # the daily token quota of the user, see lib.rate_limit.daily_quota
+            await daily_usage.add("llm_tokens", user_id, used)
+
+    def queued(self) -> Dict[str, int]:
+        queued = {priority.name.lower(): 0 for priority in Priority}
+        for request in self.queue:
+            if not request.granted.done():
+                queued[Priority(request.priority).name.lower()] += 1
+        return queued
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "tokens_per_minute": self.tokens_per_minute,
+            "requests_per_minute": self.requests_per_minute,
+            "background_share": self.background_share,
+            "queued": self.queued(),
+            "requests": dict(self.requests),
+            "average_wait_seconds": {priority: round(self.waited[priority] / count, 3) if count else None
+                                     for priority, count in self.requests.items()},
+            "retries": self.retries,
+            "tokens": self.tokens,
+        }
+
+
+llm_gateway = LlmGateway(redis_for_checks, LLM_TOKENS_PER_MINUTE, LLM_REQUESTS_PER_MINUTE, LLM_BACKGROUND_SHARE,
+                         LLM_MAX_RETRIES, LLM_GATEWAY_ENABLED)
+
+register_gauge("planspiegel_llm_queued", "LLM requests of this process waiting for the shared budget, by priority",
+               ["priority"], lambda: [((priority,), count) for priority, count in llm_gateway.queued().items()])
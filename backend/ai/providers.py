@@ -0,0 +1,274 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter, Histogram
+
+from ai.gateway import record_usage
+from constants import OPENAI_API_KEY, OPENAI_BASE_URL, LLM_PROVIDERS, LLM_MODEL, LLM_GATEWAY_ENABLED, \
+    LLM_HEDGE_ENABLED, LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_AFTER, LLM_LATENCY_WINDOW
+from lib.tracing import span
+
+LLM_FIRST_TOKEN = Histogram(
+    "planspiegel_llm_first_token_seconds",
+    "Time from sending a completion to its first token, by provider and model",
+    ["provider", "model"],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 20, 60),
+)
+LLM_HEDGES = Counter(
+    "planspiegel_llm_hedges_total",
+    "Second requests of completions whose first token was late, by provider of the second request and result "
+    "(won: it answered first, lost: the first request still answered first)",
+    ["provider", "result"],
+)
+LLM_FAILOVERS = Counter(
+    "planspiegel_llm_failovers_total",
+    "Completions that failed at a provider and were sent to the next one, by failed provider",
+    ["provider"],
+)
+
+
+class Provider:
+    """An OpenAI compatible chat completions API, OpenAI itself or e.g. a local server"""
+
+    def __init__(self, name: str, base_url: Optional[str], api_key: Optional[str], model: str):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+
+    @cached_property
+    def client(self):
+        # imported on the first completion, see ai.agent.openai_client
+        from openai import AsyncOpenAI
+        # the gateway repeats failed completions itself, after the retry-after of the shared budget
+        return AsyncOpenAI(api_key=self.api_key or "none", base_url=self.base_url,
+                           max_retries=0 if LLM_GATEWAY_ENABLED else 2)
+
+    async def close(self):
+        if "client" in self.__dict__:
+            await self.__dict__.pop("client").close()
+
+
+def parse_providers(setting: str, api_key: Optional[str] = OPENAI_API_KEY, base_url: Optional[str] = OPENAI_BASE_URL,
+                    model: str = LLM_MODEL) -> List[Provider]:
+    """"openai||gpt-4o-mini,local|http://localhost:8080/v1|qwen" -> providers, empty base_url or model: the default"""
+    if not setting.strip():
+        return [Provider("openai", base_url, api_key, model)]
+    providers = []
+    for entry in setting.split(","):
+        name, provider_url, provider_model = (entry.split("|") + ["", ""])[:3]
+        providers.append(Provider(name.strip(), provider_url.strip() or base_url, api_key,
+                                  provider_model.strip() or model))
+    return providers
+
+
+class LatencyWindow:
+    """The last first-token latencies of one provider and model"""
+
+    def __init__(self, size: int):
+        self.samples: Deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+@dataclass
+class OpenedStream:
+    """A completion that produced its first token"""
+    provider: Provider
+    stream: Any
+    chunks: AsyncIterator
+    first: List[str]
+    first_token_seconds: float
+
+
+@dataclass
+class Completion:
+    content: str
+    provider: str
+    model: str
+    usage: Dict[str, int] = field(default_factory=dict)
+
+
+class ProviderPool:
+    """
+    Chat completions over the providers, in their order.
+
+    Every completion is streamed, so the time to its first token is known for every provider and model.
+    A hedged completion whose first token is later than `hedge_percentile` of the recent ones sends the
+    same request to the next provider, the first of both to produce a token answers and the other one is
+    cancelled, which closes its connection. Hedging needs at least two providers, a single one is never hedged.
+    A completion that fails before its first token moves on to the next provider.
+    """
+
+    def __init__(self, providers: List[Provider], hedge_enabled: bool = True, hedge_percentile: float = 0.95,
+                 hedge_min_samples: int = 20, hedge_after: float = 3.0, window: int = 500):
+        self.providers = providers
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_after_default = hedge_after
+        self.window = window
+        self.latencies: Dict[Tuple[str, str], LatencyWindow] = {}
+        self.counts: Dict[str, Dict[str, int]] = {provider.name: {"completions": 0, "errors": 0, "hedges_won": 0,
+                                                                  "hedges_lost": 0} for provider in providers}
+
+    def latency(self, provider: Provider) -> LatencyWindow:
+        key = (provider.name, provider.model)
+        if key not in self.latencies:
+            self.latencies[key] = LatencyWindow(self.window)
+        return self.latencies[key]
+
+    def hedge_after(self, provider: Provider) -> float:
+        """Seconds without a first token after which a completion of the provider is hedged"""
+        latency = self.latency(provider)
+        if len(latency.samples) < self.hedge_min_samples:
+            return self.hedge_after_default
+        return latency.percentile(self.hedge_percentile)
+
+    async def complete(self, messages: List[dict], hedge: bool = False, **options) -> Completion:
+        usage = {}
+        opened = await self.open(messages, hedge, options)
+        parts = list(opened.first)
+        async for part in self.rest(opened, usage):
+            parts.append(part)
+        return Completion(content="".join(parts), provider=opened.provider.name, model=opened.provider.model,
+                          usage=usage)
+
+    async def stream(self, messages: List[dict], hedge: bool = False, **options) -> AsyncIterator[str]:
+        opened = await self.open(messages, hedge, options)
+        for part in opened.first:
+            yield part
+        async for part in self.rest(opened, {}):
+            yield part
+
+    async def open(self, messages: List[dict], hedge: bool, options: dict) -> OpenedStream:
+        candidates = list(self.providers)
+        pending: Dict[asyncio.Task, Provider] = {}
+        hedge_task: Optional[asyncio.Task] = None
+        errors: List[BaseException] = []
+
+        def start(provider: Provider) -> asyncio.Task:
+            task = asyncio.create_task(self.first_token(provider, messages, options))
+            pending[task] = provider
+            return task
+
+        with span("llm.completion", hedge=hedge) as completion_span:
+            primary = start(candidates.pop(0))
+            try:
+                while pending:
+                    hedge_after = self.hedge_after(pending[primary]) if primary in pending else None
+                    # only to another provider, the same request again would count twice against its budget
+                    can_hedge = hedge and self.hedge_enabled and hedge_task is None and hedge_after is not None \
+                        and bool(candidates)
+                    done, _ = await asyncio.wait(pending, timeout=hedge_after if can_hedge else None,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    if not done:
+                        # late first token: the same request to the next provider
+                        hedge_task = start(candidates.pop(0))
+                        completion_span.attributes.update(hedged_to=pending[hedge_task].name)
+                        continue
+
+                    opened = None
+                    for task in done:
+                        provider = pending.pop(task)
+                        if task.exception() is not None:
+                            errors.append(task.exception())
+                            self.counts[provider.name]["errors"] += 1
+                            print(f"[providers] {provider.name} failed: {task.exception()}")
+                            if candidates:
+                                LLM_FAILOVERS.labels(provider.name).inc()
+                                replacement = start(candidates.pop(0))
+                                if task is primary:
+                                    primary = replacement
+                        elif opened is None:
+                            opened = task.result()
+                            self.count_hedge(task, hedge_task, opened.provider)
+                        else:
+                            # both answered at the same time
+                            await task.result().stream.close()
+                    if opened is not None:
+                        self.counts[opened.provider.name]["completions"] += 1
+                        completion_span.attributes.update(provider=opened.provider.name,
+                                                          first_token_seconds=round(opened.first_token_seconds, 3))
+                        return opened
+                raise errors[-1]
+            finally:
+                # the slower request is cancelled, which closes its connection
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.gather(*pending, return_exceptions=True)
+
+    def count_hedge(self, winner: asyncio.Task, hedge_task: Optional[asyncio.Task], provider: Provider):
+        if hedge_task is None:
+            return
+        won = winner is hedge_task
+        self.counts[provider.name]["hedges_won" if won else "hedges_lost"] += 1
+        LLM_HEDGES.labels(provider.name, "won" if won else "lost").inc()
+
+    async def first_token(self, provider: Provider, messages: List[dict], options: dict) -> OpenedStream:
+        started_at = time.perf_counter()
+        stream = await provider.client.chat.completions.create(model=provider.model, messages=messages, stream=True,
+                                                               stream_options={"include_usage": True}, **options)
+        try:
+            chunks = aiter(stream)
+            first = []
+            async for chunk in chunks:
+                record_usage(chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    first.append(chunk.choices[0].delta.content)
+                    break
+            seconds = time.perf_counter() - started_at
+        except BaseException:
+            await stream.close()
+            raise
+        self.latency(provider).add(seconds)
+        LLM_FIRST_TOKEN.labels(provider.name, provider.model).observe(seconds)
+        return OpenedStream(provider=provider, stream=stream, chunks=chunks, first=first, first_token_seconds=seconds)
+
+    @staticmethod
+    async def rest(opened: OpenedStream, usage: dict) -> AsyncIterator[str]:
+        """The tokens after the first, the stream is closed when the reader stops"""
+        try:
+            async for chunk in opened.chunks:
+                # the last chunk has only the usage
+                record_usage(chunk.usage)
+                if chunk.usage:
+                    usage.update(chunk.usage.model_dump())
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await opened.stream.close()
+
+    async def close(self):
+        for provider in self.providers:
+            await provider.close()
+
+    def stats(self) -> dict:
+        return {
+            "hedge_enabled": self.hedge_enabled,
+            "hedge_percentile": self.hedge_percentile,
+            "providers": [{
+                "name": provider.name,
+                "model": provider.model,
+                **self.counts[provider.name],
+                "first_token_p50": self.latency(provider).percentile(0.5),
+                "first_token_p95": self.latency(provider).percentile(0.95),
+                "hedge_after": self.hedge_after(provider),
+            } for provider in self.providers],
+        }
+
+
+llm_providers = ProviderPool(parse_providers(LLM_PROVIDERS), LLM_HEDGE_ENABLED, LLM_HEDGE_PERCENTILE,
+                             LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_AFTER, LLM_LATENCY_WINDOW)
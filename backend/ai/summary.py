@@ -0,0 +1,259 @@
+import asyncio
+import json
+import time
+from collections import deque
+from dataclasses import dataclass, field, asdict
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from prometheus_client import Counter
+
+from ai.agent import get_agent_check_summary_response, get_agent_checkup_summary_response, \
+    create_check_summary_messages, create_checkup_summary_messages
+from ai.gateway import llm_gateway, Priority, estimate_tokens
+from checks.lighthouse import filter_lighthouse_report_for_summary
+from checks.network import filter_network_report_for_summary
+from constants import SUMMARY_BATCH_ENABLED, SUMMARY_BATCH_WAIT
+from lib.metrics import track_stage
+from lib.postgres_db import db_session
+from lib.tracing import run_in_executor, span
+from models import CheckType, db_update_checkup_summary
+
+SUMMARY_CALLS = Counter(
+    "planspiegel_summary_calls_total",
+    "LLM calls for check summaries: batch (all checks of a checkup), single (a check on its own) and "
+    "straggler (a check that missed the batch of its checkup)",
+    ["mode"],
+)
+SUMMARY_TOKENS = Counter(
+    "planspiegel_summary_tokens_total",
+    "Tokens of the batched summary calls (prompt, completion) and the prompt tokens saved against one call per check "
+    "(saved, estimated from the prompt sizes)",
+    ["kind"],
+)
+
+
+async def filter_for_summary(results: dict, check_type: CheckType) -> str:
+    with track_stage(check_type.value, "filter"):
+        match check_type:
+            case CheckType.LIGHTHOUSE:
+                results = await run_in_executor(None, filter_lighthouse_report_for_summary, results)
+            case CheckType.NETWORK:
+                results = await run_in_executor(None, filter_network_report_for_summary, results)
+    return str(results)
+
+
+async def summarize_check_results(results: dict, check_type: CheckType, user_id: Optional[int] = None) -> str:
+    """One call for one check"""
+    results_for_summary = await filter_for_summary(results, check_type)
+    return await summarize_filtered(results_for_summary, check_type, user_id)
+
+
+async def summarize_filtered(results_for_summary: str, check_type: CheckType, user_id: Optional[int] = None) -> str:
+    with track_stage(check_type.value, "summary"):
+        return await llm_gateway.call(Priority.BACKGROUND, user_id, estimate_tokens(results_for_summary),
+                                      get_agent_check_summary_response, results_for_summary, check_type)
+
+
+@dataclass
+class SummaryBatch:
+    checkup_id: int
+    # checks that will ask for a summary, the batch starts when all of them did
+    expected: Set[CheckType]
+    user_id: Optional[int] = None
+    ready: Dict[CheckType, str] = field(default_factory=dict)
+    waiters: Dict[CheckType, asyncio.Future] = field(default_factory=dict)
+    first_ready_at: Optional[float] = None
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+@dataclass
+class SummaryReport:
+    """What one checkup's batch cost and saved, GET /summaries"""
+    checkup_id: int
+    checks: List[str]
+    waited_seconds: float
+    seconds: float
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # the same summaries with one call per check, estimated from the prompt sizes
+    single_prompt_tokens: int = 0
+    saved_prompt_tokens: int = 0
+    single_calls: int = 0
+    executive_summary: bool = False
+    error: Optional[str] = None
+
+
+def prompt_size(messages: List[dict]) -> int:
+    return len(json.dumps(messages))
+
+
+class CheckupSummaries:
+    """
+    Summarises the checks of a checkup together.
+
+    A check whose results are ready waits for the other expected checks of its checkup, at most `wait`
+    seconds after the first of them. Then one structured output call writes a paragraph per check and
+    an executive summary of the checkup. Checks that come after that (stragglers), and paragraphs the
+    model left out, are summarised one by one as before.
+    """
+
+    def __init__(self, wait: float, enabled: bool = True, keep: int = 100):
+        self.wait = wait
+        self.enabled = enabled
+        self.batches: Dict[int, SummaryBatch] = {}
+        self.reports: Deque[SummaryReport] = deque(maxlen=keep)
+        self.tasks: Set[asyncio.Task] = set()
+        self.running: Dict[int, Tuple[SummaryBatch, asyncio.Task]] = {}
+
+    def expect(self, checkup_id: int, check_types: Iterable[CheckType], user_id: Optional[int] = None):
+        expected = set(check_types)
+        if self.enabled and expected:
+            self.batches[checkup_id] = SummaryBatch(checkup_id=checkup_id, expected=expected, user_id=user_id)
+
+    def withdraw(self, checkup_id: int, check_type: CheckType):
+        """The check failed or got its summary elsewhere, the batch doesn't wait for it"""
+        batch = self.batches.get(checkup_id)
+        if batch is None or check_type in batch.ready:
+            return
+        batch.expected.discard(check_type)
+        if not batch.expected:
+            del self.batches[checkup_id]
+        elif batch.ready and set(batch.ready) >= batch.expected:
+            self.start(batch)
+
+    def cancel(self, checkup_id: int):
+        """The checkup was cancelled: its batch isn't summarised and a summary call in progress is aborted"""
+        batch = self.batches.pop(checkup_id, None)
+        if batch is not None and batch.timer is not None:
+            batch.timer.cancel()
+        if checkup_id in self.running:
+            batch, task = self.running.pop(checkup_id)
+            task.cancel()
+        for future in (batch.waiters.values() if batch is not None else ()):
+            future.cancel()
+
+    async def summarize(self, checkup_id: int, check_type: CheckType, results: dict,
+                        user_id: Optional[int] = None) -> str:
+        results_for_summary = await filter_for_summary(results, check_type)
+        batch = self.batches.get(checkup_id)
+        if batch is None or check_type not in batch.expected:
+            SUMMARY_CALLS.labels("single").inc()
+            return await summarize_filtered(results_for_summary, check_type, user_id)
+
+        future = asyncio.get_running_loop().create_future()
+        batch.ready[check_type] = results_for_summary
+        batch.waiters[check_type] = future
+        if set(batch.ready) >= batch.expected:
+            self.start(batch)
+        elif batch.timer is None:
+            batch.first_ready_at = time.monotonic()
+            batch.timer = asyncio.get_running_loop().call_later(self.wait, self.start, batch)
+        with track_stage(check_type.value, "summary", batched=True):
+            # the batch outlives a cancelled check, the other checks still need it
+            return await asyncio.shield(future)
+
+    def start(self, batch: SummaryBatch):
+        if self.batches.get(batch.checkup_id) is not batch:
+            return
+        del self.batches[batch.checkup_id]
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = asyncio.create_task(self.run(batch))
+        self.tasks.add(task)
+        self.running[batch.checkup_id] = (batch, task)
+        task.add_done_callback(self.tasks.discard)
+        task.add_done_callback(lambda _: self.running.pop(batch.checkup_id, None))
+
+    async def run(self, batch: SummaryBatch):
+        try:
+            await self.summarize_batch(batch)
+        finally:
+            # a check must never wait forever for its paragraph, whatever went wrong
+            for future in batch.waiters.values():
+                if not future.done():
+                    future.set_exception(RuntimeError(f"the summary batch of checkup {batch.checkup_id} failed"))
+
+    async def summarize_batch(self, batch: SummaryBatch):
+        ready = dict(batch.ready)
+        report = SummaryReport(checkup_id=batch.checkup_id, checks=[check_type.value for check_type in ready],
+                               waited_seconds=round(time.monotonic() - (batch.first_ready_at or time.monotonic()), 3),
+                               seconds=0.0)
+        for check_type in batch.expected - set(ready):
+            # a straggler of this batch will be summarised on its own
+            print(f"[summary] checkup {batch.checkup_id}: {check_type.value} missed the batch")
+            SUMMARY_CALLS.labels("straggler").inc()
+
+        paragraphs, executive_summary = {}, None
+        started_at = time.perf_counter()
+        with span("checkup.summary", checkup_id=batch.checkup_id, checks=len(ready)) as summary_span:
+            try:
+                SUMMARY_CALLS.labels("batch").inc()
+                output, usage = await llm_gateway.call(Priority.BACKGROUND, batch.user_id,
+                                                       estimate_tokens(*ready.values(), completion=300 * len(ready)),
+                                                       get_agent_checkup_summary_response, ready)
+                checks = output.get("checks") or {}
+                if not isinstance(checks, dict):
+                    raise ValueError(f"checks of the answer are a {type(checks).__name__}, not an object")
+                paragraphs = checks
+                executive_summary = output.get("executive_summary") or None
+                self.count_tokens(report, ready, usage)
+            except Exception as e:
+                print(f"[summary] batch of checkup {batch.checkup_id} failed: {e}")
+                report.error = str(e) or type(e).__name__
+            report.seconds = round(time.perf_counter() - started_at, 3)
+            summary_span.attributes.update(prompt_tokens=report.prompt_tokens,
+                                           saved_prompt_tokens=report.saved_prompt_tokens)
+
+        # paragraphs the model left out, or all of them if the call failed
+        missing = [check_type for check_type in ready if not isinstance(paragraphs.get(check_type.value), str)
+                   or not paragraphs[check_type.value]]
+        report.single_calls = len(missing)
+        singles = await asyncio.gather(*[summarize_filtered(ready[check_type], check_type, batch.user_id)
+                                         for check_type in missing], return_exceptions=True)
+        SUMMARY_CALLS.labels("single").inc(len(missing))
+        paragraphs.update({check_type.value: single for check_type, single in zip(missing, singles)})
+
+        if executive_summary:
+            # saved before the checks complete, so the cached checkup response has it
+            try:
+                async with db_session() as db:
+                    await db_update_checkup_summary(batch.checkup_id, executive_summary, db=db)
+                report.executive_summary = True
+            except Exception as e:
+                print(f"[summary] saving the summary of checkup {batch.checkup_id} failed: {e}")
+
+        for check_type, future in batch.waiters.items():
+            if future.done():
+                continue
+            paragraph = paragraphs[check_type.value]
+            if isinstance(paragraph, BaseException):
+                future.set_exception(paragraph)
+            else:
+                future.set_result(paragraph)
+        self.reports.append(report)
+
+    @staticmethod
+    def count_tokens(report: SummaryReport, ready: Dict[CheckType, str], usage: dict):
+        report.prompt_tokens = usage.get("prompt_tokens") or 0
+        report.completion_tokens = usage.get("completion_tokens") or 0
+        batch_size = prompt_size(create_checkup_summary_messages(ready))
+        single_size = sum(prompt_size(create_check_summary_messages(results, check_type))
+                          for check_type, results in ready.items())
+        report.single_prompt_tokens = round(report.prompt_tokens * single_size / batch_size)
+        report.saved_prompt_tokens = report.single_prompt_tokens - report.prompt_tokens
+        SUMMARY_TOKENS.labels("prompt").inc(report.prompt_tokens)
+        SUMMARY_TOKENS.labels("completion").inc(report.completion_tokens)
+        SUMMARY_TOKENS.labels("saved").inc(max(report.saved_prompt_tokens, 0))
+
+    def stats(self) -> dict:
+        reports = list(self.reports)
+        return {
+            "enabled": self.enabled,
+            "wait": self.wait,
+            "waiting_checkups": len(self.batches),
+            "saved_prompt_tokens": sum(report.saved_prompt_tokens for report in reports),
+            "checkups": [asdict(report) for report in reversed(reports)],
+        }
+
+
+checkup_summaries = CheckupSummaries(SUMMARY_BATCH_WAIT, SUMMARY_BATCH_ENABLED)
@@ -1,3 +1,4 @@
+import secrets
 from datetime import datetime, timedelta, timezone
 
 from fastapi import APIRouter, HTTPException, Depends, Request, Response, status
@@ -6,7 +7,8 @@ from passlib.context import CryptContext
 from pydantic import BaseModel, ValidationError, Field
 from starlette.responses import RedirectResponse
 
-from constants import ACCESS_TOKEN_EXPIRE_MINUTES, ALGORITHM, SECRET_KEY, CLIENT_ID, CLIENT_SECRET, FRONTEND_URL
+from constants import ACCESS_TOKEN_EXPIRE_MINUTES, ALGORITHM, SECRET_KEY, CLIENT_ID, CLIENT_SECRET, FRONTEND_URL, \
+    INTERNAL_API_TOKEN
 from lib.postgres_db import yield_db
 from lib.redis_db import revoke_token, check_token_revoked, redis_for_session
 from lib.utils import extract_hostname, is_running_in_docker
@@ -94,6 +96,27 @@ async def verify_jwt(token: str = Depends(get_token_from_cookie)) -> TokenDataFu
         )
 
 
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+
+async def verify_internal(request: Request):
+    """
+    Protects the internal stats endpoints: `Authorization: Bearer <INTERNAL_API_TOKEN>`,
+    without a configured token only requests from localhost are allowed
+    """
+    if INTERNAL_API_TOKEN is None:
+        if request.client is None or request.client.host not in LOOPBACK_HOSTS:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Internal endpoint")
+        return
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), INTERNAL_API_TOKEN.encode()):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid internal token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
 # endregion
 
 # region ROUTES
@@ -163,7 +186,6 @@ async def logout(request: Request, response: Response, _: dict = Depends(verify_
 
 # region GOOGLE AUTH
 import time
-import secrets
 from authlib.integrations.starlette_client import OAuth
 
 
@@ -0,0 +1,257 @@
+"""
+Load test of the chat endpoints: how many concurrent users and message streams one API process sustains.
+
+    python -m benchmarks.chat_load [--users 20] [--messages 5] [--tokens-per-second 50] [--first-token-seconds 0.5]
+                                   [--answer-tokens 150] [--output chat_load.json]
+    python -m benchmarks.chat_load --base-url https://planspiegel.com/api --target-url https://example.com/
+
+Every virtual user registers, creates a checkup, waits for its checks (polling with ETags like the frontend),
+sends --messages chat messages to a completed check, alternating streamed and plain answers, and downloads the PDF.
+
+Without --base-url, one API process (uvicorn main:app) is started against the local fakes of
+benchmarks/fakes.py, the fake OpenAI answers at --tokens-per-second after --first-token-seconds.
+It needs the Postgres and Redis of .env. With --base-url, the running API is used as it is configured.
+
+Reports p50/p95/p99 per step, time to first token of the streamed answers and the event loop lag of the API,
+measured as the latency of GET /admission (no I/O, answered on the loop) probed every --probe-seconds,
+plus the lag and the blocking routes the API's own loop monitor saw (GET /loop-monitor).
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.fakes import FakeServices, fake_lighthouse, free_port
+from benchmarks.pipeline import latency_summary
+
+QUESTIONS = [
+    "Which ports are open?",
+    "What is the most critical finding?",
+    "How do I fix the missing security headers?",
+    "Is the TLS configuration good enough?",
+]
+FINAL_STATUSES = {"completed", "failed"}
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, step: str, seconds: float):
+        self.latencies[step].append(seconds)
+
+    def summary(self) -> dict:
+        return {"steps": {step: latency_summary(values) for step, values in self.latencies.items()},
+                "errors": dict(self.errors)}
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, stats: LoadStats, target_url: str, messages: int,
+                 poll_seconds: float):
+        self.client = client
+        self.stats = stats
+        self.target_url = target_url
+        self.messages = messages
+        self.poll_seconds = poll_seconds
+
+    async def timed(self, step: str, method: str, url: str, **kwargs) -> httpx.Response:
+        started_at = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        self.stats.record(step, time.perf_counter() - started_at)
+        response.raise_for_status()
+        return response
+
+    async def run(self):
+        email = f"load-{uuid.uuid4().hex[:12]}@planspiegel.local"
+        token = (await self.timed("register", "POST", "/auth/register",
+                                  json={"email": email, "password": uuid.uuid4().hex})).json()["access_token"]
+        # the auth cookie is Secure, so it is sent by hand for plain HTTP
+        self.client.headers["Cookie"] = f"access_token={token}"
+
+        checkup = (await self.timed("create_checkup", "POST", "/checkups", json={"url": self.target_url})).json()
+        started_at = time.perf_counter()
+        checkup = await self.wait_for_checks(checkup["checkup_id"])
+        self.stats.record("checkup_ready", time.perf_counter() - started_at)
+
+        check = next((check for check in checkup["checks"] if check["status"] == "completed" and check["chat"]), None)
+        if check is None:
+            raise RuntimeError(f"checkup {checkup['checkup_id']} has no completed check to chat about")
+        url = f"/checkups/{checkup['checkup_id']}/checks/{check['check_id']}/chats/{check['chat']['chat_id']}/messages"
+        for index in range(self.messages):
+            question = QUESTIONS[index % len(QUESTIONS)]
+            if index % 2 == 0:
+                await self.stream_message(url, question)
+            else:
+                await self.timed("message", "POST", url, data={"question": question, "use_stream": "false"})
+        await self.timed("messages_history", "GET", url)
+
+        await self.timed("pdf_report", "GET", f"/checkups/{checkup['checkup_id']}/pdf_report")
+
+    async def wait_for_checks(self, checkup_id: int) -> dict:
+        etag, checkup = None, None
+        while True:
+            response = await self.timed("poll_checkup", "GET", f"/checkups/{checkup_id}",
+                                        headers={"If-None-Match": etag} if etag else None)
+            if response.status_code != 304:
+                etag, checkup = response.headers.get("ETag"), response.json()
+            if checkup["checks"] and all(check["status"] in FINAL_STATUSES for check in checkup["checks"]):
+                return checkup
+            await asyncio.sleep(self.poll_seconds)
+
+    async def stream_message(self, url: str, question: str):
+        started_at = time.perf_counter()
+        first_token_at = None
+        async with self.client.stream("POST", url, data={"question": question, "use_stream": "true"}) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                if chunk and first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    self.stats.record("time_to_first_token", first_token_at - started_at)
+        self.stats.record("message_stream", time.perf_counter() - started_at)
+
+
+async def probe_loop_lag(client: httpx.AsyncClient, stats: LoadStats, interval: float, stop: asyncio.Event):
+    while not stop.is_set():
+        started_at = time.perf_counter()
+        try:
+            (await client.get("/admission")).raise_for_status()
+            stats.record("loop_lag_probe", time.perf_counter() - started_at)
+        except httpx.HTTPError:
+            stats.errors["loop_lag_probe"] += 1
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_load(base_url: str, target_urls: List[str], messages: int, poll_seconds: float,
+                   probe_seconds: float) -> dict:
+    stats = LoadStats()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    timeout = httpx.Timeout(300.0)
+
+    async def user_session(target_url: str):
+        # a client per user, every user has its own cookie
+        async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+            try:
+                await VirtualUser(client, stats, target_url, messages, poll_seconds).run()
+            except (httpx.HTTPError, RuntimeError, KeyError) as e:
+                stats.errors[type(e).__name__] += 1
+                print(f"[chat_load] user failed: {e}")
+
+    stop = asyncio.Event()
+    # the probed stats endpoints are internal, allowed from localhost or with the token
+    internal_token = os.getenv("INTERNAL_API_TOKEN")
+    probe_headers = {"Authorization": f"Bearer {internal_token}"} if internal_token else None
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, headers=probe_headers) as probe_client:
+        probe = asyncio.create_task(probe_loop_lag(probe_client, stats, probe_seconds, stop))
+        started_at = time.perf_counter()
+        await asyncio.gather(*[user_session(target_url) for target_url in target_urls])
+        elapsed = time.perf_counter() - started_at
+        stop.set()
+        await probe
+        try:
+            loop_monitor = (await probe_client.get("/loop-monitor")).json()
+        except (httpx.HTTPError, ValueError):
+            loop_monitor = None
+
+    return {"users": len(target_urls), "messages_per_user": messages, "seconds": round(elapsed, 3),
+            **stats.summary(), "loop_monitor": loop_monitor}
+
+
+def start_api(services: FakeServices, port: int) -> subprocess.Popen:
+    env = {**os.environ, **services.env()}
+    if shutil.which("lighthouse", path=env["PATH"]) is None:
+        env["PATH"] = fake_lighthouse() + os.pathsep + env["PATH"]
+    api = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+                           env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/healthz").json().get("status") == "ok":
+                return api
+        except (httpx.HTTPError, ValueError):
+            pass
+        if api.poll() is not None:
+            raise RuntimeError(f"API exited with {api.returncode}")
+        time.sleep(0.5)
+    api.terminate()
+    raise RuntimeError("API didn't become healthy within 60s")
+
+
+def print_results(results: dict):
+    print(f"{results['users']} users, {results['messages_per_user']} messages each: {results['seconds']}s, "
+          f"errors {results['errors'] or 'none'}")
+    print(f"{'step':<22}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for step, summary in results["steps"].items():
+        print(f"{step:<22}{summary['count']:>7}{summary['p50']:>10.3f}{summary['p95']:>10.3f}{summary['p99']:>10.3f}"
+              f"{summary['max']:>10.3f}")
+    if results["loop_monitor"]:
+        stalls = results["loop_monitor"]["stalls"]
+        print(f"API loop: max lag {results['loop_monitor']['max_lag']:.3f}s, {len(stalls)} stalls over "
+              f"{results['loop_monitor']['threshold']}s")
+        for route in sorted({stall["route"] for stall in stalls}):
+            durations = [stall["duration"] or 0 for stall in stalls if stall["route"] == route]
+            print(f"  {route:<60}{len(durations):>5} stalls, max {max(durations):.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5, help="chat messages per user")
+    parser.add_argument("--base-url", help="running API, nothing is started")
+    parser.add_argument("--target-url", default="https://planspiegel-landing.vercel.app/",
+                        help="checked website with --base-url")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--first-token-seconds", type=float, default=0.5)
+    parser.add_argument("--answer-tokens", type=int, default=150)
+    parser.add_argument("--poll-seconds", type=float, default=1.0)
+    parser.add_argument("--probe-seconds", type=float, default=0.1)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    services: Optional[FakeServices] = None
+    api: Optional[subprocess.Popen] = None
+    if args.base_url:
+        base_url, target_urls = args.base_url, [args.target_url] * args.users
+    else:
+        if not 1 <= args.users <= 250:
+            parser.error("--users must be in 1-250, one loopback address per user")
+        # a website per user, identical hostnames would be coalesced by single flight
+        services = FakeServices(hosts=[f"127.0.0.{index}" for index in range(1, args.users + 2)],
+                                openai_seconds=args.first_token_seconds,
+                                openai_token_seconds=1 / args.tokens_per_second,
+                                answer_tokens=args.answer_tokens).start()
+        port = free_port()
+        api = start_api(services, port)
+        base_url, target_urls = f"http://127.0.0.1:{port}", [services.url(host) for host in services.hosts[1:]]
+
+    try:
+        results = asyncio.run(run_load(base_url, target_urls, args.messages, args.poll_seconds, args.probe_seconds))
+    finally:
+        if api is not None:
+            api.terminate()
+            api.wait(timeout=30)
+        if services is not None:
+            services.stop()
+    if services is not None:
+        results["requests"] = dict(services.requests)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Bytes on the wire and CPU cost of response compression for the fixture payloads in checks/*_example*.json.
+
+    python -m benchmarks.compression [--repeat 20]
+
+Every fixture is wrapped into a check response as the API sends it and compressed with
+gzip and Brotli (if installed) at a few levels. The last block simulates the SSE chat
+stream, compressed with a flush per event like CompressionMiddleware does.
+"""
+import argparse
+import glob
+import gzip
+import os
+import time
+
+from benchmarks.serialization import raw_results
+from lib.compression import StreamCompressor, brotli
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def codecs():
+    yield "gzip-1", lambda body: gzip.compress(body, compresslevel=1)
+    yield "gzip-6", lambda body: gzip.compress(body, compresslevel=6)
+    yield "gzip-9", lambda body: gzip.compress(body, compresslevel=9)
+    if brotli is not None:
+        yield "br-4", lambda body: brotli.compress(body, quality=4)
+        yield "br-5", lambda body: brotli.compress(body, quality=5)
+        yield "br-11", lambda body: brotli.compress(body, quality=11)
+
+
+def cpu_ms(fn, body: bytes, repeat: int) -> float:
+    started_at = time.process_time()
+    for _ in range(repeat):
+        fn(body)
+    return (time.process_time() - started_at) / repeat * 1000
+
+
+def sse_events(count: int) -> list[bytes]:
+    return [f"data: {{\"content\": \"token {i} of the streamed answer\"}}\n\n".encode() for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    if brotli is None:
+        print("Brotli is not installed, gzip only\n")
+
+    names = [name for name, _ in codecs()]
+    print(f"{'fixture':<45}{'KB':>8}" + "".join(f"{name:>16}" for name in names) + "   (KB / CPU ms)")
+    for path in sorted(glob.glob(os.path.join(project_root, 'checks', '*_example*.json'))):
+        with open(path, "r", encoding="utf-8") as f:
+            body = raw_results(f.read())
+
+        cells = []
+        for _, fn in codecs():
+            size = len(fn(body)) / 1024
+            cells.append(f"{size:>8.1f}/{cpu_ms(fn, body, args.repeat):<7.2f}")
+        print(f"{os.path.basename(path):<45}{len(body) / 1024:>8.1f}" + "".join(f"{c:>16}" for c in cells))
+
+    events = sse_events(500)
+    plain = sum(len(event) for event in events)
+    print(f"\nSSE stream, {len(events)} events, {plain / 1024:.1f} KB plain")
+    for encoding in ("gzip", "br") if brotli is not None else ("gzip",):
+        started_at = time.process_time()
+        compressor = StreamCompressor(encoding, gzip_level=6, brotli_quality=5, flush_each_chunk=True)
+        wire = sum(len(compressor.compress(event, final=False)) for event in events)
+        wire += len(compressor.compress(b"", final=True))
+        elapsed = (time.process_time() - started_at) * 1000
+        print(f"{encoding:<6}{wire / 1024:>8.1f} KB on the wire, {elapsed:.2f} CPU ms")
+
+
+if __name__ == "__main__":
+    main()
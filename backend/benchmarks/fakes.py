@@ -0,0 +1,298 @@
+"""
+Local stand-ins for the external services of a checkup, for benchmarks.
+
+    services = FakeServices(hosts=["127.0.0.1", "127.0.0.2"], openai_seconds=0.5).start()
+    services.env()  # OPENAI_BASE_URL, MXTOOLBOX_URL, COOKIE_SCANNER_URL, ...
+
+One HTTP/1.1 server on a loop of its own thread, so it doesn't compete with the loop under test:
+- /v1/chat/completions: OpenAI chat completions, streamed as SSE when asked for
+- /v1/embeddings: OpenAI embeddings, a hashed bag of words, so questions with the same words are similar
+- /api/scan: the cookie scanner, a scan is done cookie_scanner_seconds after it was started
+- /api/v1/lookup/<command>/: MXToolbox lookups
+- everything else: a small website with scripts for Lighthouse, Wappalyzer and retire.js
+Payloads are the fixtures in checks/*_example.json.
+"""
+import array
+import asyncio
+import base64
+import itertools
+import json
+import os
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+SITE_HTML = b"""<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <meta name="generator" content="WordPress 6.4.2">
+  <title>Benchmark site</title>
+  <script src="/static/jquery-3.4.1.min.js"></script>
+  <script src="/static/bootstrap-4.3.1.min.js"></script>
+</head>
+<body><h1>Benchmark site</h1><p>Served by benchmarks/fakes.py</p></body>
+</html>
+"""
+SITE_SCRIPT = b"/*! benchmark fixture */ (function () { window.benchmark = true; })();\n"
+SUMMARY_WORDS = ("The check found no critical issues, the configuration follows the usual security standards "
+                 "and the remaining findings are recommendations.").split()
+EMBEDDING_DIMENSIONS = 256
+
+
+def load_fixture(name: str) -> dict:
+    with open(os.path.join(project_root, "checks", name), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def free_port(host: str = "127.0.0.1") -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class FakeServices:
+    def __init__(self, hosts: List[str] = ("127.0.0.1",), openai_seconds: float = 0.5,
+                 openai_token_seconds: float = 0.01, cookie_scanner_seconds: float = 2.0,
+                 mxtoolbox_seconds: float = 0.2, answer_tokens: int = len(SUMMARY_WORDS)):
+        self.hosts = list(hosts)
+        self.port = free_port(self.hosts[0])
+        # time to the first token and between tokens of a completion
+        self.openai_seconds = openai_seconds
+        self.openai_token_seconds = openai_token_seconds
+        self.cookie_scanner_seconds = cookie_scanner_seconds
+        self.mxtoolbox_seconds = mxtoolbox_seconds
+        # a token is a word of the answer
+        self.answer = list(itertools.islice(itertools.cycle(SUMMARY_WORDS), answer_tokens))
+
+        self.cookie_result = load_fixture("cookies_check_example.json")
+        self.network_results = load_fixture("network_check_example.json")["results"]
+        # identifier -> (done at, target)
+        self.scans: Dict[str, Tuple[float, str]] = {}
+        self.scan_ids = itertools.count(1)
+        self.requests: Dict[str, int] = {}
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.server: Optional[asyncio.Server] = None
+        self.thread: Optional[threading.Thread] = None
+
+    # region LIFECYCLE
+    def start(self) -> "FakeServices":
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self.handle, self.hosts, self.port, backlog=1024))
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name="fake-services", daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.close_connections(), self.loop).result(timeout=5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=5)
+
+    async def close_connections(self):
+        # e.g. a completion that is still waiting for its first token
+        self.server.close()
+        handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for handler in handlers:
+            handler.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    def url(self, host: str | None = None, path: str = "/") -> str:
+        return f"http://{host or self.hosts[0]}:{self.port}{path}"
+
+    def env(self) -> Dict[str, str]:
+        """Settings that point the backend at the fakes, set them before constants is imported"""
+        return {
+            "OPENAI_API_KEY": "benchmark",
+            "OPENAI_BASE_URL": self.url(path="/v1"),
+            "MXTOOLBOX_KEY": "benchmark",
+            "MXTOOLBOX_URL": self.url(path="/api/v1"),
+            "MXTOOLBOX_MOCK": "false",
+            "COOKIE_SCANNER_URL": self.url(path="").rstrip("/"),
+            "COOKIE_SCANNER_CALLBACK_URL": "",
+        }
+
+    # endregion
+
+    # region HTTP
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+
+                keep_alive = await self.route(method, urllib.parse.urlsplit(target), body, writer)
+                if not keep_alive or headers.get("connection", "").lower() == "close":
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            return
+        finally:
+            writer.close()
+
+    async def respond(self, writer: asyncio.StreamWriter, content: bytes, content_type: str = "application/json",
+                      status: str = "200 OK") -> bool:
+        writer.write((f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(content)}\r\n"
+                      f"Server: fake-services\r\n\r\n").encode() + content)
+        await writer.drain()
+        return True
+
+    async def route(self, method: str, url: urllib.parse.SplitResult, body: bytes,
+                    writer: asyncio.StreamWriter) -> bool:
+        path = url.path
+        if path.endswith("/chat/completions") and method == "POST":
+            self.count("openai")
+            return await self.chat_completion(orjson.loads(body or b"{}"), writer)
+        if path.endswith("/embeddings") and method == "POST":
+            self.count("openai_embeddings")
+            return await self.embeddings(orjson.loads(body or b"{}"), writer)
+        if path.startswith("/api/scan"):
+            self.count("cookie_scanner")
+            return await self.cookie_scanner(method, path, urllib.parse.parse_qs(url.query), writer)
+        if path.startswith("/api/v1/lookup/"):
+            self.count("mxtoolbox")
+            return await self.mxtoolbox(path.split("/")[4], writer)
+        self.count("site")
+        if path.endswith(".js"):
+            return await self.respond(writer, SITE_SCRIPT, "application/javascript")
+        return await self.respond(writer, SITE_HTML, "text/html; charset=utf-8")
+
+    def count(self, service: str):
+        self.requests[service] = self.requests.get(service, 0) + 1
+
+    # endregion
+
+    # region SERVICES
+    async def chat_completion(self, request: dict, writer: asyncio.StreamWriter) -> bool:
+        created = int(time.time())
+        envelope = {"id": f"chatcmpl-{created}", "created": created, "model": request.get("model", "gpt-4o-mini")}
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            content = orjson.dumps(self.from_schema(response_format["json_schema"]["schema"])).decode()
+        else:
+            content = " ".join(self.answer)
+        words = content.split(" ")
+        # roughly 4 characters per token, so that prompt sizes show in the usage
+        prompt_tokens = len(orjson.dumps(request.get("messages", []))) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+
+        if not request.get("stream"):
+            await asyncio.sleep(self.openai_seconds)
+            completion = {**envelope, "object": "chat.completion", "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage}
+            await asyncio.sleep(self.openai_token_seconds * len(words))
+            return await self.respond(writer, orjson.dumps(completion))
+
+        # SSE until the connection closes, the way the API streams: headers at once, tokens after openai_seconds
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\n")
+        await writer.drain()
+        await asyncio.sleep(self.openai_seconds)
+        for index, word in enumerate(words):
+            part = word if index == len(words) - 1 else word + " "
+            chunk = {**envelope, "object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": {"role": "assistant", "content": part} if index == 0 else
+                 {"content": part}, "finish_reason": None}]}
+            writer.write(b"data: " + orjson.dumps(chunk) + b"\n\n")
+            await writer.drain()
+            await asyncio.sleep(self.openai_token_seconds)
+        last = {**envelope, "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        writer.write(b"data: " + orjson.dumps(last) + b"\n\n")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            writer.write(b"data: " + orjson.dumps({**envelope, "object": "chat.completion.chunk", "choices": [],
+                                                   "usage": usage}) + b"\n\n")
+        writer.write(b"data: [DONE]\n\n")
+        await writer.drain()
+        return False
+
+    def from_schema(self, schema: dict):
+        """An object of a json_schema response_format, every string is the answer"""
+        if schema.get("type") == "object":
+            return {name: self.from_schema(value) for name, value in schema.get("properties", {}).items()}
+        return " ".join(self.answer)
+
+    async def embeddings(self, request: dict, writer: asyncio.StreamWriter) -> bool:
+        inputs = request.get("input", "")
+        data = []
+        for index, text in enumerate([inputs] if isinstance(inputs, str) else inputs):
+            vector = [0.0] * EMBEDDING_DIMENSIONS
+            for word in text.lower().split():
+                vector[zlib.crc32(word.encode()) % EMBEDDING_DIMENSIONS] += 1.0
+            # the client asks for base64 floats unless it set encoding_format
+            embedding = (base64.b64encode(array.array("f", vector).tobytes()).decode()
+                         if request.get("encoding_format") == "base64" else vector)
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        tokens = sum(len(str(item).split()) for item in ([inputs] if isinstance(inputs, str) else inputs))
+        return await self.respond(writer, orjson.dumps({"object": "list", "data": data, "model": request.get("model"),
+                                                        "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}))
+
+    async def cookie_scanner(self, method: str, path: str, query: dict, writer: asyncio.StreamWriter) -> bool:
+        if method == "POST":
+            identifier = f"benchmark-{next(self.scan_ids)}"
+            self.scans[identifier] = (time.monotonic() + self.cookie_scanner_seconds, query.get("target", [""])[0])
+            return await self.respond(writer, orjson.dumps({"identifier": identifier}))
+
+        identifier = path.rstrip("/").rsplit("/", 1)[-1]
+        if identifier not in self.scans:
+            return await self.respond(writer, orjson.dumps({"error": "Unknown scan"}), status="404 Not Found")
+        done_at, target = self.scans[identifier]
+        if time.monotonic() < done_at:
+            return await self.respond(writer, orjson.dumps({"status": "running", "identifier": identifier}))
+        result = {**self.cookie_result, "status": "done", "identifier": identifier, "target": target,
+                  "images": []}
+        return await self.respond(writer, orjson.dumps(result))
+
+    async def mxtoolbox(self, command: str, writer: asyncio.StreamWriter) -> bool:
+        await asyncio.sleep(self.mxtoolbox_seconds)
+        data = self.network_results.get(command, {}).get("data") or {"Failed": [], "Warnings": [], "Passed": [],
+                                                                     "Timeouts": []}
+        return await self.respond(writer, orjson.dumps(data))
+
+    # endregion
+
+
+def fake_lighthouse(seconds: float = 3.0) -> str:
+    """
+    Directory with a `lighthouse` executable that waits and writes the fixture report,
+    put it in front of PATH when Lighthouse and Chrome aren't installed.
+    """
+    directory = tempfile.mkdtemp(prefix="fake-lighthouse-")
+    path = os.path.join(directory, "lighthouse")
+    fixture = os.path.join(project_root, "checks", "lighthouse_check_example.json")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"""#!{sys.executable}
+import shutil, sys, time
+time.sleep({seconds})
+output = next(arg.split("=", 1)[1] for arg in sys.argv if arg.startswith("--output-path="))
+shutil.copyfile({fixture!r}, output)
+""")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return directory
@@ -0,0 +1,154 @@
+"""
+Image attachment preprocessing: vision tokens, bytes and time saved by the downscaled WebP variant.
+
+    python -m benchmarks.images [--images a.png b.jpg ...] [--repeat 20] [--bandwidth-mbps 50] [--output images.json]
+
+Without --images, sample screenshots are drawn (desktop, retina, phone with EXIF rotation, full page).
+For every image: the input tokens with detail "high" of the original and the variant, their sizes,
+the time the model side needs to download them at --bandwidth-mbps, and the preparation time.
+Then --repeat copies of all images are prepared inline and in the process pool of lib.images.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import time
+from typing import Dict, List
+
+from benchmarks.pipeline import latency_summary
+from lib.images import prepare_image, prepare_image_in_pool, shutdown_image_pool, vision_tokens
+
+SAMPLES = {
+    "desktop_1920x1080.png": (1920, 1080, "PNG"),
+    "retina_2880x1800.png": (2880, 1800, "PNG"),
+    "phone_1170x2532.jpg": (1170, 2532, "JPEG"),
+    "full_page_1440x5200.png": (1440, 5200, "PNG"),
+}
+
+
+def draw_screenshot(width: int, height: int, image_format: str) -> bytes:
+    """A page with a header, text lines and cards, close enough to a real screenshot for encoders"""
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, width, 80), fill=(24, 39, 71))
+    draw.text((24, 30), "planspiegel.com - security checkup", fill="white")
+    for top in range(120, height - 40, 36):
+        row = top // 36
+        if row % 9 == 0:
+            draw.rounded_rectangle((24, top, width // 2, top + 28), radius=6, fill=(230, 240, 255))
+        line = f"{row:04d} Strict-Transport-Security: max-age=31536000; includeSubDomains; port {row * 7 % 65535}"
+        draw.text((32, top + 8), line * (width // 600 + 1), fill=(40 + row % 50, 40, 40))
+    output = io.BytesIO()
+    if image_format == "JPEG":
+        # a phone stores the pixels sideways and the orientation in EXIF
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        image.transpose(Image.Transpose.ROTATE_90).save(output, "JPEG", quality=92, exif=exif)
+    else:
+        image.save(output, image_format)
+    return output.getvalue()
+
+
+def load_images(paths: List[str]) -> Dict[str, bytes]:
+    if not paths:
+        return {name: draw_screenshot(*sample) for name, sample in SAMPLES.items()}
+    images = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            images[os.path.basename(path)] = f.read()
+    return images
+
+
+def compare(name: str, content: bytes, bandwidth_mbps: float) -> dict:
+    started_at = time.perf_counter()
+    prepared = prepare_image(content)
+    seconds = time.perf_counter() - started_at
+    if prepared is None:
+        return {"image": name, "error": "not an image"}
+    original_tokens = vision_tokens(prepared.original_width, prepared.original_height)
+    tokens = vision_tokens(prepared.width, prepared.height)
+    bytes_per_second = bandwidth_mbps * 1_000_000 / 8
+    return {
+        "image": name,
+        "original": f"{prepared.original_width}x{prepared.original_height}",
+        "prepared": f"{prepared.width}x{prepared.height}",
+        "original_tokens": original_tokens,
+        "tokens": tokens,
+        "original_kb": round(len(content) / 1024, 1),
+        "kb": round(len(prepared.content) / 1024, 1),
+        "original_download_seconds": round(len(content) / bytes_per_second, 3),
+        "download_seconds": round(len(prepared.content) / bytes_per_second, 3),
+        "prepare_seconds": round(seconds, 3),
+    }
+
+
+async def prepare_in_pool(contents: List[bytes]) -> float:
+    started_at = time.perf_counter()
+    await asyncio.gather(*[prepare_image_in_pool(content) for content in contents])
+    return time.perf_counter() - started_at
+
+
+def throughput(images: Dict[str, bytes], repeat: int) -> dict:
+    contents = list(images.values()) * repeat
+    started_at = time.perf_counter()
+    latencies = []
+    for content in contents:
+        image_started_at = time.perf_counter()
+        prepare_image(content)
+        latencies.append(time.perf_counter() - image_started_at)
+    inline_seconds = time.perf_counter() - started_at
+
+    # the first image starts the workers, they are warmed up before measuring
+    asyncio.run(prepare_in_pool(contents[:1]))
+    pool_seconds = asyncio.run(prepare_in_pool(contents))
+    shutdown_image_pool()
+    return {"images": len(contents), "prepare_seconds": latency_summary(latencies),
+            "inline_images_per_second": round(len(contents) / inline_seconds, 1),
+            "pool_images_per_second": round(len(contents) / pool_seconds, 1)}
+
+
+def print_results(results: dict):
+    print(f"{'image':<28}{'size':>22}{'tokens':>14}{'KB':>18}{'download s':>16}{'prepare s':>11}")
+    for row in results["images"]:
+        if "error" in row:
+            print(f"{row['image']:<28} {row['error']}")
+            continue
+        print(f"{row['image']:<28}{row['original'] + ' -> ' + row['prepared']:>22}"
+              f"{str(row['original_tokens']) + ' -> ' + str(row['tokens']):>14}"
+              f"{str(row['original_kb']) + ' -> ' + str(row['kb']):>18}"
+              f"{str(row['original_download_seconds']) + ' -> ' + str(row['download_seconds']):>16}"
+              f"{row['prepare_seconds']:>11.3f}")
+    rows = [row for row in results["images"] if "error" not in row]
+    if rows:
+        original = sum(row["original_tokens"] for row in rows)
+        prepared = sum(row["tokens"] for row in rows)
+        print(f"tokens {original} -> {prepared} ({(1 - prepared / original) * 100:.0f}% saved), "
+              f"KB {sum(row['original_kb'] for row in rows):.0f} -> {sum(row['kb'] for row in rows):.0f}")
+    pool = results["throughput"]
+    print(f"{pool['images']} images: inline {pool['inline_images_per_second']}/s, "
+          f"process pool {pool['pool_images_per_second']}/s, prepare p95 {pool['prepare_seconds']['p95']}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", nargs="*", default=[], help="screenshots to use instead of the drawn samples")
+    parser.add_argument("--repeat", type=int, default=20, help="copies of every image for the throughput run")
+    parser.add_argument("--bandwidth-mbps", type=float, default=50, help="download speed of the model side")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    results = {"images": [compare(name, content, args.bandwidth_mbps) for name, content in images.items()],
+               "throughput": throughput(images, args.repeat)}
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+Full checkup pipeline with local stand-ins for every external service.
+
+    python -m benchmarks.pipeline [--checkups 20] [--concurrency 5] [--thresholds benchmarks/pipeline_thresholds.json]
+                                  [--output results.json] [--fake-lighthouse] [--per-check-summaries]
+
+Needs the Postgres and Redis of .env (docker compose up planspiegel_postgres planspiegel_redis).
+benchmarks/fakes.py serves OpenAI, the cookie scanner, MXToolbox and the website under test; the
+backend is pointed at it through OPENAI_BASE_URL, MXTOOLBOX_URL and COOKIE_SCANNER_URL. Port scans
+and fingerprinting run for real against the loopback addresses. Lighthouse runs for real if it is
+installed, --fake-lighthouse (or a missing `lighthouse`) replaces it with a script writing the fixture report.
+
+--concurrency workers run create_checkup -> start_check -> update_check_callback, a worker starts its
+next checkup when all checks of the previous one are final. Every checkup gets its own loopback address
+(127.0.0.2, 127.0.0.3, ... Linux routes all of 127/8), identical hostnames would be coalesced by single flight.
+
+Reports per-stage latency (from the check.* spans), checkup latency, throughput and peak threads/RSS,
+and exits with 1 if a value crosses its threshold. The checks of a checkup are summarised in one batched
+call, --per-check-summaries makes one call per check to compare the summary tokens and the LLM requests.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import shutil
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from benchmarks.fakes import FakeServices, fake_lighthouse
+
+STATUS_POLL_SECONDS = 0.2
+SAMPLE_SECONDS = 0.1
+default_thresholds = os.path.join(os.path.dirname(__file__), "pipeline_thresholds.json")
+
+
+class SpanCollector(logging.Handler):
+    """Finished spans from the tracing logger, recent_spans only keeps the last 2000"""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.spans: List[dict] = []
+
+    def emit(self, record: logging.LogRecord):
+        self.spans.append(json.loads(record.getMessage()))
+
+
+class ResourceSampler:
+    def __init__(self):
+        self.peak_threads = threading.active_count()
+        self.task = None
+
+    async def sample(self):
+        while True:
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            await asyncio.sleep(SAMPLE_SECONDS)
+
+    def start(self):
+        self.task = asyncio.create_task(self.sample())
+
+    def stop(self):
+        self.task.cancel()
+
+    @staticmethod
+    def peak_rss_mb() -> Dict[str, float]:
+        # kilobytes on Linux, children is the largest finished child (lighthouse, chrome)
+        return {"process": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[int(fraction * 100) - 1]
+
+
+def latency_summary(values: List[float]) -> dict:
+    return {"count": len(values), "p50": round(percentile(values, 0.5), 3), "p95": round(percentile(values, 0.95), 3),
+            "p99": round(percentile(values, 0.99), 3), "max": round(max(values, default=0.0), 3)}
+
+
+async def run_pipeline(services: FakeServices, checkups: int, concurrency: int) -> dict:
+    # the backend reads its settings when constants is imported, so only after the fakes are running
+    from sqlalchemy import select
+
+    from ai.chat import create_checkup, check_tasks
+    from ai.summary import checkup_summaries
+    from lib.postgres_db import db_session, engine
+    from models import CheckDB, db_save_user_via_provider
+
+    async with db_session() as db:
+        user = await db_save_user_via_provider("benchmark@planspiegel.local", db=db)
+
+    async def wait_for_checkup(checkup_id: int) -> list:
+        while True:
+            async with db_session() as db:
+                statuses = (await db.scalars(select(CheckDB.status).where(CheckDB.checkup_id == checkup_id))).all()
+            if statuses and all(check_status.is_final for check_status in statuses):
+                return statuses
+            await asyncio.sleep(STATUS_POLL_SECONDS)
+
+    pending = iter(services.hosts[1:checkups + 1])
+    latencies, statuses = [], defaultdict(int)
+
+    async def worker():
+        for host in pending:
+            started_at = time.perf_counter()
+            async with db_session() as db:
+                checkup = await create_checkup(services.url(host), user.user_id, False, db=db)
+            for check_status in await wait_for_checkup(checkup.checkup_id):
+                statuses[check_status.value] += 1
+            latencies.append(time.perf_counter() - started_at)
+
+    sampler = ResourceSampler()
+    sampler.start()
+    started_at = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(min(concurrency, checkups))])
+    elapsed = time.perf_counter() - started_at
+    sampler.stop()
+
+    await asyncio.gather(*check_tasks, *checkup_summaries.tasks, return_exceptions=True)
+    await engine.dispose()
+    summaries = checkup_summaries.stats()
+    return {
+        "checkups": checkups,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "checkups_per_minute": round(checkups / elapsed * 60, 2),
+        "checkup_seconds": latency_summary(latencies),
+        "checks": dict(statuses),
+        "peak_threads": sampler.peak_threads,
+        "peak_rss_mb": {name: round(value, 1) for name, value in ResourceSampler.peak_rss_mb().items()},
+        "requests": dict(services.requests),
+        "summaries": {
+            "batched": summaries["enabled"],
+            "batches": len(summaries["checkups"]),
+            "prompt_tokens": sum(report["prompt_tokens"] for report in summaries["checkups"]),
+            "saved_prompt_tokens": summaries["saved_prompt_tokens"],
+            "single_calls": sum(report["single_calls"] for report in summaries["checkups"]),
+            "batch_seconds": latency_summary([report["seconds"] for report in summaries["checkups"]]),
+        },
+    }
+
+
+def stage_latencies(spans: List[dict]) -> Dict[str, Dict[str, dict]]:
+    """check type -> stage -> latency summary"""
+    durations = defaultdict(lambda: defaultdict(list))
+    for finished in spans:
+        if finished["name"].startswith("check.") and finished["end"] is not None:
+            stage = finished["name"].removeprefix("check.")
+            durations[finished["attributes"].get("check_type")][stage].append(finished["end"] - finished["start"])
+    return {check_type: {stage: latency_summary(values) for stage, values in stages.items()}
+            for check_type, stages in durations.items()}
+
+
+def regressions(results: dict, thresholds: dict) -> List[str]:
+    found = []
+    if results["checkup_seconds"]["p95"] > thresholds["checkup_p95_seconds"]:
+        found.append(f"checkup p95 {results['checkup_seconds']['p95']}s > {thresholds['checkup_p95_seconds']}s")
+    if results["checkups_per_minute"] < thresholds["min_checkups_per_minute"]:
+        found.append(f"throughput {results['checkups_per_minute']}/min < {thresholds['min_checkups_per_minute']}/min")
+    if results["peak_threads"] > thresholds["max_threads"]:
+        found.append(f"peak threads {results['peak_threads']} > {thresholds['max_threads']}")
+    if results["peak_rss_mb"]["process"] > thresholds["max_rss_mb"]:
+        found.append(f"peak RSS {results['peak_rss_mb']['process']}MB > {thresholds['max_rss_mb']}MB")
+    failed = results["checks"].get("failed", 0)
+    if failed > thresholds["max_failed_checks"]:
+        found.append(f"failed checks {failed} > {thresholds['max_failed_checks']}")
+    for check_type, stages in results["stages"].items():
+        for stage, summary in stages.items():
+            limit = thresholds["stage_p95_seconds"].get(stage)
+            if limit is not None and summary["p95"] > limit:
+                found.append(f"{check_type}.{stage} p95 {summary['p95']}s > {limit}s")
+    return found
+
+
+def print_results(results: dict):
+    print(f"{results['checkups']} checkups, {results['concurrency']} at once: {results['seconds']}s, "
+          f"{results['checkups_per_minute']} checkups/min")
+    print(f"checkup latency  p50 {results['checkup_seconds']['p50']}s  p95 {results['checkup_seconds']['p95']}s  "
+          f"max {results['checkup_seconds']['max']}s")
+    print(f"checks {results['checks']}, peak threads {results['peak_threads']}, "
+          f"peak RSS {results['peak_rss_mb']['process']}MB (largest child {results['peak_rss_mb']['children']}MB)")
+    print(f"requests to the fakes {results['requests']}")
+    summaries = results["summaries"]
+    if summaries["batched"]:
+        print(f"summaries {summaries['batches']} batches, {summaries['prompt_tokens']} prompt tokens, "
+              f"~{summaries['saved_prompt_tokens']} saved, {summaries['single_calls']} single fallbacks, "
+              f"batch call p50 {summaries['batch_seconds']['p50']}s")
+    print(f"{'check type':<14}{'stage':<12}{'count':>7}{'p50':>10}{'p95':>10}{'max':>10}")
+    for check_type, stages in sorted(results["stages"].items()):
+        for stage, summary in stages.items():
+            print(f"{check_type:<14}{stage:<12}{summary['count']:>7}{summary['p50']:>10.3f}{summary['p95']:>10.3f}"
+                  f"{summary['max']:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkups", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--thresholds", default=default_thresholds)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--fake-lighthouse", action="store_true")
+    parser.add_argument("--lighthouse-seconds", type=float, default=3.0)
+    parser.add_argument("--openai-seconds", type=float, default=0.5)
+    parser.add_argument("--cookie-scanner-seconds", type=float, default=2.0)
+    parser.add_argument("--mxtoolbox-seconds", type=float, default=0.2)
+    parser.add_argument("--per-check-summaries", action="store_true", help="one summary call per check")
+    args = parser.parse_args()
+    if not 1 <= args.checkups <= 250:
+        parser.error("--checkups must be in 1-250, one loopback address per checkup")
+
+    services = FakeServices(hosts=[f"127.0.0.{index}" for index in range(1, args.checkups + 2)],
+                            openai_seconds=args.openai_seconds, cookie_scanner_seconds=args.cookie_scanner_seconds,
+                            mxtoolbox_seconds=args.mxtoolbox_seconds).start()
+    os.environ.update(services.env())
+    if args.per_check_summaries:
+        os.environ["SUMMARY_BATCH_ENABLED"] = "false"
+    if args.fake_lighthouse or shutil.which("lighthouse") is None:
+        os.environ["PATH"] = fake_lighthouse(args.lighthouse_seconds) + os.pathsep + os.environ["PATH"]
+        print(f"fake lighthouse, {args.lighthouse_seconds}s per report")
+
+    collector = SpanCollector()
+    tracing_logger = logging.getLogger("planspiegel.tracing")
+    tracing_logger.setLevel(logging.DEBUG)
+    tracing_logger.addHandler(collector)
+    tracing_logger.propagate = False
+
+    try:
+        results = asyncio.run(run_pipeline(services, args.checkups, args.concurrency))
+    finally:
+        services.stop()
+    results["stages"] = stage_latencies(collector.spans)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    with open(args.thresholds, "r", encoding="utf-8") as f:
+        found = regressions(results, json.load(f))
+    for regression in found:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Full-range port scan time against local fixture listeners.
+
+    python -m benchmarks.port_scan [--listeners 20] [--host localhost] [--legacy]
+
+Opens --listeners TCP servers on random ports of the host, then scans all 65535 ports
+of every address it resolves to with the async engine of checks/scan_ports.py.
+--legacy also times the previous scanner (a thread per connect, first IPv4 address only).
+"""
+import argparse
+import asyncio
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from checks.scan_ports import scan_host, ports_for_profile, PortProfile, resolve_host
+
+
+async def start_listeners(host: str, count: int) -> list:
+    servers = []
+    for _ in range(count):
+        servers.append(await asyncio.start_server(lambda reader, writer: writer.close(), host, 0))
+    return servers
+
+
+def legacy_check_port(target: str, port: int):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(0.5)
+        return port if s.connect_ex((target, port)) == 0 else None
+
+
+def legacy_scan(target: str, ports: list[int], max_workers: int = 1024) -> list[int]:
+    ip_address = socket.gethostbyname(target)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [port for port in executor.map(lambda port: legacy_check_port(ip_address, port), ports) if port]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--listeners", type=int, default=20)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--legacy", action="store_true")
+    args = parser.parse_args()
+
+    servers = await start_listeners(args.host, args.listeners)
+    listening = sorted({sock.getsockname()[1] for server in servers for sock in server.sockets})
+    ports = ports_for_profile(PortProfile.FULL)
+    addresses = await resolve_host(args.host)
+    print(f"{len(listening)} listeners on {args.host} ({', '.join(address for _, address in addresses)})")
+
+    started_at = time.perf_counter()
+    results = await scan_host(args.host, ports, PortProfile.FULL)
+    elapsed = time.perf_counter() - started_at
+    found = set(results["open_ports"]) & set(listening)
+    print(f"async engine: {len(ports) * len(addresses)} connects in {elapsed:.2f}s, "
+          f"{len(found)}/{len(listening)} listeners found, {len(results['open_ports'])} open ports in total")
+    for host_scan in results["hosts"]:
+        print(f"  {host_scan['address']:<20}{len(host_scan['open_ports']):>6} open  {host_scan['error'] or ''}")
+
+    if args.legacy:
+        started_at = time.perf_counter()
+        legacy_open = await asyncio.to_thread(legacy_scan, args.host, ports)
+        elapsed = time.perf_counter() - started_at
+        print(f"legacy threads: {len(ports)} connects in {elapsed:.2f}s, "
+              f"{len(set(legacy_open) & set(listening))}/{len(listening)} listeners found")
+
+    for server in servers:
+        server.close()
+        await server.wait_closed()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
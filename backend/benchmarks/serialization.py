@@ -0,0 +1,80 @@
+"""
+Serialization time of check responses for the fixture payloads in checks/*_example*.json.
+
+    python -m benchmarks.serialization [--repeat 200]
+
+Compares FastAPI's default JSONResponse path, ORJSONResponse, a Pydantic Check
+round trip and the raw path that splices the stored results text into the response.
+"""
+import argparse
+import glob
+import json
+import os
+import timeit
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+from lib.utils import dumps_with_raw_json
+from models import Check, CheckType, CheckStatus
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def check_envelope(results: object) -> dict:
+    return {
+        "check_id": 1,
+        "check_type": CheckType.NETWORK.value,
+        "status": CheckStatus.COMPLETED.value,
+        "results": results,
+        "results_description": "summary",
+        "results_diff": None,
+        "checkup_id": 1,
+        "chat": None,
+        "queue_position": None,
+    }
+
+
+def default_json_response(results: object) -> bytes:
+    # starlette JSONResponse.render after FastAPI's jsonable_encoder
+    return json.dumps(jsonable_encoder(check_envelope(results)), ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def orjson_response(results: object) -> bytes:
+    # ORJSONResponse.render after FastAPI's jsonable_encoder
+    return orjson.dumps(jsonable_encoder(check_envelope(results)))
+
+
+def pydantic_check(results: object) -> bytes:
+    return Check.model_validate(check_envelope(results)).model_dump_json().encode()
+
+
+def raw_results(raw: str) -> bytes:
+    envelope = check_envelope(None)
+    del envelope["results"]
+    return dumps_with_raw_json(envelope, {"results": raw})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'fixture':<45}{'KB':>8}{'default':>12}{'orjson':>12}{'pydantic':>12}{'raw':>12}   (ms per response)")
+    for path in sorted(glob.glob(os.path.join(project_root, 'checks', '*_example*.json'))):
+        with open(path, "r", encoding="utf-8") as f:
+            raw = f.read()
+        results = json.loads(raw)
+
+        timings = []
+        for fn, arg in ((default_json_response, results), (orjson_response, results),
+                        (pydantic_check, results), (raw_results, raw)):
+            seconds = min(timeit.repeat(lambda: fn(arg), number=args.repeat, repeat=3)) / args.repeat
+            timings.append(seconds * 1000)
+
+        print(f"{os.path.basename(path):<45}{len(raw) / 1024:>8.1f}" + "".join(f"{t:>12.3f}" for t in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Cold import time of the API (python -X importtime), in a fresh interpreter without credentials.
+
+    python -m benchmarks.startup [--module main] [--top 25] [--repeat 3]
+
+Prints the total import time of --module and the slowest imports by cumulative time, the best of --repeat runs.
+tests/test_startup.py keeps the heavy dependencies (LAZY_MODULES) out of the import and the total under budget.
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, Tuple
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# loaded by the code that needs them (PDF route, technologies check, chat completion, GCS attachments, images)
+LAZY_MODULES = ("reportlab", "Wappalyzer", "retirejs", "bs4", "openai", "google.cloud.storage", "minio", "PIL")
+# settings that would make import time touch the network or credentials
+CREDENTIALS = ("OPENAI_API_KEY", "MXTOOLBOX_KEY", "GOOGLE_APPLICATION_CREDENTIALS", "GCS_CREDENTIALS_FILE")
+
+
+def import_times(module: str = "main") -> Dict[str, Tuple[int, int]]:
+    """module -> (self, cumulative) import time in microseconds, of one import of module in a fresh interpreter"""
+    env = {key: value for key, value in os.environ.items() if key not in CREDENTIALS}
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=project_root,
+                               env=env, capture_output=True, text=True, timeout=120)
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{completed.stderr[-4000:]}")
+    times = {}
+    for line in completed.stderr.splitlines():
+        # import time:       self [us] |  cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--top", type=int, default=25)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(args.repeat)]
+    times = min(runs, key=lambda run: run[args.module][1])
+    print(f"import {args.module}: {times[args.module][1] / 1e6:.3f}s (best of {args.repeat}), {len(times)} modules")
+    loaded = [name for name in LAZY_MODULES if name in times]
+    print(f"lazy modules imported at start-up: {', '.join(loaded) or 'none'}")
+    print(f"{'module':<60}{'self ms':>10}{'cumulative ms':>15}")
+    for name, (self_us, cumulative_us) in sorted(times.items(), key=lambda item: -item[1][1])[:args.top]:
+        print(f"{name:<60}{self_us / 1000:>10.1f}{cumulative_us / 1000:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,18 @@
 import asyncio
+import copy
+import secrets
+import time
 import urllib.parse
 from typing import List, Optional, Dict, Union
 
 import httpx
-from fastapi import APIRouter, HTTPException, Depends, status
+from fastapi import APIRouter, HTTPException, Depends, Request, status
 from pydantic import BaseModel, HttpUrl, Field
 
 from auth import verify_jwt
-from lib.utils import run_async_in_sync
+from constants import COOKIE_SCANNER_URL, COOKIE_SCANNER_CALLBACK_URL, COOKIE_SCANNER_CALLBACK_SECRET, \
+    RATE_LIMIT_CHECK_COST
+from lib.rate_limit import rate_limit
 
 
 #region Types
@@ -55,38 +60,135 @@ class CookieScannerResult(BaseModel):
 router = APIRouter()
 
 
-@router.post("/cookies")
+@router.post("/cookies", dependencies=[Depends(rate_limit("cookies_check", RATE_LIMIT_CHECK_COST))])
 async def cookies_check(request: CookiesRequest, _: dict = Depends(verify_jwt)):
     response_data = await start_cookies_check(str(request.target))
     result = CookieScannerResult(**response_data)
     return result
 
-#endregion
 
-#region Check
-def sync_start_cookies_check(url: str):
-    return run_async_in_sync(start_cookies_check, url)
+@router.post("/cookies/callback", include_in_schema=False)
+async def cookies_scanner_callback(request: Request):
+    """
+    Completion webhook of the scanner. It only wakes up the poller,
+    the result itself is always fetched from the scanner.
+    The scanner got the secret in the callback URL, anybody else could wake up pollers at will.
+    """
+    if not COOKIE_SCANNER_CALLBACK_SECRET:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Callbacks are disabled")
+    token = request.query_params.get("token") or request.headers.get("X-Callback-Token", "")
+    if not secrets.compare_digest(token.encode(), COOKIE_SCANNER_CALLBACK_SECRET.encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid callback token")
+
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = {}
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Payload must be an object")
+    identifier = payload.get("identifier") or request.query_params.get("identifier")
+    if not identifier:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Identifier is missing")
+    notify_scan_done(identifier)
+    return {"message": "ok"}
+
 
+#endregion
 
+#region Check
 async def start_cookies_check(url: str) -> Dict:
+    # The same target requested by several users shares one scan
+    key = normalize_target(url)
+    task = in_flight_scans.get(key)
+    if task is None:
+        task = asyncio.create_task(run_cookies_scan(url))
+        in_flight_scans[key] = task
+        task.add_done_callback(lambda _: in_flight_scans.pop(key, None))
+    scan_waiters[key] = scan_waiters.get(key, 0) + 1
+    try:
+        response_data = await asyncio.shield(task)
+    finally:
+        scan_waiters[key] -= 1
+        if not scan_waiters[key]:
+            del scan_waiters[key]
+            # the last check waiting for the scan was cancelled, the poll loop stops too
+            task.cancel()
+    return copy.deepcopy(response_data)
+
+
+async def run_cookies_scan(url: str) -> Dict:
+    started_at = time.monotonic()
     scan_id = await scan_cookie(url)
     response_data = await poll_cookie_scanner_result(scan_id)
+    scan_durations.observe(time.monotonic() - started_at)
     # print(response_data)
 
     # images
-    prefix = "https://rapid-shadow-93cf.davidzhai0921.workers.dev"
-    response_data["images"] = [f"{prefix}{image}" for image in response_data.get("images", [])]
+    response_data["images"] = [f"{COOKIE_SCANNER_URL}{image}" for image in response_data.get("images", [])]
 
     return response_data
 
 
-base_url = "https://rapid-shadow-93cf.davidzhai0921.workers.dev/api/scan"
+base_url = f"{COOKIE_SCANNER_URL}/api/scan"
 headers = {"accept": "application/json"}
 
+in_flight_scans: Dict[str, asyncio.Task] = {}
+scan_waiters: Dict[str, int] = {}
+scan_done_events: Dict[str, asyncio.Event] = {}
+
+
+def normalize_target(url: str) -> str:
+    parsed = urllib.parse.urlsplit(url.strip())
+    path = parsed.path.rstrip("/")
+    return f"{parsed.scheme.lower()}://{parsed.netloc.lower()}{path}?{parsed.query}"
+
+
+def notify_scan_done(identifier: str):
+    event = scan_done_events.get(identifier)
+    if event is not None:
+        event.set()
+
+
+class ScanDurations:
+    """
+    Exponentially weighted average of the observed scan durations (seconds).
+    The poller uses it to decide when the first poll makes sense.
+    """
+
+    def __init__(self, initial: float = 20.0, alpha: float = 0.3):
+        self.average = initial
+        self.alpha = alpha
+
+    def observe(self, duration: float):
+        self.average = self.alpha * duration + (1 - self.alpha) * self.average
+
+    def poll_delays(self, min_delay: float = 1.0, max_delay: float = 10.0, factor: float = 2.0):
+        """
+        First wait is half of the expected duration, then exponential backoff
+        from min_delay up to max_delay
+        """
+        yield max(min_delay, self.average / 2)
+        delay = min_delay
+        while True:
+            yield delay
+            delay = min(delay * factor, max_delay)
+
+    @property
+    def timeout(self) -> float:
+        return max(120.0, self.average * 4)
+
+
+scan_durations = ScanDurations()
+
 
 async def scan_cookie(url: str):
     target = urllib.parse.quote(url, safe="")
     full_url = f"{base_url}?target={target}&limit=1"
+    if COOKIE_SCANNER_CALLBACK_URL and COOKIE_SCANNER_CALLBACK_SECRET:
+        separator = "&" if "?" in COOKIE_SCANNER_CALLBACK_URL else "?"
+        callback_url = (f"{COOKIE_SCANNER_CALLBACK_URL}{separator}"
+                        f"token={urllib.parse.quote(COOKIE_SCANNER_CALLBACK_SECRET, safe='')}")
+        full_url += f"&callback={urllib.parse.quote(callback_url, safe='')}"
 
     async with httpx.AsyncClient() as client:
         response = await client.post(full_url, headers=headers)
@@ -98,22 +200,34 @@ async def scan_cookie(url: str):
                                 detail=response_data.get("error", "Failed to retrieve identifier"))
         return identifier
 
+
 async def poll_cookie_scanner_result(identifier: str):
     result_url = f"{base_url}/{identifier}"
+    done_event = scan_done_events.setdefault(identifier, asyncio.Event())
+    deadline = time.monotonic() + scan_durations.timeout
 
-    await asyncio.sleep(20)
-
-    for attempt in range(20):  # Up to 15 attempts
+    try:
         async with httpx.AsyncClient() as client:
-            response = await client.get(result_url, headers=headers)
-            response.raise_for_status()
-            result = response.json()
-            # print(f"\n\nattempt #{attempt + 1}: {result}")
-            if result.get("status") == "done":
-                return result
-
-        await asyncio.sleep(5) # seconds
+            for delay in scan_durations.poll_delays():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # the scanner callback interrupts the wait
+                try:
+                    await asyncio.wait_for(done_event.wait(), timeout=min(delay, remaining))
+                except asyncio.TimeoutError:
+                    pass
+                done_event.clear()
+
+                response = await client.get(result_url, headers=headers)
+                response.raise_for_status()
+                result = response.json()
+                # print(f"\n\npoll: {result}")
+                if result.get("status") == "done":
+                    return result
+    finally:
+        scan_done_events.pop(identifier, None)
 
     raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                         detail="Timeout while polling scanner result")
-#endregion
\ No newline at end of file
+#endregion
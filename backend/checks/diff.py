@@ -0,0 +1,140 @@
+from typing import Dict, Iterable, List
+
+from models import CheckType
+
+
+# region Helpers
+def set_diff(previous: Iterable, current: Iterable) -> Dict[str, List]:
+    previous, current = set(previous), set(current)
+    return {"added": sorted(current - previous), "removed": sorted(previous - current)}
+
+
+def has_changes(diff) -> bool:
+    if isinstance(diff, dict):
+        return any(has_changes(value) for value in diff.values())
+    if isinstance(diff, list):
+        return len(diff) > 0
+    return diff is not None
+
+
+# endregion
+
+# region Per check type
+def diff_scan_ports(previous: dict, current: dict) -> dict:
+    ports = set_diff(previous.get("open_ports", []), current.get("open_ports", []))
+    return {"opened_ports": ports["added"], "closed_ports": ports["removed"]}
+
+
+def diff_lighthouse(previous: dict, current: dict) -> dict:
+    previous_audits, current_audits = previous.get("audits", {}), current.get("audits", {})
+    changed = [
+        {
+            "id": key,
+            "title": audit.get("title", key),
+            "previous_score": previous_audits[key].get("score"),
+            "score": audit.get("score"),
+        }
+        for key, audit in current_audits.items()
+        if key in previous_audits and previous_audits[key].get("score") != audit.get("score")
+    ]
+    audits = set_diff(previous_audits, current_audits)
+    return {"changed_audits": changed, "new_audits": audits["added"], "removed_audits": audits["removed"]}
+
+
+def vulnerability_ids(retire_analysis: list) -> set:
+    """'component@version: CVE-..' for every finding of retire.js, over all scripts"""
+    found = set()
+    for scanned in retire_analysis or []:
+        for findings in scanned.values():
+            for finding in findings or []:
+                component = f"{finding.get('component')}@{finding.get('version')}"
+                for vulnerability in finding.get("vulnerabilities", []):
+                    identifiers = vulnerability.get("identifiers", {})
+                    name = (identifiers.get("CVE") or [identifiers.get("summary") or vulnerability.get("severity")])[0]
+                    found.add(f"{component}: {name}")
+    return found
+
+
+def diff_technologies(previous: dict, current: dict) -> dict:
+    previous_technologies, current_technologies = previous.get("technologies", {}), current.get("technologies", {})
+    technologies = set_diff(previous_technologies, current_technologies)
+    changed_versions = [
+        {"name": name, "previous_versions": previous_technologies[name].get("versions", []),
+         "versions": info.get("versions", [])}
+        for name, info in current_technologies.items()
+        if name in previous_technologies and previous_technologies[name].get("versions") != info.get("versions")
+    ]
+    vulnerabilities = set_diff(vulnerability_ids(previous.get("retire_analysis")),
+                               vulnerability_ids(current.get("retire_analysis")))
+    return {
+        "new_technologies": technologies["added"],
+        "removed_technologies": technologies["removed"],
+        "changed_versions": changed_versions,
+        "new_vulnerabilities": vulnerabilities["added"],
+        "fixed_vulnerabilities": vulnerabilities["removed"],
+    }
+
+
+def network_items(results: dict, category: str) -> set:
+    """'check: item' names of one MXToolbox category (Failed, Warnings, ...) over all lookups"""
+    return {
+        f"{check_name}: {item.get('Name', '')}"
+        for check_name, check_result in results.get("results", {}).items()
+        for item in (check_result.get("data") or {}).get(category, [])
+    }
+
+
+def diff_network(previous: dict, current: dict) -> dict:
+    failed = set_diff(network_items(previous, "Failed"), network_items(current, "Failed"))
+    warnings = set_diff(network_items(previous, "Warnings"), network_items(current, "Warnings"))
+    return {
+        "new_failures": failed["added"],
+        "resolved_failures": failed["removed"],
+        "new_warnings": warnings["added"],
+        "resolved_warnings": warnings["removed"],
+    }
+
+
+def cookie_providers(results: dict) -> set:
+    """The scanner sends the providers by category, or as a list of providers with their category"""
+    providers = results.get("provider") or {}
+    if isinstance(providers, dict):
+        by_category = providers.items()
+    else:
+        by_category = [(provider.get("category", ""), provider) for provider in providers if isinstance(provider, dict)]
+    return {
+        f"{category}: {url.get('url', '') if isinstance(url, dict) else url}"
+        for category, provider in by_category
+        for url in provider.get("urls", [])
+    }
+
+
+def diff_cookie(previous: dict, current: dict) -> dict:
+    providers = set_diff(cookie_providers(previous), cookie_providers(current))
+    gdpr_changed = previous.get("gdpr_compliant") != current.get("gdpr_compliant")
+    return {
+        "gdpr_compliant": {"previous": previous.get("gdpr_compliant"), "current": current.get("gdpr_compliant")}
+        if gdpr_changed else None,
+        "new_providers": providers["added"],
+        "removed_providers": providers["removed"],
+    }
+
+
+# endregion
+
+differs = {
+    CheckType.SCAN_PORTS: diff_scan_ports,
+    CheckType.LIGHTHOUSE: diff_lighthouse,
+    CheckType.TECHNOLOGIES: diff_technologies,
+    CheckType.NETWORK: diff_network,
+    CheckType.COOKIE: diff_cookie,
+}
+
+
+def diff_check_results(check_type: CheckType, previous: dict, current: dict) -> dict:
+    """
+    Structured diff of two results of the same check type.
+    "changed" is False when nothing relevant for the summary differs.
+    """
+    changes = differs[check_type](previous or {}, current or {})
+    return {"changed": has_changes(changes), "changes": changes}
@@ -0,0 +1,288 @@
+import asyncio
+import re
+import socket
+import ssl
+import time
+import warnings
+from datetime import datetime, timezone
+from functools import cache
+from typing import Dict, List, Optional, Tuple
+
+from constants import FINGERPRINT_CONNECTIONS, FINGERPRINT_TIMEOUT, FINGERPRINT_CACHE_TTL, \
+    FINGERPRINT_CACHE_MAX_ENTRIES
+
+try:
+    from cryptography import x509
+except ImportError:  # expiry of untrusted certificates stays unknown
+    x509 = None
+
+# Service detection on open ports: banner read, TLS handshake inspection and one HTTP probe.
+# Every probe holds a socket of the shared budget and has a tight timeout.
+
+#region Types
+BANNER_PATTERNS = [
+    ("ssh", re.compile(rb"^SSH-")),
+    ("smtp", re.compile(rb"^220[ -].*(smtp|mail)", re.I)),
+    ("ftp", re.compile(rb"^220[ -]")),
+    ("pop3", re.compile(rb"^\+OK")),
+    ("imap", re.compile(rb"^\* OK")),
+    ("vnc", re.compile(rb"^RFB \d")),
+    ("telnet", re.compile(rb"^\xff[\xfb-\xfe]")),
+    ("mysql", re.compile(rb"^.{4}\x0a\d", re.S)),
+]
+# answers to the HTTP probe
+RESPONSE_PATTERNS = [
+    ("http", re.compile(rb"^HTTP/\d")),
+    ("redis", re.compile(rb"^(-ERR|-NOAUTH|\+PONG)")),
+]
+# unencrypted services that shouldn't face the internet
+EXPOSED_SERVICES = {"telnet", "ftp", "mysql", "postgresql", "redis", "mongodb", "vnc", "memcache", "docker"}
+# plaintext at first, encryption via STARTTLS isn't checked
+STARTTLS_SERVICES = {"smtp", "pop3", "imap", "submission"}
+LEGACY_TLS_VERSIONS = {"SSLv3", "TLSv1", "TLSv1.1"}
+EXPIRY_WARNING_DAYS = 14
+
+#endregion
+
+#region Check
+# sockets of all fingerprinting probes together
+socket_budget = asyncio.Semaphore(FINGERPRINT_CONNECTIONS)
+# (address, port, hostname) -> (expires at, service info), SNI and Host make the answer depend on the hostname
+fingerprint_cache: Dict[Tuple[str, int, str], Tuple[float, dict]] = {}
+
+
+async def fingerprint_ports(address: str, ports: List[int], hostname: str) -> List[dict]:
+    return list(await asyncio.gather(*[fingerprint_port(address, port, hostname) for port in ports]))
+
+
+async def fingerprint_port(address: str, port: int, hostname: str) -> dict:
+    cached = fingerprint_cache.get((address, port, hostname))
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    try:
+        # probes of a port are sequential, a budget slot is one open socket
+        async with socket_budget:
+            info = await inspect_port(address, port, hostname)
+    except (OSError, asyncio.TimeoutError) as e:
+        info = {"address": address, "port": port, "service": guess_service(port), "product": None, "banner": None,
+                "tls": None, "error": str(e) or type(e).__name__}
+    info["secure"], info["assessment"] = assess(info)
+
+    cache_fingerprint((address, port, hostname), info)
+    return info
+
+
+def cache_fingerprint(key: Tuple[str, int, str], info: dict):
+    now = time.monotonic()
+    fingerprint_cache.pop(key, None)
+    if len(fingerprint_cache) >= FINGERPRINT_CACHE_MAX_ENTRIES:
+        for expired in [key for key, (expires_at, _) in fingerprint_cache.items() if expires_at <= now]:
+            del fingerprint_cache[expired]
+    while fingerprint_cache and len(fingerprint_cache) >= FINGERPRINT_CACHE_MAX_ENTRIES:
+        # the oldest entry
+        del fingerprint_cache[next(iter(fingerprint_cache))]
+    fingerprint_cache[key] = (now + FINGERPRINT_CACHE_TTL, info)
+
+
+async def inspect_port(address: str, port: int, hostname: str) -> dict:
+    info = {"address": address, "port": port, "service": None, "product": None, "banner": None, "tls": None,
+            "error": None}
+
+    # services that talk first
+    banner = await read_banner(address, port)
+    if banner:
+        info["service"] = classify(banner, BANNER_PATTERNS)
+        info["banner"] = printable(banner)
+        info["product"] = info["banner"].splitlines()[0] if info["banner"] else None
+        return with_guessed_service(info)
+
+    # services that wait for the client: TLS first, then a request on top of it or in plaintext
+    info["tls"] = await inspect_tls(address, port, hostname)
+    response = await probe_request(address, port, hostname, use_tls=info["tls"] is not None)
+    if response:
+        info["service"] = classify(response, RESPONSE_PATTERNS)
+        info["banner"] = printable(response)
+        if info["service"] == "http":
+            info["product"] = http_header(response, b"server")
+            if info["tls"] is not None:
+                info["service"] = "https"
+            elif (http_header(response, b"location") or "").startswith("https://"):
+                info["redirects_to_https"] = True
+    return with_guessed_service(info)
+
+
+async def open_connection(address: str, port: int, context: ssl.SSLContext | None = None,
+                          hostname: str | None = None):
+    return await asyncio.wait_for(
+        asyncio.open_connection(address, port, ssl=context, server_hostname=hostname if context else None),
+        FINGERPRINT_TIMEOUT)
+
+
+async def read_banner(address: str, port: int) -> bytes:
+    reader, writer = await open_connection(address, port)
+    try:
+        return await asyncio.wait_for(reader.read(1024), FINGERPRINT_TIMEOUT / 2)
+    except asyncio.TimeoutError:
+        return b""
+    finally:
+        writer.close()
+
+
+async def probe_request(address: str, port: int, hostname: str, use_tls: bool) -> bytes:
+    try:
+        reader, writer = await open_connection(address, port, unverified_context() if use_tls else None, hostname)
+    except (OSError, ssl.SSLError, asyncio.TimeoutError):
+        return b""
+    try:
+        writer.write(f"HEAD / HTTP/1.0\r\nHost: {hostname}\r\nUser-Agent: planspiegel\r\n\r\n".encode())
+        await writer.drain()
+        return await asyncio.wait_for(reader.read(2048), FINGERPRINT_TIMEOUT)
+    except (OSError, ssl.SSLError, asyncio.TimeoutError):
+        return b""
+    finally:
+        writer.close()
+
+
+@cache
+def verified_context() -> ssl.SSLContext:
+    """Loads the system CA bundle once instead of for every probed port"""
+    return ssl.create_default_context()
+
+
+@cache
+def unverified_context(maximum_version: ssl.TLSVersion | None = None) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    if maximum_version is not None:
+        # legacy protocols are only offered with the lowest security level
+        with warnings.catch_warnings():
+            # deprecated on purpose, they are what the probe looks for
+            warnings.simplefilter("ignore", DeprecationWarning)
+            context.minimum_version = ssl.TLSVersion.MINIMUM_SUPPORTED
+            context.maximum_version = maximum_version
+        context.set_ciphers("DEFAULT:@SECLEVEL=0")
+    return context
+
+
+async def handshake(address: str, port: int, hostname: str, context: ssl.SSLContext) -> dict:
+    _, writer = await open_connection(address, port, context, hostname)
+    try:
+        ssl_object = writer.get_extra_info("ssl_object")
+        return {
+            "version": ssl_object.version(),
+            "cipher": ssl_object.cipher()[0],
+            "cert": ssl_object.getpeercert(),
+            "cert_der": ssl_object.getpeercert(binary_form=True),
+        }
+    finally:
+        writer.close()
+
+
+async def inspect_tls(address: str, port: int, hostname: str) -> Optional[dict]:
+    """Negotiated version and cipher, certificate trust and expiry, legacy protocol support. None if no TLS."""
+    verify_error = None
+    try:
+        session = await handshake(address, port, hostname, verified_context())
+    except ssl.SSLCertVerificationError as e:
+        verify_error = e.verify_message or str(e)
+        try:
+            session = await handshake(address, port, hostname, unverified_context())
+        except (OSError, ssl.SSLError, asyncio.TimeoutError):
+            return None
+    except (OSError, ssl.SSLError, asyncio.TimeoutError):
+        return None
+
+    tls = {"version": session["version"], "cipher": session["cipher"], "trusted": verify_error is None,
+           "verify_error": verify_error, "subject": None, "issuer": None, "expires_at": None, "days_left": None,
+           "legacy_versions": []}
+    tls.update(certificate_details(session["cert"], session["cert_der"]))
+
+    if session["version"] not in LEGACY_TLS_VERSIONS:
+        try:
+            legacy = await handshake(address, port, hostname, unverified_context(ssl.TLSVersion.TLSv1_1))
+            tls["legacy_versions"] = [legacy["version"]]
+        except (OSError, ssl.SSLError, asyncio.TimeoutError, ValueError):
+            pass
+    else:
+        tls["legacy_versions"] = [session["version"]]
+    return tls
+
+
+def certificate_details(cert: dict, cert_der: bytes | None) -> dict:
+    if cert:
+        expires_at = datetime.fromtimestamp(ssl.cert_time_to_seconds(cert["notAfter"]), tz=timezone.utc)
+        subject = dict(item for rdn in cert.get("subject", ()) for item in rdn).get("commonName")
+        issuer = dict(item for rdn in cert.get("issuer", ()) for item in rdn).get("commonName")
+    elif cert_der and x509 is not None:
+        # not verified, ssl only parses verified certificates
+        certificate = x509.load_der_x509_certificate(cert_der)
+        expires_at = certificate.not_valid_after_utc
+        subject = certificate.subject.rfc4514_string()
+        issuer = certificate.issuer.rfc4514_string()
+    else:
+        return {}
+
+    return {"subject": subject, "issuer": issuer, "expires_at": expires_at.isoformat(),
+            "days_left": (expires_at - datetime.now(timezone.utc)).days}
+
+
+def classify(data: bytes, patterns) -> Optional[str]:
+    return next((service for service, pattern in patterns if pattern.search(data)), None)
+
+
+def guess_service(port: int) -> Optional[str]:
+    try:
+        return socket.getservbyport(port, "tcp")
+    except OSError:
+        return None
+
+
+def with_guessed_service(info: dict) -> dict:
+    if info["service"] is None:
+        info["service"] = guess_service(info["port"])
+        info["service_guessed"] = info["service"] is not None
+    return info
+
+
+def printable(data: bytes, limit: int = 200) -> str:
+    return data[:limit].decode("utf-8", errors="replace").strip()
+
+
+def http_header(response: bytes, name: bytes) -> Optional[str]:
+    for line in response.split(b"\r\n")[1:]:
+        key, _, value = line.partition(b":")
+        if key.strip().lower() == name:
+            return printable(value)
+    return None
+
+
+def assess(info: dict) -> Tuple[Optional[bool], str]:
+    """(secure, reason), secure is None if it can't be told from the outside"""
+    tls, service = info["tls"], info["service"]
+    if tls is not None:
+        if not tls["trusted"]:
+            return False, f"Untrusted certificate: {tls['verify_error']}"
+        if tls["days_left"] is not None and tls["days_left"] < 0:
+            return False, "Certificate expired"
+        if tls["legacy_versions"]:
+            return False, f"Accepts legacy {', '.join(tls['legacy_versions'])}"
+        if tls["days_left"] is not None and tls["days_left"] < EXPIRY_WARNING_DAYS:
+            return True, f"{tls['version']}, certificate expires in {tls['days_left']} days"
+        return True, f"{tls['version']} with a trusted certificate"
+    if service == "ssh":
+        return True, "Encrypted (SSH)"
+    if service == "http":
+        if info.get("redirects_to_https"):
+            return True, "Redirects to HTTPS"
+        return False, "Plain HTTP without redirect to HTTPS"
+    if service in EXPOSED_SERVICES:
+        return False, f"{service} reachable from the internet without encryption"
+    if service in STARTTLS_SERVICES:
+        return None, f"{service} in plaintext, STARTTLS not checked"
+    if info.get("error"):
+        return None, f"No answer: {info['error']}"
+    return None, "Unknown service"
+
+#endregion
@@ -8,7 +8,9 @@ from fastapi import APIRouter, HTTPException, Depends, status
 from pydantic import BaseModel, HttpUrl, Field
 
 from auth import verify_jwt
-from lib.utils import is_running_in_docker, run_async_in_sync
+from constants import RATE_LIMIT_CHECK_COST
+from lib.rate_limit import rate_limit
+from lib.utils import is_running_in_docker, communicate_or_kill
 
 
 #region Types
@@ -22,7 +24,7 @@ class LighthouseRequest(BaseModel):
 router = APIRouter()
 
 
-@router.post("/lighthouse")
+@router.post("/lighthouse", dependencies=[Depends(rate_limit("lighthouse_check", RATE_LIMIT_CHECK_COST))])
 async def lighthouse_check(request: LighthouseRequest, _: dict = Depends(verify_jwt)) -> Dict:
     return await get_lighthouse_report(str(request.target))
 
@@ -30,10 +32,6 @@ async def lighthouse_check(request: LighthouseRequest, _: dict = Depends(verify_
 #endregion
 
 #region Check
-def sync_get_lighthouse_report(url: str):
-    return run_async_in_sync(get_lighthouse_report, url)
-
-
 async def get_lighthouse_report(url: str) -> Dict:
     domain = url.split("//")[-1].split("/")[0]
     report_name = f"report_{domain}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
@@ -54,13 +52,15 @@ async def get_lighthouse_report(url: str) -> Dict:
         command = (f"{base_flags}"
                    f"{flags}")
 
+        # bash, node and chrome share a new session, a cancelled check kills all of them
         process = await asyncio.create_subprocess_exec(
             'bash', '-c', command,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True
         )
 
-        stdout, stderr = await process.communicate()
+        stdout, stderr = await communicate_or_kill(process)
 
         if process.returncode != 0:
             raise Exception(stderr.decode())
@@ -2,16 +2,19 @@ import asyncio
 import json
 import os
 from datetime import datetime
+from functools import cached_property
 from typing import Dict
 
 import httpx
+import orjson
 from fastapi import APIRouter, HTTPException, status, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response
 from pydantic import BaseModel, HttpUrl, Field
 
 from auth import verify_jwt
-from constants import MXTOOLBOX_KEY
-from lib.utils import extract_hostname, run_async_in_sync
+from constants import MXTOOLBOX_KEY, MXTOOLBOX_URL, MXTOOLBOX_MOCK, RATE_LIMIT_CHECK_COST
+from lib.rate_limit import rate_limit
+from lib.utils import extract_hostname
 
 
 #region Types
@@ -81,18 +84,27 @@ def filter_network_report_for_summary(report: dict) -> dict:
 
 
 class MXToolboxClient:
-    def __init__(self, api_key: str):
-        self.base_url = "https://api.mxtoolbox.com/api/v1"
+    def __init__(self, api_key: str, base_url: str = MXTOOLBOX_URL):
+        self.base_url = base_url
         self.headers = {
             "Authorization": api_key,
             "Content-Type": "application/json"
         }
+
+    @cached_property
+    def results(self) -> Dict:
+        # the fixture of the mock, read on the first mocked lookup
         current_file_path = os.path.abspath(__file__)
         current_dir = os.path.dirname(current_file_path)
         project_root = os.path.abspath(os.path.join(current_dir, '..'))
         file_path = os.path.join(project_root, 'checks', 'network_check_example.json')
         with open(file_path, "r", encoding="utf-8") as f:
-            self.results = json.load(f)
+            return json.load(f)
+
+    @cached_property
+    def results_json(self) -> bytes:
+        # serialized once, the route sends these bytes as they are
+        return orjson.dumps(self.results)
 
     async def lookup(self, command: str, target: str) -> Dict:
         hostname = extract_hostname(target)
@@ -131,12 +143,24 @@ class MXToolboxClient:
         await asyncio.sleep(10)
         return self.results
 
+    async def mock_parallel_lookup_json(self, target: str) -> bytes:
+        await self.mock_parallel_lookup(target)
+        return self.results_json
+
+    async def parallel_lookup_json(self, target: str) -> bytes:
+        if MXTOOLBOX_MOCK:
+            return await self.mock_parallel_lookup_json(target)
+        return orjson.dumps(await self.parallel_lookup(target))
+
 
 mxtoolbox = MXToolboxClient(api_key=MXTOOLBOX_KEY)
 
 
-def sync_start_network_check(url: str):
-    return run_async_in_sync(mxtoolbox.mock_parallel_lookup, url)
+async def start_network_check(url: str) -> Dict:
+    # lookups on the shared loop, a cancelled check closes their connections
+    if MXTOOLBOX_MOCK:
+        return await mxtoolbox.mock_parallel_lookup(url)
+    return await mxtoolbox.parallel_lookup(url)
 
 
 #endregion
@@ -145,7 +169,7 @@ def sync_start_network_check(url: str):
 router = APIRouter()
 
 
-@router.post("/network")
+@router.post("/network", dependencies=[Depends(rate_limit("network_check", RATE_LIMIT_CHECK_COST))])
 async def network_check(request: NetworkRequest, _: dict = Depends(verify_jwt)):
     target = str(request.target)
 
@@ -153,8 +177,8 @@ async def network_check(request: NetworkRequest, _: dict = Depends(verify_jwt)):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Target is required")
 
     try:
-        results = await mxtoolbox.mock_parallel_lookup(target)
-        return JSONResponse(content=results)
+        results_json = await mxtoolbox.parallel_lookup_json(target)
+        return Response(content=results_json, media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 #endregion
\ No newline at end of file
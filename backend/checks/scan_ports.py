@@ -1,19 +1,85 @@
+import asyncio
+import errno
+import math
+import os
 import socket
-from concurrent.futures import ThreadPoolExecutor
+import time
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from pydantic import BaseModel, HttpUrl, Field
 
-from auth import verify_jwt
+from auth import verify_jwt, TokenDataFulfilled
+from checks.fingerprint import fingerprint_ports
+from constants import PORT_SCAN_PROFILE, PORT_SCAN_CONNECTIONS, PORT_SCAN_TIMEOUT, PORT_SCAN_MAX_OPEN_PER_HOST, \
+    DNS_CACHE_TTL, DNS_CACHE_MAX_ENTRIES, FINGERPRINT_ENABLED, RATE_LIMIT_CHECK_COST, PORT_SCAN_PORTS_PER_COST
+from lib.rate_limit import charge_user
 
 
 #region Types
+class PortProfile(str, Enum):
+    TOP_100 = "top-100"
+    TOP_1000 = "top-1000"
+    FULL = "full"
+    CUSTOM = "custom"
+
+
 class ScanPortsRequest(BaseModel):
     target: HttpUrl = Field(default="https://planspiegel-landing.vercel.app/")
+    profile: PortProfile = Field(default=PortProfile(PORT_SCAN_PROFILE))
+    # only for the custom profile, e.g. "22,80,8000-8100"
+    ports: Optional[str] = None
+    # detect the services behind the open ports
+    fingerprint: bool = FINGERPRINT_ENABLED
+
+
+class TlsInfo(BaseModel):
+    version: Optional[str] = None
+    cipher: Optional[str] = None
+    trusted: bool
+    verify_error: Optional[str] = None
+    subject: Optional[str] = None
+    issuer: Optional[str] = None
+    expires_at: Optional[str] = None
+    days_left: Optional[int] = None
+    # legacy protocols the port still accepts, e.g. TLSv1.1
+    legacy_versions: list[str] = []
+
+
+class ServiceInfo(BaseModel):
+    address: str
+    port: int
+    service: Optional[str] = None
+    # from the IANA port registry, nothing answered that could be recognized
+    service_guessed: bool = False
+    product: Optional[str] = None
+    banner: Optional[str] = None
+    tls: Optional[TlsInfo] = None
+    redirects_to_https: bool = False
+    # None if it can't be told from the outside
+    secure: Optional[bool] = None
+    assessment: str = ""
+    error: Optional[str] = None
+
+
+class HostScan(BaseModel):
+    address: str
+    family: str
+    open_ports: list[int]
+    # stopped after PORT_SCAN_MAX_OPEN_PER_HOST open ports, e.g. a firewall that accepts everything
+    truncated: bool = False
+    error: Optional[str] = None
+    services: list[ServiceInfo] = []
 
 
 class ScanPortsResponse(BaseModel):
+    # open on any address of the host
     open_ports: list[int]
+    profile: Optional[PortProfile] = None
+    hosts: list[HostScan] = []
+    # a service per open port, from the first address it is open on
+    services: list[ServiceInfo] = []
 
 
 #endregion
@@ -22,36 +88,216 @@ class ScanPortsResponse(BaseModel):
 router = APIRouter()
 
 
-@router.post("/scan_ports", response_model=ScanPortsResponse)
-def port_check(request: ScanPortsRequest, _: dict = Depends(verify_jwt)):
-    results = start_check_ports(request.target.host)
-    return ScanPortsResponse(open_ports=results["open_ports"])
+@router.post("/scan_ports", response_model=ScanPortsResponse,
+             description="costs more of the rate limit the more ports are scanned")
+async def port_check(request: ScanPortsRequest, http_request: Request, user: TokenDataFulfilled = Depends(verify_jwt)):
+    try:
+        ports = ports_for_profile(request.profile, request.ports)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    # a full scan is 60 times the connections of the default profile
+    await charge_user(http_request, "port_check", user.sub,
+                      RATE_LIMIT_CHECK_COST * math.ceil(len(ports) / PORT_SCAN_PORTS_PER_COST))
+    return await scan_host(request.target.host, ports, request.profile, request.fingerprint)
 
 
-def start_check_ports(host: str) -> dict:
-    return {"open_ports": get_open_ports(host, port_range=(1, 1024), max_workers=1024)}
+async def start_check_ports(host: str, profile: PortProfile = PortProfile(PORT_SCAN_PROFILE),
+                            fingerprint: bool = FINGERPRINT_ENABLED) -> dict:
+    return await scan_host(host, ports_for_profile(profile), profile, fingerprint)
+
+#endregion
+
+#region Port profiles
+# nmap's most frequent TCP ports
+TOP_100_PORTS = [
+    7, 9, 13, 21, 22, 23, 25, 26, 37, 53, 79, 80, 81, 88, 106, 110, 111, 113, 119, 135, 139, 143, 144, 179, 199, 389,
+    427, 443, 444, 445, 465, 513, 514, 515, 543, 544, 548, 554, 587, 631, 646, 873, 990, 993, 995, 1025, 1026, 1027,
+    1028, 1029, 1110, 1433, 1720, 1723, 1755, 1900, 2000, 2001, 2049, 2121, 2717, 3000, 3128, 3306, 3389, 3986, 4899,
+    5000, 5009, 5051, 5060, 5101, 5190, 5357, 5432, 5631, 5666, 5800, 5900, 6000, 6001, 6646, 7070, 8000, 8008, 8009,
+    8080, 8081, 8443, 8888, 9100, 9999, 10000, 32768, 49152, 49153, 49154, 49155, 49156, 49157,
+]
+# service ports above the well-known range: admin panels, databases, brokers, container APIs
+COMMON_HIGH_PORTS = [
+    1080, 1194, 1521, 1883, 2082, 2083, 2086, 2087, 2095, 2096, 2375, 2376, 2379, 2380, 3001, 3268, 3269, 4000, 4443,
+    4444, 4848, 5001, 5044, 5222, 5269, 5353, 5601, 5672, 5984, 5985, 5986, 6379, 6443, 6666, 6667, 7000, 7001, 7443,
+    7474, 8001, 8002, 8082, 8083, 8088, 8089, 8090, 8161, 8180, 8200, 8300, 8333, 8500, 8530, 8531, 8761, 8834, 8880,
+    8883, 9000, 9001, 9042, 9043, 9060, 9080, 9090, 9091, 9092, 9200, 9300, 9418, 9443, 10250, 11211, 15672, 25565,
+    27017, 27018, 28017, 50000, 50070,
+]
+
+
+def parse_port_spec(spec: str) -> List[int]:
+    """"22,80,8000-8100" -> sorted ports"""
+    ports = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        if not start.isdigit() or (end and not end.isdigit()):
+            raise ValueError(f"Invalid port range: {part}")
+        start, end = int(start), int(end or start)
+        if not 1 <= start <= end <= 65535:
+            raise ValueError(f"Ports must be in 1-65535: {part}")
+        ports.update(range(start, end + 1))
+    if not ports:
+        raise ValueError("No ports to scan")
+    return sorted(ports)
+
+
+def ports_for_profile(profile: PortProfile, spec: str | None = None) -> List[int]:
+    match profile:
+        case PortProfile.TOP_100:
+            return TOP_100_PORTS
+        case PortProfile.TOP_1000:
+            # all well-known ports plus the frequent ones above them, about 1100 ports
+            return sorted(set(range(1, 1025)) | set(TOP_100_PORTS) | set(COMMON_HIGH_PORTS))
+        case PortProfile.FULL:
+            return list(range(1, 65536))
+        case PortProfile.CUSTOM:
+            return parse_port_spec(spec or "")
+    raise ValueError(f"Unknown port profile: {profile}")
 
 #endregion
 
 #region Check
-def check_port(target: str, port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.settimeout(0.5)
-        result = s.connect_ex((target, port))
-        if result == 0:
-            return port
-    # print(f" port {port} checked ")
-    return None
-
-
-def get_open_ports(target: str, port_range=(1, 1024), max_workers=50):
-    open_ports = []
-    ip_address = socket.gethostbyname(target)
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(check_port, ip_address, port) for port in range(port_range[0], port_range[1] + 1)]
-        for future in futures:
-            port = future.result()
-            if port:
-                open_ports.append(port)
-    return open_ports
+# connections of all running scans together, so parallel checks don't exhaust file descriptors
+connection_budget = asyncio.Semaphore(PORT_SCAN_CONNECTIONS)
+# host -> (expires at, addresses), at most DNS_CACHE_MAX_ENTRIES in the order they were resolved
+dns_cache: Dict[str, Tuple[float, List[Tuple[socket.AddressFamily, str]]]] = {}
+
+UNREACHABLE_ERRNOS = {errno.ENETUNREACH, errno.EHOSTUNREACH, errno.EADDRNOTAVAIL, errno.EAFNOSUPPORT}
+
+
+class HostUnreachable(Exception):
+    pass
+
+
+async def resolve_host(host: str) -> List[Tuple[socket.AddressFamily, str]]:
+    """All IPv4 and IPv6 addresses of the host, without blocking the loop"""
+    cached = dns_cache.get(host)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    addresses = list(dict.fromkeys((family, sockaddr[0]) for family, _, _, _, sockaddr in infos))
+    cache_addresses(host, addresses)
+    return addresses
+
+
+def cache_addresses(host: str, addresses: List[Tuple[socket.AddressFamily, str]]):
+    now = time.monotonic()
+    dns_cache.pop(host, None)
+    if len(dns_cache) >= DNS_CACHE_MAX_ENTRIES:
+        for expired in [key for key, (expires_at, _) in dns_cache.items() if expires_at <= now]:
+            del dns_cache[expired]
+    while dns_cache and len(dns_cache) >= DNS_CACHE_MAX_ENTRIES:
+        # the oldest entry
+        del dns_cache[next(iter(dns_cache))]
+    dns_cache[host] = (now + DNS_CACHE_TTL, addresses)
+
+
+def raise_if_unreachable(code: int):
+    if code in UNREACHABLE_ERRNOS:
+        raise HostUnreachable(os.strerror(code))
+
+
+async def probe_port(family: socket.AddressFamily, address: str, port: int, timeout: float) -> bool:
+    """
+    Non-blocking connect. Refused ports answer at once (mostly on the same host or a LAN),
+    so the loop only waits for the ports that don't answer right away.
+    """
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        code = sock.connect_ex((address, port))
+        if code == 0:
+            return True
+        if code != errno.EINPROGRESS:
+            raise_if_unreachable(code)
+            return False
+
+        loop = asyncio.get_running_loop()
+        writable = loop.create_future()
+        loop.add_writer(sock.fileno(), lambda: writable.done() or writable.set_result(None))
+        try:
+            async with asyncio.timeout(timeout):
+                await writable
+        except TimeoutError:
+            return False
+        finally:
+            loop.remove_writer(sock.fileno())
+
+        code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        raise_if_unreachable(code)
+        return code == 0
+    finally:
+        sock.close()
+
+
+async def scan_address(family: socket.AddressFamily, address: str, ports: List[int]) -> HostScan:
+    result = HostScan(address=address, family="ipv6" if family == socket.AF_INET6 else "ipv4", open_ports=[])
+    pending = iter(ports)
+    stop = asyncio.Event()
+
+    async def worker():
+        for port in pending:
+            if stop.is_set():
+                return
+            async with connection_budget:
+                try:
+                    is_open = await probe_port(family, address, port, PORT_SCAN_TIMEOUT)
+                except HostUnreachable as e:
+                    result.error = str(e)
+                    stop.set()
+                    return
+                except OSError as e:
+                    # e.g. out of file descriptors (EMFILE), the scan of the address is incomplete
+                    result.error = f"Scan stopped: {e}"
+                    stop.set()
+                    return
+            if is_open and not stop.is_set():
+                result.open_ports.append(port)
+                if len(result.open_ports) >= PORT_SCAN_MAX_OPEN_PER_HOST:
+                    result.truncated = True
+                    stop.set()
+
+    await asyncio.gather(*[worker() for _ in range(min(PORT_SCAN_CONNECTIONS, len(ports)))])
+    result.open_ports.sort()
+    return result
+
+
+async def fingerprint_host_scan(host_scan: HostScan, hostname: str):
+    # a firewall that accepts everything has no services to tell apart
+    if host_scan.open_ports and not host_scan.truncated and host_scan.error is None:
+        infos = await fingerprint_ports(host_scan.address, host_scan.open_ports, hostname)
+        host_scan.services = [ServiceInfo.model_validate(info) for info in infos]
+
+
+async def scan_host(host: str, ports: List[int], profile: PortProfile | None = None,
+                    fingerprint: bool = False) -> dict:
+    """
+    Scans the ports on every address of the host, all addresses share the connection budget.
+    With fingerprint, the open ports of every address are probed for their service afterwards.
+    """
+    try:
+        addresses = await resolve_host(host)
+    except socket.gaierror as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Can't resolve {host}: {e}")
+
+    hosts = await asyncio.gather(*[scan_address(family, address, ports) for family, address in addresses])
+    if fingerprint:
+        await asyncio.gather(*[fingerprint_host_scan(host_scan, host) for host_scan in hosts])
+
+    services = {}
+    for host_scan in hosts:
+        for service in host_scan.services:
+            services.setdefault(service.port, service)
+    return ScanPortsResponse(
+        open_ports=sorted({port for host_scan in hosts for port in host_scan.open_ports}),
+        profile=profile,
+        hosts=hosts,
+        services=sorted(services.values(), key=lambda service: service.port),
+    ).model_dump(mode="json")
+
 #endregion
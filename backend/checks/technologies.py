@@ -1,13 +1,13 @@
+import threading
 import warnings
+from functools import cache
 
-import requests
-import retirejs
-import urllib3
-from Wappalyzer import Wappalyzer, WebPage
-from bs4 import BeautifulSoup
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from pydantic import BaseModel, HttpUrl, Field
 
+from constants import RATE_LIMIT_CHECK_COST
+from lib.cancellation import CheckCancelled
+from lib.rate_limit import rate_limit_anonymous
 from lib.utils import fix_script_urls, get_base_url, run_async_in_sync
 
 
@@ -22,7 +22,9 @@ class TechnologiesRequest(BaseModel):
 router = APIRouter()
 
 
-@router.post("/technologies")
+# the only check without a login, limited per client address
+@router.post("/technologies",
+             dependencies=[Depends(rate_limit_anonymous("technologies_check", RATE_LIMIT_CHECK_COST))])
 async def technologies_check(request: TechnologiesRequest):
     return await start_technologies_check(str(request.target))
 
@@ -31,11 +33,20 @@ async def technologies_check(request: TechnologiesRequest):
 
 # region Check
 
-def sync_start_technologies_check(url: str):
-    return run_async_in_sync(start_technologies_check, url)
+def sync_start_technologies_check(url: str, cancelled: threading.Event | None = None):
+    return run_async_in_sync(start_technologies_check, url, cancelled)
 
 
-async def start_technologies_check(url: str):
+def raise_if_cancelled(cancelled: threading.Event | None):
+    # a thread can't be interrupted, it stops between its requests
+    if cancelled is not None and cancelled.is_set():
+        raise CheckCancelled("The technologies check was cancelled")
+
+
+async def start_technologies_check(url: str, cancelled: threading.Event | None = None):
+    # Wappalyzer, retirejs, bs4 and requests are imported on the first check, not with the API
+    import urllib3
+
     # loop = asyncio.get_event_loop()
     warnings.filterwarnings("ignore", category=UserWarning, module="Wappalyzer")
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -44,9 +55,11 @@ async def start_technologies_check(url: str):
     # vulnerabilities = await loop.run_in_executor(None, analyze_scripts_with_retirejs, fixed_scripts)
     # scripts = await loop.run_in_executor(None, get_scripts, url)
     technologies = get_dependencies(url)
+    raise_if_cancelled(cancelled)
     scripts = get_scripts(url)
+    raise_if_cancelled(cancelled)
     fixed_scripts = fix_script_urls(get_base_url(url), scripts)
-    vulnerabilities = analyze_scripts_with_retirejs(fixed_scripts)
+    vulnerabilities = analyze_scripts_with_retirejs(fixed_scripts, cancelled)
     warnings.simplefilter('default', urllib3.exceptions.InsecureRequestWarning)
 
     return {
@@ -57,6 +70,9 @@ async def start_technologies_check(url: str):
 
 
 def get_scripts(url):
+    import requests
+    from bs4 import BeautifulSoup
+
     # parsed_url = urlparse(url)
     # verify_ssl = parsed_url.scheme == "https"
     # response = requests.get(url, verify=verify_ssl)
@@ -72,10 +88,18 @@ def get_scripts(url):
     return scripts
 
 
+@cache
+def wappalyzer():
+    # parses the fingerprints of all technologies, once
+    from Wappalyzer import Wappalyzer
+    return Wappalyzer.latest()
+
+
 def get_dependencies(url):
+    from Wappalyzer import WebPage
+
     webpage = WebPage.new_from_url(url)
-    wappalyzer = Wappalyzer.latest()
-    technologies = wappalyzer.analyze_with_versions_and_categories(webpage)
+    technologies = wappalyzer().analyze_with_versions_and_categories(webpage)
 
     if not isinstance(technologies, dict):
         raise TypeError("Wappalyzer returned an unexpected type. Expected dict, got: " + str(type(technologies)))
@@ -87,10 +111,13 @@ def get_dependencies(url):
     return technologies
 
 
-def analyze_scripts_with_retirejs(scripts):
+def analyze_scripts_with_retirejs(scripts, cancelled: threading.Event | None = None):
+    import retirejs
+
     # print("\nAnalyzing JS Files with Retire.js:")
     results = []
     for script in scripts:
+        raise_if_cancelled(cancelled)
         try:
             result = retirejs.scan_endpoint(script)
             # print(f"result: {script} {result}")
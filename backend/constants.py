@@ -6,14 +6,137 @@ load_dotenv()
 
 # region Chat
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# OpenAI compatible API, e.g. a local fake for benchmarks, empty -> api.openai.com
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+# answers to the first question of a chat are reused for similar questions about identical check results
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true") == "true"
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(60 * 60 * 24)))  # seconds
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))  # cosine of the question embeddings
+ANSWER_CACHE_EMBEDDING_MODEL = os.getenv("ANSWER_CACHE_EMBEDDING_MODEL", "text-embedding-3-small")
+# the checks of a checkup are summarised in one call with an executive summary, a check that finishes
+# more than SUMMARY_BATCH_WAIT seconds after the first one is summarised on its own
+SUMMARY_BATCH_ENABLED = os.getenv("SUMMARY_BATCH_ENABLED", "true") == "true"
+SUMMARY_BATCH_WAIT = float(os.getenv("SUMMARY_BATCH_WAIT", "30"))
+# completions of all API processes share the limits of the OpenAI account (kept in Redis),
+# chat goes before summaries, which leave 1 - LLM_BACKGROUND_SHARE of the budget to chat
+LLM_GATEWAY_ENABLED = os.getenv("LLM_GATEWAY_ENABLED", "true") == "true"
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "500"))
+LLM_BACKGROUND_SHARE = float(os.getenv("LLM_BACKGROUND_SHARE", "0.8"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+# OpenAI compatible chat completion APIs in failover order, "name|base_url|model" separated by commas,
+# e.g. "openai||gpt-4o-mini,local|http://localhost:8080/v1|qwen2.5-7b-instruct"; empty -> OpenAI at OPENAI_BASE_URL
+LLM_PROVIDERS = os.getenv("LLM_PROVIDERS", "")
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+# chat answers send a second request when the first token is later than LLM_HEDGE_PERCENTILE of the provider's
+# recent first tokens, or than LLM_HEDGE_AFTER seconds until LLM_HEDGE_MIN_SAMPLES of them were measured.
+# The second request goes to the next provider, with a single one in LLM_PROVIDERS (the default) nothing is hedged
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true") == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "3.0"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "500"))  # first tokens per provider and model
 # endregion
 
 # region Checks
 MXTOOLBOX_KEY = os.getenv("MXTOOLBOX_KEY")
+MXTOOLBOX_URL = os.getenv("MXTOOLBOX_URL", "https://api.mxtoolbox.com/api/v1")
+# true -> the network check answers with checks/network_check_example.json instead of calling MXToolbox
+MXTOOLBOX_MOCK = os.getenv("MXTOOLBOX_MOCK", "true") == "true"
+COOKIE_SCANNER_URL = os.getenv("COOKIE_SCANNER_URL", "https://rapid-shadow-93cf.davidzhai0921.workers.dev")
+# public URL of POST /api/checks/cookies/callback, empty -> polling only
+COOKIE_SCANNER_CALLBACK_URL = os.getenv("COOKIE_SCANNER_CALLBACK_URL", "")
+# sent to the scanner in the callback URL (?token=) and checked by the callback, unset -> polling only
+COOKIE_SCANNER_CALLBACK_SECRET = os.getenv("COOKIE_SCANNER_CALLBACK_SECRET")
+
+# How many checks of each type may run at once in one process
+CHECK_CAPACITY = {
+    "cookie": int(os.getenv("CHECK_CAPACITY_COOKIE", "16")),
+    "lighthouse": int(os.getenv("CHECK_CAPACITY_LIGHTHOUSE", "2")),
+    "network": int(os.getenv("CHECK_CAPACITY_NETWORK", "8")),
+    "scan_ports": int(os.getenv("CHECK_CAPACITY_SCAN_PORTS", "8")),
+    "technologies": int(os.getenv("CHECK_CAPACITY_TECHNOLOGIES", "4")),
+}
+# How many checks of one user may run at once
+CHECKS_PER_USER = int(os.getenv("CHECKS_PER_USER", "5"))
+# Identical checks (same hostname and type) running at once share one execution
+SINGLE_FLIGHT_LOCK_TTL = int(os.getenv("SINGLE_FLIGHT_LOCK_TTL", str(60 * 5)))  # seconds, renewed by the leader
+SINGLE_FLIGHT_RESULT_TTL = int(os.getenv("SINGLE_FLIGHT_RESULT_TTL", "60"))  # seconds
+# Serialized responses of finished checkups/checks and of chat histories
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(60 * 60 * 24)))  # seconds
+# Port scan: top-100, top-1000, full or custom
+PORT_SCAN_PROFILE = os.getenv("PORT_SCAN_PROFILE", "top-1000")
+PORT_SCAN_CONNECTIONS = int(os.getenv("PORT_SCAN_CONNECTIONS", "512"))  # open sockets of all scans together
+PORT_SCAN_TIMEOUT = float(os.getenv("PORT_SCAN_TIMEOUT", "0.5"))  # seconds per connect
+PORT_SCAN_MAX_OPEN_PER_HOST = int(os.getenv("PORT_SCAN_MAX_OPEN_PER_HOST", "100"))
+# POST /checks/scan_ports costs RATE_LIMIT_CHECK_COST per started PORT_SCAN_PORTS_PER_COST ports, a full scan more
+PORT_SCAN_PORTS_PER_COST = int(os.getenv("PORT_SCAN_PORTS_PER_COST", "1100"))
+DNS_CACHE_TTL = int(os.getenv("DNS_CACHE_TTL", "300"))  # seconds
+DNS_CACHE_MAX_ENTRIES = int(os.getenv("DNS_CACHE_MAX_ENTRIES", "1000"))
+# Service detection on the open ports: banners, TLS handshakes and an HTTP probe
+FINGERPRINT_ENABLED = os.getenv("FINGERPRINT_ENABLED", "true") == "true"
+FINGERPRINT_CONNECTIONS = int(os.getenv("FINGERPRINT_CONNECTIONS", "64"))  # open sockets of all probes together
+FINGERPRINT_TIMEOUT = float(os.getenv("FINGERPRINT_TIMEOUT", "2"))  # seconds per connect and read
+FINGERPRINT_CACHE_TTL = int(os.getenv("FINGERPRINT_CACHE_TTL", "600"))  # seconds, per (ip, port, hostname)
+FINGERPRINT_CACHE_MAX_ENTRIES = int(os.getenv("FINGERPRINT_CACHE_MAX_ENTRIES", "10000"))
+# Bulk checkups of POST /checkups/batch
+BATCH_MAX_URLS = int(os.getenv("BATCH_MAX_URLS", "100"))
+BATCH_CHECKUP_CONCURRENCY = int(os.getenv("BATCH_CHECKUP_CONCURRENCY", "4"))  # checkups of a batch in progress
+BATCH_FEED_POLL_SECONDS = float(os.getenv("BATCH_FEED_POLL_SECONDS", "2"))
+# the feed ends when no check of the batch changed its status for this long
+BATCH_FEED_STALL_SECONDS = float(os.getenv("BATCH_FEED_STALL_SECONDS", "600"))
+# unfinished checks of checkups older than this were abandoned by a stopped process, they fail at start-up
+CHECK_ABANDONED_HOURS = float(os.getenv("CHECK_ABANDONED_HOURS", "6"))
+# endregion
+
+# region Rate limits
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true") == "true"
+RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "60"))  # seconds of the sliding window
+RATE_LIMIT_POINTS = int(os.getenv("RATE_LIMIT_POINTS", "120"))  # per user and window
+RATE_LIMIT_ANONYMOUS_POINTS = int(os.getenv("RATE_LIMIT_ANONYMOUS_POINTS", "30"))  # per client address and window
+# Points of one request, by what it costs us
+RATE_LIMIT_CHECKUP_COST = int(os.getenv("RATE_LIMIT_CHECKUP_COST", "20"))
+# a batch costs RATE_LIMIT_BATCH_COST plus RATE_LIMIT_BATCH_URL_COST per url, at most all points of the window
+RATE_LIMIT_BATCH_COST = int(os.getenv("RATE_LIMIT_BATCH_COST", "20"))
+RATE_LIMIT_BATCH_URL_COST = int(os.getenv("RATE_LIMIT_BATCH_URL_COST", "2"))
+RATE_LIMIT_CHECK_COST = int(os.getenv("RATE_LIMIT_CHECK_COST", "10"))
+RATE_LIMIT_MESSAGE_COST = int(os.getenv("RATE_LIMIT_MESSAGE_COST", "2"))
+# Per user and UTC day, 0 disables the quota
+QUOTA_LLM_TOKENS_PER_DAY = int(os.getenv("QUOTA_LLM_TOKENS_PER_DAY", "300000"))
+QUOTA_SCAN_MINUTES_PER_DAY = int(os.getenv("QUOTA_SCAN_MINUTES_PER_DAY", "120"))
+# endregion
+
+# region Scheduler
+SCHEDULER_TICK_SECONDS = int(os.getenv("SCHEDULER_TICK_SECONDS", "60"))
+# Due schedules claimed by one replica per tick
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "20"))
+# Checkups of one batch are started spread over this many seconds
+SCHEDULER_BATCH_SPREAD_SECONDS = int(os.getenv("SCHEDULER_BATCH_SPREAD_SECONDS", "30"))
+# Random delay added to every next run, so schedules created together drift apart
+SCHEDULER_NEXT_RUN_JITTER_MINUTES = int(os.getenv("SCHEDULER_NEXT_RUN_JITTER_MINUTES", "30"))
+# No new batch while this many checks wait for an admission slot in the scheduler process
+SCHEDULER_MAX_QUEUED_CHECKS = int(os.getenv("SCHEDULER_MAX_QUEUED_CHECKS", "20"))
+SCHEDULER_METRICS_PORT = int(os.getenv("SCHEDULER_METRICS_PORT", "9100"))
+SCHEDULES_PER_USER = int(os.getenv("SCHEDULES_PER_USER", "20"))
 # endregion
 
 # region Other
 RUNNING_IN_DOCKER = os.getenv("RUNNING_IN_DOCKER")
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))  # bytes
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5"))
+# bytes, larger bodies and stream chunks are compressed in a worker thread instead of on the event loop
+COMPRESSION_EXECUTOR_MIN_SIZE = int(os.getenv("COMPRESSION_EXECUTOR_MIN_SIZE", str(256 * 1024)))
+# Event loop lag sampling and capture of callbacks that block the loop
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "true") == "true"
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1"))  # seconds between lag samples
+LOOP_MONITOR_THRESHOLD = float(os.getenv("LOOP_MONITOR_THRESHOLD", "0.1"))  # seconds, longer blocks are captured
+# seconds, the stack of a route's stall is printed at most once in this time, the others in one line
+LOOP_MONITOR_STACK_LOG_SECONDS = float(os.getenv("LOOP_MONITOR_STACK_LOG_SECONDS", "60"))
+# true -> a request whose code blocked the loop longer than the threshold fails, for development and tests
+LOOP_MONITOR_STRICT = os.getenv("LOOP_MONITOR_STRICT", "false") == "true"
 # endregion
 
 # region Auth & Tokens
@@ -25,6 +148,8 @@ SECRET_KEY = os.getenv("SECRET_KEY", "your_secret_key")
 CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:8000/api/docs")
+# Bearer token of the internal stats endpoints (/traces, /admission, ...), unset -> only from localhost
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN")
 # endregion
 
 # region Databases
@@ -39,6 +164,12 @@ POSTGRES_DB = os.getenv("POSTGRES_DB", "db")
 DATABASE_URL = (
     f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 )
+POSTGRES_POOL_SIZE = int(os.getenv("POSTGRES_POOL_SIZE", "10"))
+POSTGRES_MAX_OVERFLOW = int(os.getenv("POSTGRES_MAX_OVERFLOW", "20"))
+POSTGRES_POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+POSTGRES_POOL_RECYCLE = int(os.getenv("POSTGRES_POOL_RECYCLE", str(60 * 30)))  # seconds
+POSTGRES_POOL_PRE_PING = os.getenv("POSTGRES_POOL_PRE_PING", "true") == "true"
+POSTGRES_STATEMENT_CACHE_SIZE = int(os.getenv("POSTGRES_STATEMENT_CACHE_SIZE", "500"))
 DATABASE_URL_MIGRATIONS = (
     f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 )
@@ -46,4 +177,22 @@ DATABASE_URL_MIGRATIONS = (
 MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY")
 MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY")
 MINIO_ENDPOINT_URL = os.getenv("MINIO_ENDPOINT_URL")
+MINIO_SECURE = os.getenv("MINIO_SECURE", "false") == "true"
+# endregion
+
+# region Storage
+# Chat attachments: gcs, minio or local
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "gcs")
+STORAGE_BUCKET = os.getenv("STORAGE_BUCKET", "planspiegel-attachments")
+GCS_CREDENTIALS_FILE = os.getenv("GCS_CREDENTIALS_FILE", "planspiegel_google_service_account_key.json")
+STORAGE_LOCAL_DIRECTORY = os.getenv("STORAGE_LOCAL_DIRECTORY", "/tmp/planspiegel-attachments")
+# base URL of the stored objects, empty -> the default of the backend
+STORAGE_PUBLIC_URL = os.getenv("STORAGE_PUBLIC_URL", "")
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(10 * 1024 * 1024)))
+# image attachments get a downscaled WebP variant without metadata, which is sent to the model
+IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "true") == "true"
+IMAGE_MAX_LONG_SIDE = int(os.getenv("IMAGE_MAX_LONG_SIDE", "1024"))
+IMAGE_MAX_SHORT_SIDE = int(os.getenv("IMAGE_MAX_SHORT_SIDE", "768"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))  # processes
 # endregion
@@ -0,0 +1,113 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+from constants import CHECK_CAPACITY, CHECKS_PER_USER
+
+Waiter = Tuple[int, asyncio.Future]  # (check_id, granted future)
+
+
+class CheckAdmission:
+    """
+    Process-wide admission control for checks.
+
+    Every check type has a number of slots, every user may hold a limited
+    number of slots at once. Waiting checks of the user with the fewest running
+    checks go first and ties are served round-robin, so one user with many
+    checkups doesn't starve the others.
+    """
+
+    def __init__(self, capacity: Dict[str, int], per_user: int):
+        self.capacity = dict(capacity)
+        self.per_user = per_user
+        self.running: Dict[str, int] = {check_type: 0 for check_type in self.capacity}
+        self.running_by_user: Dict[int, int] = {}
+        # check_type -> user_id -> waiting checks of the user (FIFO)
+        self.queues: Dict[str, OrderedDict[int, Deque[Waiter]]] = {
+            check_type: OrderedDict() for check_type in self.capacity
+        }
+
+    def enqueue(self, check_type: str, user_id: int, check_id: int) -> asyncio.Future:
+        """
+        Registers the check and returns a future that resolves once the check got a slot.
+        The owner of the future must call release() when the check is finished.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queues[check_type].setdefault(user_id, deque()).append((check_id, future))
+        self._dispatch()
+        return future
+
+    def release(self, check_type: str, user_id: int):
+        self.running[check_type] -= 1
+        self.running_by_user[user_id] -= 1
+        if self.running_by_user[user_id] <= 0:
+            del self.running_by_user[user_id]
+        self._dispatch()
+
+    def discard(self, check_id: int) -> bool:
+        """Removes a waiting check from the queue. Returns False if it isn't waiting."""
+        for user_queues in self.queues.values():
+            for user_id, waiters in list(user_queues.items()):
+                for waiter in waiters:
+                    if waiter[0] == check_id:
+                        waiters.remove(waiter)
+                        waiter[1].cancel()
+                        if not waiters:
+                            del user_queues[user_id]
+                        return True
+        return False
+
+    def withdraw(self, check_type: str, user_id: int, check_id: int, slot: asyncio.Future):
+        """Gives up a slot that won't be used, no matter if it is still waiting or already granted"""
+        if not self.discard(check_id) and slot.done() and not slot.cancelled():
+            self.release(check_type, user_id)
+
+    def queue_position(self, check_id: int) -> Optional[int]:
+        """1-based position in the queue of its check type, None if the check isn't waiting"""
+        for check_type in self.queues:
+            for position, waiter in enumerate(self._service_order(check_type), start=1):
+                if waiter[0] == check_id:
+                    return position
+        return None
+
+    def stats(self) -> dict:
+        return {
+            check_type: {
+                "capacity": self.capacity[check_type],
+                "running": self.running[check_type],
+                "queued": sum(len(waiters) for waiters in self.queues[check_type].values()),
+            } for check_type in self.capacity
+        }
+
+    def _user_has_quota(self, user_id: int) -> bool:
+        return self.running_by_user.get(user_id, 0) < self.per_user
+
+    def _service_order(self, check_type: str):
+        """Waiting checks in the order they will be served if quotas allow it"""
+        waiters = [list(user_waiters) for user_waiters in self.queues[check_type].values()]
+        for i in range(max((len(user_waiters) for user_waiters in waiters), default=0)):
+            for user_waiters in waiters:
+                if i < len(user_waiters):
+                    yield user_waiters[i]
+
+    def _dispatch(self):
+        for check_type, user_queues in self.queues.items():
+            while self.running[check_type] < self.capacity[check_type]:
+                # the user with the fewest running checks goes first, ties are served round-robin
+                eligible = [user_id for user_id in user_queues if self._user_has_quota(user_id)]
+                if not eligible:
+                    break
+                user_id = min(eligible, key=lambda candidate: self.running_by_user.get(candidate, 0))
+                waiters = user_queues.pop(user_id)
+                _, future = waiters.popleft()
+                # served user goes to the end of the round
+                if waiters:
+                    user_queues[user_id] = waiters
+                if future.cancelled():
+                    continue
+                self.running[check_type] += 1
+                self.running_by_user[user_id] = self.running_by_user.get(user_id, 0) + 1
+                future.set_result(None)
+
+
+admission = CheckAdmission(capacity=CHECK_CAPACITY, per_user=CHECKS_PER_USER)
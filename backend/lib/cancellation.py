@@ -0,0 +1,127 @@
+import asyncio
+from typing import Dict, List, Optional, Set
+
+from prometheus_client import Counter
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from lib.redis_db import redis_for_checks
+
+CHECKUPS_CANCELLED = Counter("planspiegel_checkups_cancelled_total", "Checkups cancelled by their users")
+CHECKS_CANCELLED = Counter(
+    "planspiegel_checks_cancelled_total",
+    "Check tasks cancelled in this process, by check type",
+    ["check_type"],
+)
+
+CHANNEL = "checkup-cancellations"
+
+
+class CheckCancelled(Exception):
+    """Raised in a worker thread whose check was cancelled, at its next step"""
+
+
+class CheckupCancellation:
+    """
+    The check tasks of the checkups in this process.
+
+    A cancelled checkup is announced to all processes over Redis, every process cancels its own tasks.
+    The checkup is also marked in Redis for a day, so its checks that start later (a batch, another
+    process) don't run.
+    """
+
+    def __init__(self, redis: Redis, ttl: int = 60 * 60 * 24):
+        self.redis = redis
+        self.ttl = ttl
+        self.tasks: Dict[int, Set[asyncio.Task]] = {}
+        self.check_types: Dict[asyncio.Task, str] = {}
+        self.listener: Optional[asyncio.Task] = None
+        self.cancelled = 0
+
+    def track(self, checkup_id: int, check_type: str, task: asyncio.Task):
+        self.tasks.setdefault(checkup_id, set()).add(task)
+        self.check_types[task] = check_type
+        task.add_done_callback(lambda _: self._untrack(checkup_id, task))
+
+    def _untrack(self, checkup_id: int, task: asyncio.Task):
+        self.check_types.pop(task, None)
+        tasks = self.tasks.get(checkup_id)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self.tasks[checkup_id]
+
+    @staticmethod
+    def key(checkup_id: int) -> str:
+        return f"cancelled-checkup:{checkup_id}"
+
+    async def is_cancelled(self, checkup_id: int) -> bool:
+        try:
+            return bool(await self.redis.exists(self.key(checkup_id)))
+        except RedisError as e:
+            print(f"[cancellation] checkup {checkup_id} assumed not cancelled: {e}")
+            return False
+
+    async def cancel(self, checkup_id: int, wait: float = 5.0) -> int:
+        """
+        Cancels the checks of the checkup in all processes.
+        Waits up to `wait` seconds for the ones of this process, so their slots are free when it returns.
+        Returns how many checks were cancelled in this process.
+        """
+        tasks = self.cancel_local(checkup_id)
+        CHECKUPS_CANCELLED.inc()
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.set(self.key(checkup_id), "1", ex=self.ttl)
+                pipe.publish(CHANNEL, str(checkup_id))
+                await pipe.execute()
+        except RedisError as e:
+            print(f"[cancellation] other processes don't know that checkup {checkup_id} is cancelled: {e}")
+        if tasks:
+            await asyncio.wait(tasks, timeout=wait)
+        return len(tasks)
+
+    def cancel_local(self, checkup_id: int) -> List[asyncio.Task]:
+        tasks = []
+        for task in self.tasks.get(checkup_id, ()):
+            # the announcement of our own cancellation comes back over Redis
+            if task.done() or task.cancelling():
+                continue
+            task.cancel()
+            tasks.append(task)
+            CHECKS_CANCELLED.labels(self.check_types.get(task, "unknown")).inc()
+        self.cancelled += len(tasks)
+        return tasks
+
+    def start(self):
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            await asyncio.gather(self.listener, return_exceptions=True)
+            self.listener = None
+
+    async def listen(self):
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self.cancel_local(int(message["data"]))
+            except RedisError as e:
+                print(f"[cancellation] listening failed, again in 5s: {e}")
+                await asyncio.sleep(5)
+
+    def stats(self) -> dict:
+        return {
+            "listening": self.listener is not None and not self.listener.done(),
+            "checkups": len(self.tasks),
+            "checks": sum(len(tasks) for tasks in self.tasks.values()),
+            "cancelled_checks": self.cancelled,
+        }
+
+
+checkup_cancellation = CheckupCancellation(redis_for_checks)
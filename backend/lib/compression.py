@@ -0,0 +1,222 @@
+import gzip
+import zlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from lib.tracing import run_in_executor
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+# media that is already compressed
+INCOMPRESSIBLE_TYPES = ("image/", "video/", "audio/", "font/woff", "application/zip", "application/gzip",
+                        "application/x-brotli", "application/x-7z-compressed", "application/octet-stream")
+
+# streams whose every chunk must reach the client at once
+LIVE_FEED_TYPES = ("text/event-stream", "application/x-ndjson")
+
+ENCODINGS = ("br", "gzip")
+
+
+def etag_for_encoding(etag: str, encoding: str) -> str:
+    """The ETag of the compressed representation, W/"abc-br" for "abc" and br"""
+    return f'W/{etag.removeprefix("W/")[:-1]}-{encoding}"'
+
+
+def etag_without_encoding(etag: str) -> str:
+    """The ETag of the uncompressed representation, "abc" for W/"abc-br", W/"abc" and "abc" """
+    etag = etag.strip().removeprefix("W/")
+    for encoding in ENCODINGS:
+        if etag.endswith(f'-{encoding}"'):
+            return etag[:-len(encoding) - 2] + '"'
+    return etag
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """br or gzip from an Accept-Encoding header, None if the client accepts neither"""
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip()] = q
+
+    wildcard = accepted.get("*", 0.0)
+    if brotli is not None and accepted.get("br", wildcard) > 0:
+        return "br"
+    if accepted.get("gzip", wildcard) > 0:
+        return "gzip"
+    return None
+
+
+class StreamCompressor:
+    """
+    Compresses a body chunk by chunk. With flush_each_chunk every chunk is flushed,
+    so SSE events reach the client at once, otherwise the compressor buffers for a better ratio.
+    """
+
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int, flush_each_chunk: bool):
+        self.encoding = encoding
+        self.flush_each_chunk = flush_each_chunk
+        if encoding == "br":
+            self.brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            self.zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if self.encoding == "br":
+            out = self.brotli.process(data)
+            if final:
+                return out + self.brotli.finish()
+            return out + self.brotli.flush() if self.flush_each_chunk else out
+        out = self.zlib.compress(data)
+        if final:
+            return out + self.zlib.flush(zlib.Z_FINISH)
+        return out + self.zlib.flush(zlib.Z_SYNC_FLUSH) if self.flush_each_chunk else out
+
+
+class CompressionMiddleware:
+    """
+    Brotli/gzip compression of responses.
+
+    Small bodies, already compressed media and responses with Content-Encoding pass through.
+    Bodies with an ETag are immutable for that ETag, their compressed form is kept in an LRU cache.
+    Bodies and chunks from executor_minimum_size on are compressed in the default executor, not on the loop.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 5,
+                 cache_size: int = 256, executor_minimum_size: int = 256 * 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.executor_minimum_size = executor_minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.cache_size = cache_size
+        self.cache: OrderedDict[Tuple[str, str], bytes] = OrderedDict()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        responder = CompressionResponder(self, encoding, send)
+        await self.app(scope, receive, responder.send)
+
+    async def compress(self, body: bytes, encoding: str, etag: Optional[str]) -> bytes:
+        key = (etag, encoding)
+        if etag and key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        if len(body) >= self.executor_minimum_size:
+            compressed = await run_in_executor(None, self.compress_body, body, encoding)
+        else:
+            compressed = self.compress_body(body, encoding)
+
+        # the cache is only touched on the loop
+        if etag:
+            self.cache[key] = compressed
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return compressed
+
+    def compress_body(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+
+class CompressionResponder:
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send_next = send
+        self.start_message: Optional[Message] = None
+        self.started = False
+        self.passthrough = False
+        self.compressor: Optional[StreamCompressor] = None
+
+    async def send(self, message: Message):
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            # headers are sent with the first body part, when we know if it gets compressed
+            self.start_message = message
+            return
+        if message_type != "http.response.body":
+            await self.send_next(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.passthrough:
+            await self.send_next(message)
+            return
+        if self.started:
+            await self.send_next({"type": "http.response.body",
+                                  "body": await self.compress_chunk(body, final=not more_body),
+                                  "more_body": more_body})
+            return
+
+        self.started = True
+        headers = MutableHeaders(raw=self.start_message["headers"])
+        if not self.should_compress(headers, body, more_body):
+            self.passthrough = True
+            await self.send_next(self.start_message)
+            await self.send_next(message)
+            return
+
+        headers["Content-Encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        etag = headers.get("etag")
+        if etag:
+            # the compressed representation is only semantically equal, and differs per encoding
+            headers["ETag"] = etag_for_encoding(etag, self.encoding)
+
+        if not more_body:
+            compressed = await self.middleware.compress(body, self.encoding, etag)
+            headers["Content-Length"] = str(len(compressed))
+            await self.send_next(self.start_message)
+            await self.send_next({"type": "http.response.body", "body": compressed, "more_body": False})
+            return
+
+        # streaming response, e.g. the SSE chat stream or the PDF report
+        if "content-length" in headers:
+            del headers["Content-Length"]
+        is_live_feed = headers.get("content-type", "").startswith(LIVE_FEED_TYPES)
+        self.compressor = StreamCompressor(self.encoding, self.middleware.gzip_level, self.middleware.brotli_quality,
+                                           flush_each_chunk=is_live_feed)
+        await self.send_next(self.start_message)
+        await self.send_next({"type": "http.response.body",
+                              "body": await self.compress_chunk(body, final=False),
+                              "more_body": True})
+
+    async def compress_chunk(self, body: bytes, final: bool) -> bytes:
+        # the chunks of a response are sent one after the other, the compressor is never used twice at once
+        if len(body) >= self.middleware.executor_minimum_size:
+            return await run_in_executor(None, self.compressor.compress, body, final)
+        return self.compressor.compress(body, final)
+
+    def should_compress(self, headers: MutableHeaders, body: bytes, more_body: bool) -> bool:
+        if self.start_message["status"] in (204, 304) or "content-encoding" in headers:
+            return False
+        content_type = headers.get("content-type", "").lower()
+        if content_type.startswith(INCOMPRESSIBLE_TYPES):
+            return False
+        return more_body or len(body) >= self.middleware.minimum_size
@@ -0,0 +1,119 @@
+import asyncio
+import io
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Optional
+
+from constants import IMAGE_MAX_LONG_SIDE, IMAGE_MAX_SHORT_SIDE, IMAGE_QUALITY, IMAGE_WORKERS
+from lib.tracing import span
+
+# larger images are rejected instead of decoded, a 10MB PNG can unpack into gigabytes
+MAX_PIXELS = 50_000_000
+# the variant is cached per settings, new settings make new variants
+VARIANT = f"l{IMAGE_MAX_LONG_SIDE}s{IMAGE_MAX_SHORT_SIDE}q{IMAGE_QUALITY}"
+
+
+@dataclass
+class PreparedImage:
+    content: bytes
+    content_type: str
+    width: int
+    height: int
+    original_width: int
+    original_height: int
+
+
+def fit_size(width: int, height: int, max_long_side: int = IMAGE_MAX_LONG_SIDE,
+             max_short_side: int = IMAGE_MAX_SHORT_SIDE) -> tuple[int, int]:
+    """Scales down (never up) until the long and the short side fit"""
+    scale = min(1.0, max_long_side / max(width, height), max_short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def vision_tokens(width: int, height: int) -> int:
+    """
+    Input tokens of an image with detail "high": the model scales it into 2048x2048, then the short side
+    down to 768, and charges 85 + 170 per 512px tile. Pixels above that are uploaded and decoded for nothing.
+    """
+    width, height = fit_size(width, height, 2048, 768)
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def prepare_image(content: bytes, max_long_side: int = IMAGE_MAX_LONG_SIDE,
+                  max_short_side: int = IMAGE_MAX_SHORT_SIDE, quality: int = IMAGE_QUALITY) -> Optional[PreparedImage]:
+    """
+    Decodes, downscales to fit IMAGE_MAX_LONG_SIDE x IMAGE_MAX_SHORT_SIDE and re-encodes as WebP without metadata.
+    CPU bound, runs in the process pool. None if the content is not an image Pillow can read.
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            if image.width * image.height > MAX_PIXELS:
+                return None
+            original_width, original_height = image.size
+            # EXIF orientation 5-8 stores the pixels sideways
+            rotated = image.getexif().get(0x0112) in (5, 6, 7, 8)
+            if rotated:
+                original_width, original_height = original_height, original_width
+            width, height = fit_size(original_width, original_height, max_long_side, max_short_side)
+            # JPEGs are decoded at a fraction of the size right away
+            image.draft("RGB", (height, width) if rotated else (width, height))
+            # the orientation tag is gone after re-encoding
+            oriented = ImageOps.exif_transpose(image)
+            has_alpha = oriented.mode in ("RGBA", "LA") or "transparency" in oriented.info
+            converted = oriented.convert("RGBA" if has_alpha else "RGB")
+            if converted.size != (width, height):
+                converted = converted.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            output = io.BytesIO()
+            # only the pixels are written, no EXIF, ICC or XMP
+            converted.save(output, "WEBP", quality=quality, method=4)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):
+        return None
+    return PreparedImage(content=output.getvalue(), content_type="image/webp", width=width, height=height,
+                         original_width=original_width, original_height=original_height)
+
+
+pool: Optional[ProcessPoolExecutor] = None
+
+
+def image_pool() -> ProcessPoolExecutor:
+    # started on the first image, the API shouldn't start workers it never uses.
+    # forkserver: forking the threaded API process could copy a held lock into the worker
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+    return pool
+
+
+async def prepare_image_in_pool(content: bytes) -> Optional[PreparedImage]:
+    """None if the image can't be prepared, the original is sent to the model then"""
+    global pool
+    with span("image.prepare", size=len(content)) as prepare_span:
+        executor = image_pool()
+        try:
+            prepared = await asyncio.get_running_loop().run_in_executor(executor, prepare_image, content)
+        except BrokenProcessPool as e:
+            # a worker died (e.g. killed for its memory), the next image gets a new pool
+            print(f"[images] process pool is broken, the original image is used: {e}")
+            prepare_span.attributes.update(error="broken process pool")
+            if pool is executor:
+                pool = None
+                executor.shutdown(wait=False, cancel_futures=True)
+            return None
+        if prepared is not None:
+            prepare_span.attributes.update(prepared_size=len(prepared.content),
+                                           tokens=vision_tokens(prepared.width, prepared.height),
+                                           original_tokens=vision_tokens(prepared.original_width,
+                                                                         prepared.original_height))
+        return prepared
+
+
+def shutdown_image_pool():
+    global pool
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool = None
@@ -0,0 +1,258 @@
+import asyncio
+import contextvars
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import deque
+from dataclasses import dataclass, field, asdict
+from typing import Deque, Dict, List, Optional
+
+from prometheus_client import Histogram
+
+from constants import LOOP_MONITOR_INTERVAL, LOOP_MONITOR_THRESHOLD, LOOP_MONITOR_STACK_LOG_SECONDS
+
+EVENT_LOOP_LAG = Histogram(
+    "planspiegel_event_loop_lag_seconds",
+    "How much later than planned the loop monitor's sleep woke up",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+EVENT_LOOP_STALLS = Histogram(
+    "planspiegel_event_loop_stall_seconds",
+    "Loop blocked longer than LOOP_MONITOR_THRESHOLD, by the route whose code blocked it",
+    ["route"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+
+@dataclass
+class Stall:
+    """The loop was blocked by one callback, stack is where it was stuck"""
+    route: str
+    started_at: float
+    duration: Optional[float] = None
+    stack: str = ""
+
+
+@dataclass
+class RequestInfo:
+    scope: dict
+    stalls: List[Stall] = field(default_factory=list)
+
+    @property
+    def route(self) -> str:
+        # the router fills the scope in place once it matched
+        method = self.scope.get("method", self.scope["type"])
+        route = self.scope.get("route")
+        if getattr(route, "path", None):
+            return f"{method} {route.path}"
+        endpoint = self.scope.get("endpoint")
+        if endpoint is not None:
+            return f"{method} {getattr(endpoint, '__name__', repr(endpoint))}"
+        return f"{method} unmatched"
+
+
+class LoopBlockedError(Exception):
+    pass
+
+
+current_request: contextvars.ContextVar[Optional[RequestInfo]] = contextvars.ContextVar("current_request",
+                                                                                        default=None)
+# request tasks, for Python < 3.12 where the context of another task can't be read
+requests_by_task: "weakref.WeakKeyDictionary[asyncio.Task, RequestInfo]" = weakref.WeakKeyDictionary()
+
+
+def request_of(task: Optional[asyncio.Task]) -> Optional[RequestInfo]:
+    if task is None:
+        return None
+    get_context = getattr(task, "get_context", None)
+    if get_context is not None:
+        return get_context().get(current_request)
+    return requests_by_task.get(task)
+
+
+class LoopMonitor:
+    """
+    Samples the lag of the loop it was started on and captures what blocks it.
+
+    A task sleeps interval after interval and records how late it woke up. A watchdog thread
+    notices when these wake-ups stop for longer than the threshold and captures the stack of
+    the loop thread at that moment, tagged with the route of the running task.
+    """
+
+    def __init__(self, interval: float, threshold: float, keep: int = 50, stack_log_seconds: float = 60):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls: Deque[Stall] = deque(maxlen=keep)
+        # a route that blocks on every request would print a stack every time
+        self.stack_log_seconds = stack_log_seconds
+        self.stack_logged_at: Dict[str, float] = {}
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.beat = time.monotonic()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.sampler: Optional[asyncio.Task] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        """Starts monitoring the running loop"""
+        if self.sampler is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.stopping.clear()
+        self.sampler = self.loop.create_task(self.sample())
+        self.watchdog = threading.Thread(target=self.watch, name="loop-monitor", daemon=True)
+        self.watchdog.start()
+
+    async def stop(self):
+        if self.sampler is None:
+            return
+        self.stopping.set()
+        self.sampler.cancel()
+        self.sampler = None
+        await asyncio.to_thread(self.watchdog.join)
+
+    async def sample(self):
+        while True:
+            planned = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_lag = max(now - planned, 0.0)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            EVENT_LOOP_LAG.observe(self.last_lag)
+            self.beat = now
+
+    def watch(self):
+        stall, stalled_beat = None, None
+        while not self.stopping.wait(self.threshold / 4):
+            beat = self.beat
+            if time.monotonic() - beat > self.interval + self.threshold:
+                if stall is None:
+                    stall, stalled_beat = self.capture(), beat
+            elif stall is not None:
+                self.finish(stall, max(beat - stalled_beat - self.interval, 0.0))
+                stall = None
+
+    def capture(self) -> Stall:
+        """Stack of the loop thread while it is blocked, runs in the watchdog thread"""
+        frame = sys._current_frames().get(self.loop_thread_id)
+        request = request_of(asyncio.current_task(self.loop))
+        stall = Stall(route=request.route if request else "background", started_at=time.time(),
+                      stack="".join(traceback.format_stack(frame)) if frame is not None else "")
+        if request is not None:
+            request.stalls.append(stall)
+        return stall
+
+    def finish(self, stall: Stall, duration: float):
+        stall.duration = duration
+        self.stalls.append(stall)
+        EVENT_LOOP_STALLS.labels(stall.route).observe(duration)
+        message = f"[loop_monitor] {stall.route} blocked the event loop for {duration:.3f}s"
+        now = time.monotonic()
+        logged_at = self.stack_logged_at.get(stall.route)
+        if logged_at is None or now - logged_at >= self.stack_log_seconds:
+            self.stack_logged_at[stall.route] = now
+            print(f"{message}\n{stall.stack}")
+        else:
+            print(f"{message}, stack in GET /loop-monitor")
+
+    def stats(self) -> dict:
+        return {
+            "running": self.sampler is not None,
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+            "stalls": [asdict(stall) for stall in reversed(self.stalls)],
+        }
+
+
+loop_monitor = LoopMonitor(LOOP_MONITOR_INTERVAL, LOOP_MONITOR_THRESHOLD,
+                           stack_log_seconds=LOOP_MONITOR_STACK_LOG_SECONDS)
+
+
+# region STRICT MODE
+strict_threshold: Optional[float] = None
+# start of the callback the loop of this thread is running
+running_callback = threading.local()
+
+
+def install_strict_mode(threshold: float):
+    """
+    Times every callback of every asyncio loop of the process (Handle._run), a callback of a request
+    that runs longer than the threshold is recorded on the request. Not for production.
+    """
+    global strict_threshold
+    if strict_threshold is not None:
+        strict_threshold = threshold
+        return
+    strict_threshold = threshold
+    run = asyncio.events.Handle._run
+
+    def timed_run(handle: asyncio.events.Handle):
+        started_at = running_callback.started_at = time.perf_counter()
+        try:
+            run(handle)
+        finally:
+            running_callback.started_at = None
+        duration = time.perf_counter() - started_at
+        if duration > strict_threshold and handle._context is not None:
+            request = handle._context.get(current_request)
+            if request is not None:
+                # a task step shows the coroutine and the line it is suspended at
+                owner = getattr(handle._callback, "__self__", None)
+                request.stalls.append(Stall(route=request.route, started_at=time.time() - duration, duration=duration,
+                                            stack=repr(owner if isinstance(owner, asyncio.Task) else handle)))
+
+    asyncio.events.Handle._run = timed_run
+
+
+def check_running_callback(request: RequestInfo):
+    """The request ends inside the current callback, which timed_run can't attribute to it afterwards"""
+    started_at = getattr(running_callback, "started_at", None)
+    if started_at is not None and time.perf_counter() - started_at > strict_threshold:
+        request.stalls.append(Stall(route=request.route, started_at=time.time(),
+                                    duration=time.perf_counter() - started_at,
+                                    stack=repr(asyncio.current_task())))
+
+
+class LoopMonitorMiddleware:
+    """
+    Tags the code of a request with its route, so stalls can be attributed to it.
+    In strict mode a request that blocked the loop fails with LoopBlockedError.
+    """
+
+    def __init__(self, app, strict: bool = False, threshold: float = 0.1):
+        self.app = app
+        self.strict = strict
+        if strict:
+            install_strict_mode(threshold)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = RequestInfo(scope)
+        token = current_request.set(request)
+        task = asyncio.current_task()
+        requests_by_task[task] = request
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if self.strict:
+                check_running_callback(request)
+            current_request.reset(token)
+            requests_by_task.pop(task, None)
+
+        if self.strict and request.stalls:
+            details = "\n".join(f"{'blocked' if stall.duration is None else f'{stall.duration:.3f}s'} "
+                                f"in {stall.stack}" for stall in request.stalls)
+            raise LoopBlockedError(f"{request.route} blocked the event loop:\n{details}")
+
+# endregion
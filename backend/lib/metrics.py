@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+from typing import Callable, Iterable, Sequence, Tuple
+
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+from lib.tracing import span
+
+STAGE_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120, 300, 600)
+
+CHECK_STAGE_SECONDS = Histogram(
+    "planspiegel_check_stage_duration_seconds",
+    "Duration of a checkup pipeline stage (queue, check, filter, summary, db_update)",
+    ["check_type", "stage"],
+    buckets=STAGE_BUCKETS,
+)
+CHECK_STAGE_FAILURES = Counter(
+    "planspiegel_check_stage_failures_total",
+    "Failed checkup pipeline stages",
+    ["check_type", "stage"],
+)
+SINGLE_FLIGHT_RUNS = Counter(
+    "planspiegel_single_flight_runs_total",
+    "Check runs by role: led runs executed the check, coalesced runs reused another one",
+    ["check_type", "role"],
+)
+
+
+@contextmanager
+def track_stage(check_type: str, stage: str, **attributes):
+    """Span + duration histogram + failure counter for one stage of a check"""
+    with span(f"check.{stage}", check_type=check_type, **attributes) as stage_span:
+        try:
+            yield stage_span
+        except BaseException:
+            CHECK_STAGE_FAILURES.labels(check_type, stage).inc()
+            raise
+        finally:
+            CHECK_STAGE_SECONDS.labels(check_type, stage).observe(stage_span.duration)
+
+
+class CallbackGaugeCollector(Collector):
+    """Gauge whose labelled samples are read from a callback at scrape time"""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str],
+                 callback: Callable[[], Iterable[Tuple[Sequence[str], float]]]):
+        self.name = name
+        self.documentation = documentation
+        self.labels = list(labels)
+        self.callback = callback
+
+    def collect(self):
+        gauge = GaugeMetricFamily(self.name, self.documentation, labels=self.labels)
+        for label_values, value in self.callback():
+            gauge.add_metric(list(label_values), value)
+        yield gauge
+
+
+def register_gauge(name: str, documentation: str, labels: Sequence[str],
+                   callback: Callable[[], Iterable[Tuple[Sequence[str], float]]]):
+    REGISTRY.register(CallbackGaugeCollector(name, documentation, labels, callback))
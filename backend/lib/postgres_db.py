@@ -1,18 +1,93 @@
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import exc, text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from constants import DATABASE_URL, POSTGRES_POOL_SIZE, POSTGRES_MAX_OVERFLOW, POSTGRES_POOL_TIMEOUT, \
+    POSTGRES_POOL_RECYCLE, POSTGRES_POOL_PRE_PING, POSTGRES_STATEMENT_CACHE_SIZE
+from lib.metrics import register_gauge
+
+# region POOL INSTRUMENTATION
+POOL_WAITING = Gauge("planspiegel_db_pool_waiting", "Coroutines waiting for a connection from the pool")
+POOL_TIMEOUTS = Counter("planspiegel_db_pool_timeouts_total", "Connection requests that hit pool_timeout")
+POOL_WAIT_SECONDS = Histogram("planspiegel_db_pool_wait_seconds", "Time to get a connection from the pool",
+                              buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30))
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    def exhausted(self) -> bool:
+        """Every connection the pool may open is checked out, a request has to wait (max_overflow -1 is unlimited)"""
+        return self._max_overflow > -1 and self.checkedout() >= self.size() + self._max_overflow
+
+    def _do_get(self):
+        waiting = self.exhausted()
+        if waiting:
+            POOL_WAITING.inc()
+        started_at = time.monotonic()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            if waiting:
+                POOL_WAITING.dec()
+            POOL_WAIT_SECONDS.observe(time.monotonic() - started_at)
 
-from constants import DATABASE_URL
+
+# endregion
 
 Base = declarative_base()
-engine = create_async_engine(DATABASE_URL, future=True)
+engine = create_async_engine(
+    DATABASE_URL,
+    future=True,
+    poolclass=InstrumentedQueuePool,
+    pool_size=POSTGRES_POOL_SIZE,
+    max_overflow=POSTGRES_MAX_OVERFLOW,
+    pool_timeout=POSTGRES_POOL_TIMEOUT,
+    pool_recycle=POSTGRES_POOL_RECYCLE,
+    pool_pre_ping=POSTGRES_POOL_PRE_PING,
+    connect_args={
+        # asyncpg cache of server-side prepared statements, per connection
+        "statement_cache_size": POSTGRES_STATEMENT_CACHE_SIZE,
+        # SQLAlchemy's cache of asyncpg prepared statements, per connection
+        "prepared_statement_cache_size": POSTGRES_STATEMENT_CACHE_SIZE,
+    },
+)
 SessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+register_gauge("planspiegel_db_pool_connections", "Connections of the pool by state", ["state"],
+               lambda: [(("checked_out",), engine.pool.checkedout()),
+                        (("idle",), engine.pool.checkedin()),
+                        (("overflow",), max(engine.pool.overflow(), 0)),
+                        (("size",), engine.pool.size())])
+
 
 async def yield_db() -> AsyncSession:
     async with SessionLocal() as session:
         yield session
 
 
-def return_db() -> AsyncSession:
-    session = SessionLocal()
-    return session
+@asynccontextmanager
+async def db_session() -> AsyncIterator[AsyncSession]:
+    """
+    Unit of work outside of a request: rolls back on error
+    and always gives the connection back to the pool.
+    """
+    async with SessionLocal() as session:
+        try:
+            yield session
+        except BaseException:
+            await session.rollback()
+            raise
+
+
+async def ping_db():
+    """Cheap health probe: one pooled connection, no ORM session"""
+    async with engine.connect() as connection:
+        await connection.execute(text("SELECT 1"))
@@ -0,0 +1,243 @@
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from fastapi import Depends, HTTPException, Request
+from prometheus_client import Counter
+from redis.exceptions import RedisError
+from starlette import status
+
+from auth import verify_jwt, TokenDataFulfilled
+from constants import RATE_LIMIT_ENABLED, RATE_LIMIT_WINDOW, RATE_LIMIT_POINTS, RATE_LIMIT_ANONYMOUS_POINTS
+from lib.redis_db import redis_for_checks
+
+RATE_LIMITED = Counter(
+    "planspiegel_rate_limited_total",
+    "Requests rejected with 429, by route and reason (rate: points of the window, or the exhausted daily quota)",
+    ["route", "reason"],
+)
+
+# Sliding window over two fixed windows: the previous one counts with the part of it that is still in the window.
+# KEYS: current window, previous window. ARGV: limit, cost, weight of the previous window, ttl
+WINDOW_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+local limit, cost, weight = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+if previous * weight + current + cost > limit then
+    return {0, current, previous}
+end
+current = redis.call('INCRBY', KEYS[1], cost)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return {1, current, previous}
+"""
+
+
+@dataclass
+class RateLimitDecision:
+    allowed: bool
+    limit: int
+    remaining: int
+    reset: int  # seconds until the current window ends
+    retry_after: int  # seconds until the rejected cost fits, 0 if allowed
+    window: int
+
+    def headers(self) -> Dict[str, str]:
+        return {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(self.reset),
+            "RateLimit-Policy": f"{self.limit};w={self.window}",
+        }
+
+
+class SlidingWindowLimiter:
+    """
+    Points per identity (a user or a client address) in a sliding window, shared by all processes through Redis.
+    Without Redis every process counts on its own, so the limit holds per process until Redis is back.
+    """
+
+    def __init__(self, redis=redis_for_checks, window: int = 60, prefix: str = "rate-limit"):
+        self.redis = redis
+        self.window = window
+        self.prefix = prefix
+        self.local: Dict[str, Tuple[int, int]] = {}  # key -> (window index, points), the fallback without Redis
+        self.fallbacks = 0
+
+    async def hit(self, identity: str, cost: int, limit: int, now: Optional[float] = None) -> RateLimitDecision:
+        now = time.time() if now is None else now
+        index = int(now // self.window)
+        elapsed = (now % self.window) / self.window
+        weight = 1 - elapsed
+        keys = (f"{self.prefix}:{identity}:{index}", f"{self.prefix}:{identity}:{index - 1}")
+        try:
+            allowed, current, previous = await self.redis.eval(WINDOW_SCRIPT, 2, *keys, limit, cost, weight,
+                                                               self.window * 2)
+        except RedisError as e:
+            if not self.fallbacks:
+                print(f"[rate_limit] counting in this process, Redis failed: {e}")
+            self.fallbacks += 1
+            allowed, current, previous = self.hit_locally(keys, index, limit, cost, weight)
+        return self.decision(bool(allowed), int(current), int(previous), limit, cost, weight, elapsed)
+
+    def hit_locally(self, keys: Tuple[str, str], index: int, limit: int, cost: int,
+                    weight: float) -> Tuple[int, int, int]:
+        current = self.local.get(keys[0], (index, 0))[1]
+        previous = self.local.get(keys[1], (index - 1, 0))[1]
+        if previous * weight + current + cost > limit:
+            return 0, current, previous
+        current += cost
+        self.local[keys[0]] = (index, current)
+        if len(self.local) > 10_000:
+            # windows before the previous one don't count anymore
+            self.local = {key: entry for key, entry in self.local.items() if entry[0] >= index - 1}
+        return 1, current, previous
+
+    def decision(self, allowed: bool, current: int, previous: int, limit: int, cost: int, weight: float,
+                 elapsed: float) -> RateLimitDecision:
+        used = previous * weight + current
+        reset = max(math.ceil((1 - elapsed) * self.window), 1)
+        retry_after = 0
+        if not allowed:
+            if current + cost <= limit and previous:
+                # the previous window fades out until the cost fits
+                fits_at = 1 - (limit - current - cost) / previous
+                retry_after = max(math.ceil((fits_at - elapsed) * self.window), 1)
+            else:
+                retry_after = reset
+        return RateLimitDecision(allowed=allowed, limit=limit, remaining=max(limit - math.ceil(used), 0),
+                                 reset=reset, retry_after=retry_after, window=self.window)
+
+    def stats(self) -> dict:
+        return {"window": self.window, "fallbacks": self.fallbacks, "local_keys": len(self.local)}
+
+
+def utc_day(now: Optional[float] = None) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(now))
+
+
+def seconds_until_utc_midnight(now: Optional[float] = None) -> int:
+    now = time.time() if now is None else now
+    return max(math.ceil(86400 - now % 86400), 1)
+
+
+class DailyUsage:
+    """What a user used on a UTC day, e.g. LLM tokens or seconds of scans, of all processes"""
+
+    def __init__(self, redis=redis_for_checks, prefix: str = "usage"):
+        self.redis = redis
+        self.prefix = prefix
+        self.local: Dict[Tuple[str, str, str], float] = {}  # (kind, day, user) -> amount, while Redis is down
+
+    def key(self, kind: str, day: str) -> str:
+        return f"{self.prefix}:{kind}:{day}"
+
+    async def add(self, kind: str, user_id: int, amount: float):
+        day = utc_day()
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.hincrbyfloat(self.key(kind, day), str(user_id), amount)
+                pipe.expire(self.key(kind, day), 60 * 60 * 24 * 31)
+                await pipe.execute()
+        except RedisError as e:
+            print(f"[rate_limit] usage {kind} counted in this process: {e}")
+            if any(key[1] != day for key in self.local):
+                self.local = {key: value for key, value in self.local.items() if key[1] == day}
+            self.local[(kind, day, str(user_id))] = self.local.get((kind, day, str(user_id)), 0) + amount
+
+    async def get(self, kind: str, user_id: int, day: Optional[str] = None) -> float:
+        day = day or utc_day()
+        local = self.local.get((kind, day, str(user_id)), 0)
+        try:
+            return float(await self.redis.hget(self.key(kind, day), str(user_id)) or 0) + local
+        except RedisError as e:
+            print(f"[rate_limit] usage {kind} of this process only: {e}")
+            return local
+
+
+rate_limiter = SlidingWindowLimiter(window=RATE_LIMIT_WINDOW)
+daily_usage = DailyUsage()
+
+
+async def enforce(request: Request, route: str, identity: str, cost: int, limit: int):
+    decision = await rate_limiter.hit(identity, cost, limit)
+    # the headers are added by RateLimitHeadersMiddleware, also to the responses the routes build themselves
+    request.state.rate_limit = decision
+    if not decision.allowed:
+        RATE_LIMITED.labels(route, "rate").inc()
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail=f"Too many requests, retry in {decision.retry_after}s",
+                            headers={"Retry-After": str(decision.retry_after)})
+
+
+async def charge_user(request: Request, route: str, user_id: int, cost: int):
+    """For routes whose cost depends on the request, a cost above the limit takes all points of the window"""
+    if RATE_LIMIT_ENABLED:
+        await enforce(request, route, f"user:{user_id}", min(cost, RATE_LIMIT_POINTS), RATE_LIMIT_POINTS)
+
+
+def rate_limit(route: str, cost: int):
+    """Dependency: the request costs `cost` of the user's points in the window"""
+
+    async def limit_user(request: Request, user: TokenDataFulfilled = Depends(verify_jwt)):
+        await charge_user(request, route, user.sub, cost)
+
+    return limit_user
+
+
+def rate_limit_anonymous(route: str, cost: int):
+    """Dependency: the request costs `cost` of the client address's points in the window"""
+
+    async def limit_client(request: Request):
+        if RATE_LIMIT_ENABLED:
+            # behind a proxy the address is the forwarded one if uvicorn runs with --proxy-headers
+            client = request.client.host if request.client else "unknown"
+            await enforce(request, route, f"ip:{client}", cost, RATE_LIMIT_ANONYMOUS_POINTS)
+
+    return limit_client
+
+
+async def enforce_quota(route: str, kind: str, limit: float, user_id: int):
+    """Rejects the request once the user used `limit` of `kind` today, 0 disables the quota"""
+    if not RATE_LIMIT_ENABLED or not limit:
+        return
+    used = await daily_usage.get(kind, user_id)
+    if used >= limit:
+        RATE_LIMITED.labels(route, kind).inc()
+        retry_after = seconds_until_utc_midnight()
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail=f"The daily quota of {kind} is used up ({used:.0f} of {limit:.0f})",
+                            headers={"Retry-After": str(retry_after)})
+
+
+def daily_quota(route: str, kind: str, limit: float):
+    """Dependency of enforce_quota()"""
+
+    async def check_quota(user: TokenDataFulfilled = Depends(verify_jwt)):
+        await enforce_quota(route, kind, limit, user.sub)
+
+    return check_quota
+
+
+class RateLimitHeadersMiddleware:
+    """Adds the RateLimit-* headers of the request's decision to its response"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                decision: Optional[RateLimitDecision] = scope.get("state", {}).get("rate_limit")
+                if decision is not None:
+                    headers = list(message.get("headers", []))
+                    headers.extend((name.lower().encode(), value.encode())
+                                   for name, value in decision.headers().items())
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
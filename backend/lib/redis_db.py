@@ -13,6 +13,10 @@ redis_for_session = aioredis.from_url(REDIS_URL+"/1",
                           password=REDIS_PASSWORD,
                           decode_responses=True)
 
+redis_for_checks = aioredis.from_url(REDIS_URL+"/2",
+                          password=REDIS_PASSWORD,
+                          decode_responses=True)
+
 
 # TODO: async def check_redis():
 #     try:
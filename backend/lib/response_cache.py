@@ -0,0 +1,93 @@
+import hashlib
+from typing import Dict, Optional, Sequence
+
+from fastapi import Request, Response
+from prometheus_client import Counter
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from starlette import status
+
+from constants import RESPONSE_CACHE_TTL
+from lib.compression import etag_without_encoding
+from lib.redis_db import redis_for_checks
+
+RESPONSE_CACHE_REQUESTS = Counter(
+    "planspiegel_response_cache_requests_total",
+    "Read-through response cache lookups by route and result (hit, miss)",
+    ["route", "result"],
+)
+
+
+class ResponseCache:
+    """
+    Read-through cache of serialized API responses in Redis.
+
+    Every entry is a hash with the JSON body and the fields needed to authorize
+    the request without Postgres. Writers invalidate the keys they touch,
+    Redis errors only make the cache fall back to the database.
+    """
+
+    def __init__(self, redis: Redis, ttl: int):
+        self.redis = redis
+        self.ttl = ttl
+
+    async def get(self, key: str, route: str | None = None) -> Optional[Dict[str, str]]:
+        """route labels the hit rate metric, lookups without a route aren't counted"""
+        try:
+            entry = await self.redis.hgetall(key)
+        except RedisError as e:
+            print(f"[response_cache] get {key} failed: {e}")
+            entry = None
+        if route is not None:
+            RESPONSE_CACHE_REQUESTS.labels(route, "hit" if entry else "miss").inc()
+        return entry or None
+
+    async def set(self, key: str, fields: Dict[str, str], ttl: int | None = None):
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                await pipe.delete(key).hset(key, mapping=fields).expire(key, ttl or self.ttl).execute()
+        except RedisError as e:
+            print(f"[response_cache] set {key} failed: {e}")
+
+    async def invalidate(self, *keys: str):
+        try:
+            await self.redis.delete(*keys)
+        except RedisError as e:
+            print(f"[response_cache] invalidate {keys} failed: {e}")
+
+
+def checkup_key(checkup_id: int) -> str:
+    return f"response:checkup:{checkup_id}"
+
+
+def check_key(check_id: int) -> str:
+    return f"response:check:{check_id}"
+
+
+def join_ids(ids: Sequence[int]) -> str:
+    return ",".join(str(i) for i in ids)
+
+
+def split_ids(ids: str) -> list[int]:
+    return [int(i) for i in ids.split(",") if i]
+
+
+def etag_for(body: str | bytes) -> str:
+    return f'"{hashlib.sha1(body if isinstance(body, bytes) else body.encode()).hexdigest()}"'
+
+
+def json_response_with_etag(request: Request, body: str | bytes, etag: str | None = None) -> Response:
+    """JSON response from an already serialized body, 304 if the client has this version"""
+    etag = etag or etag_for(body)
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*":
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    # weak comparison, compressed responses carry W/ and the encoding in the tag
+    for client_etag in if_none_match.split(","):
+        if etag_without_encoding(client_etag) == etag:
+            # the tag of the representation the client has, compressed or not
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": client_etag.strip()})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+response_cache = ResponseCache(redis_for_checks, ttl=RESPONSE_CACHE_TTL)
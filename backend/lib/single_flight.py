@@ -0,0 +1,215 @@
+import asyncio
+import json
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from constants import SINGLE_FLIGHT_LOCK_TTL, SINGLE_FLIGHT_RESULT_TTL
+from lib.metrics import SINGLE_FLIGHT_RUNS
+from lib.redis_db import redis_for_checks
+from lib.utils import extract_hostname
+
+
+class SingleFlightError(Exception):
+    pass
+
+
+def flight_key(check_type: str, url: str) -> str:
+    hostname = (extract_hostname(url) or url).lower().rstrip(".")
+    return f"single-flight:{check_type}:{hostname}"
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent executions.
+
+    The first caller of a key becomes the leader: it holds a Redis lock and
+    runs the work. Callers in the same process attach to the leader's future,
+    callers in other workers poll Redis for the leader's outcome.
+    """
+
+    def __init__(self, redis: Redis, lock_ttl: int, result_ttl: int, poll_interval: float = 1.0):
+        self.redis = redis
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.local: Dict[str, asyncio.Future] = {}
+        self.waiting: Dict[str, int] = {}  # callers in this process attached to a local execution
+        self.led: Dict[str, int] = {}
+        self.coalesced: Dict[str, int] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]],
+                 on_follow: Optional[Callable[[], Awaitable[None]]] = None) -> Tuple[Any, bool]:
+        """
+        Runs fn() once per key across all workers.
+
+        Returns the outcome and whether this caller ran fn itself.
+        on_follow is awaited as soon as the caller knows it only waits for another execution.
+        A cancelled leader cancels fn() only if no other caller waits for it.
+        """
+        local = self.local.get(key)
+        if local is not None:
+            self._count(self.coalesced, key, "coalesced")
+            if on_follow is not None:
+                await on_follow()
+            return await self._wait_local(key, local), False
+
+        future = asyncio.get_running_loop().create_future()
+        self.local[key] = future
+        try:
+            token = uuid.uuid4().hex
+            leader_token = await self._acquire(key, token)
+        except RedisError as e:
+            # callers in this process still share the execution
+            print(f"[single_flight] {key} runs without coalescing across workers: {e}")
+            token = leader_token = None
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+
+        if leader_token == token:
+            self._count(self.led, key, "led")
+            # its own task, so the execution outlives a cancelled leader while others wait for it
+            run = asyncio.create_task(self._lead(key, token, fn))
+            run.add_done_callback(lambda _: self._resolve(key, future, run))
+            try:
+                return await asyncio.shield(run), True
+            except asyncio.CancelledError:
+                if not run.done() and not await self._has_followers(key, token):
+                    run.cancel()
+                    await asyncio.gather(run, return_exceptions=True)
+                raise
+
+        self._count(self.coalesced, key, "coalesced")
+        try:
+            if on_follow is not None:
+                await on_follow()
+            outcome = await self._follow(key, leader_token)
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._forget(key, future)
+        future.set_result(outcome)
+        return outcome, False
+
+    async def _wait_local(self, key: str, local: asyncio.Future) -> Any:
+        self.waiting[key] = self.waiting.get(key, 0) + 1
+        try:
+            return await asyncio.shield(local)
+        finally:
+            self.waiting[key] -= 1
+            if not self.waiting[key]:
+                del self.waiting[key]
+
+    async def _has_followers(self, key: str, token: Optional[str]) -> bool:
+        if self.waiting.get(key):
+            return True
+        if token is None:
+            return False
+        try:
+            return int(await self.redis.get(f"{key}:followers:{token}") or 0) > 0
+        except RedisError as e:
+            print(f"[single_flight] followers of {key} unknown: {e}")
+            return False
+
+    def _resolve(self, key: str, future: asyncio.Future, run: asyncio.Task):
+        if run.cancelled() or run.exception() is not None:
+            self._fail(key, future, asyncio.CancelledError() if run.cancelled() else run.exception())
+            return
+        self._forget(key, future)
+        future.set_result(run.result())
+
+    def _fail(self, key: str, future: asyncio.Future, e: BaseException):
+        self._forget(key, future)
+        future.set_exception(e if isinstance(e, Exception) else SingleFlightError("Execution was cancelled"))
+        # followers in this process consume the exception
+        future.exception()
+
+    def _forget(self, key: str, future: asyncio.Future):
+        if self.local.get(key) is future:
+            del self.local[key]
+
+    def stats(self) -> dict:
+        return {"led": dict(self.led), "coalesced": dict(self.coalesced)}
+
+    async def _acquire(self, key: str, token: str) -> str:
+        """Returns the token of the current leader"""
+        while True:
+            if await self.redis.set(f"{key}:lock", token, nx=True, ex=self.lock_ttl):
+                return token
+            leader_token = await self.redis.get(f"{key}:lock")
+            if leader_token is not None:
+                return leader_token
+            # lock expired in between, try again
+
+    async def _lead(self, key: str, token: Optional[str], fn: Callable[[], Awaitable[Any]]) -> Any:
+        if token is None:
+            # without the lock there is nobody in Redis to publish to
+            return await fn()
+        keep_alive = asyncio.create_task(self._keep_lock(key, token))
+        try:
+            outcome = await fn()
+        except BaseException as e:
+            await self._publish(key, token, {"error": str(e) or type(e).__name__})
+            raise
+        finally:
+            keep_alive.cancel()
+
+        await self._publish(key, token, {"outcome": outcome})
+        return outcome
+
+    async def _publish(self, key: str, token: str, payload: dict):
+        # result first, so a follower always finds the lock or the result
+        try:
+            await self.redis.set(f"{key}:result:{token}", json.dumps(payload), ex=self.result_ttl)
+            if await self.redis.get(f"{key}:lock") == token:
+                await self.redis.delete(f"{key}:lock")
+        except RedisError as e:
+            # the outcome of the leader doesn't depend on its followers in other workers
+            print(f"[single_flight] outcome of {key} not published: {e}")
+
+    async def _keep_lock(self, key: str, token: str):
+        while True:
+            await asyncio.sleep(self.lock_ttl / 3)
+            if await self.redis.get(f"{key}:lock") != token:
+                return
+            await self.redis.expire(f"{key}:lock", self.lock_ttl)
+
+    async def _follow(self, key: str, token: str) -> Any:
+        # the leader keeps the execution going for us if it is cancelled
+        followers = f"{key}:followers:{token}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.incr(followers)
+            # decremented when the follower stops, the expiry only cleans up after a crashed worker
+            pipe.expire(followers, 60 * 60)
+            await pipe.execute()
+        try:
+            return await self._poll(key, token)
+        finally:
+            await asyncio.shield(self.redis.decr(followers))
+
+    async def _poll(self, key: str, token: str) -> Any:
+        while True:
+            payload = await self.redis.get(f"{key}:result:{token}")
+            if payload is None and await self.redis.get(f"{key}:lock") != token:
+                # the leader may have published right after the first read
+                payload = await self.redis.get(f"{key}:result:{token}")
+                if payload is None:
+                    raise SingleFlightError("The execution this check was attached to has been lost")
+            if payload is not None:
+                data = json.loads(payload)
+                if "error" in data:
+                    raise SingleFlightError(data["error"])
+                return data["outcome"]
+            await asyncio.sleep(self.poll_interval)
+
+    @staticmethod
+    def _count(counter: Dict[str, int], key: str, role: str):
+        check_type = key.split(":")[1]
+        counter[check_type] = counter.get(check_type, 0) + 1
+        SINGLE_FLIGHT_RUNS.labels(check_type, role).inc()
+
+
+single_flight = SingleFlight(redis_for_checks, lock_ttl=SINGLE_FLIGHT_LOCK_TTL, result_ttl=SINGLE_FLIGHT_RESULT_TTL)
@@ -0,0 +1,327 @@
+import base64
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import BinaryIO, Optional
+
+from fastapi import HTTPException, UploadFile, status
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from constants import STORAGE_BACKEND, STORAGE_BUCKET, GCS_CREDENTIALS_FILE, STORAGE_LOCAL_DIRECTORY, \
+    STORAGE_PUBLIC_URL, ATTACHMENT_MAX_BYTES, MINIO_ENDPOINT_URL, MINIO_ACCESS_KEY, MINIO_SECRET_KEY, MINIO_SECURE, \
+    IMAGE_PREPROCESS_ENABLED
+from lib.images import VARIANT, prepare_image_in_pool
+from lib.tracing import run_in_executor
+
+CHUNK_BYTES = 1024 * 1024
+# uploads up to this size stay in memory while they are hashed
+SPOOL_BYTES = 1024 * 1024
+# room for the other fields of a form with an attachment
+FORM_FIELDS_BYTES = 1024 * 1024
+# attachments are images for the model, anything else (html, svg) could run scripts where it is served
+IMAGE_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+
+
+@dataclass
+class StoredAttachment:
+    key: str
+    url: str
+    size: int
+    content_type: str
+    # the same content was stored before, nothing was uploaded
+    deduplicated: bool = False
+    # downscaled variant of an image for the model
+    model_url: Optional[str] = None
+
+
+class Storage(ABC):
+    """
+    Object storage for attachments. Keys are content hashes, so an object is never overwritten
+    with different content and a duplicate upload is skipped.
+    Methods are blocking, store_upload() runs them in the executor.
+    """
+    # the URLs can be downloaded by OpenAI, otherwise the model gets the image inline
+    reachable = True
+
+    def setup(self):
+        pass
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def put(self, key: str, file: BinaryIO, size: int, content_type: str):
+        ...
+
+    @abstractmethod
+    def read(self, key: str) -> bytes:
+        ...
+
+    @abstractmethod
+    def url(self, key: str) -> str:
+        ...
+
+
+class GcsStorage(Storage):
+    def __init__(self, bucket_name: str, credentials_file: str, public_url: str = ""):
+        self.bucket_name = bucket_name
+        self.credentials_file = credentials_file
+        self.public_url = public_url or f"https://storage.googleapis.com/{bucket_name}"
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        # the client reads the credentials file, only once it is needed
+        if self._bucket is None:
+            from google.cloud import storage
+            client = storage.Client.from_service_account_json(self.credentials_file)
+            self._bucket = client.bucket(self.bucket_name)
+        return self._bucket
+
+    def exists(self, key: str) -> bool:
+        return self.bucket.blob(key).exists()
+
+    def put(self, key: str, file: BinaryIO, size: int, content_type: str):
+        # resumable upload in chunks for big files
+        blob = self.bucket.blob(key, chunk_size=max(CHUNK_BYTES // (256 * 1024), 1) * 256 * 1024)
+        blob.upload_from_file(file, size=size, content_type=content_type, rewind=True)
+
+    def read(self, key: str) -> bytes:
+        return self.bucket.blob(key).download_as_bytes()
+
+    def url(self, key: str) -> str:
+        return f"{self.public_url}/{key}"
+
+
+class MinioStorage(Storage):
+    def __init__(self, endpoint: str, access_key: str, secret_key: str, bucket_name: str, secure: bool = False,
+                 public_url: str = ""):
+        self.endpoint = endpoint
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.bucket_name = bucket_name
+        self.secure = secure
+        self.public_url = public_url or f"{'https' if secure else 'http'}://{endpoint}/{bucket_name}"
+        # the endpoint is usually a container name, only a configured public URL is reachable
+        self.reachable = bool(public_url)
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from minio import Minio
+            self._client = Minio(self.endpoint, access_key=self.access_key, secret_key=self.secret_key,
+                                 secure=self.secure)
+        return self._client
+
+    def setup(self):
+        from minio.error import S3Error
+        try:
+            if not self.client.bucket_exists(self.bucket_name):
+                self.client.make_bucket(self.bucket_name)
+                print(f"[storage] bucket '{self.bucket_name}' created")
+        except S3Error as e:
+            if e.code != "BucketAlreadyOwnedByYou":
+                raise
+
+    def exists(self, key: str) -> bool:
+        from minio.error import S3Error
+        try:
+            self.client.stat_object(self.bucket_name, key)
+            return True
+        except S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchObject"):
+                return False
+            raise
+
+    def put(self, key: str, file: BinaryIO, size: int, content_type: str):
+        file.seek(0)
+        self.client.put_object(self.bucket_name, key, file, length=size, content_type=content_type,
+                               part_size=max(CHUNK_BYTES, 5 * 1024 * 1024))
+
+    def read(self, key: str) -> bytes:
+        response = self.client.get_object(self.bucket_name, key)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def url(self, key: str) -> str:
+        return f"{self.public_url}/{key}"
+
+
+class LocalStorage(Storage):
+    """Files in a directory, main.py serves them under /attachments"""
+
+    def __init__(self, directory: str, public_url: str = ""):
+        self.directory = directory
+        self.public_url = public_url or "/api/attachments"
+        self.reachable = bool(public_url)
+
+    def setup(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self.directory, key))
+
+    def put(self, key: str, file: BinaryIO, size: int, content_type: str):
+        file.seek(0)
+        # a complete file or none, concurrent uploads of the same content write the same bytes
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as target:
+            shutil.copyfileobj(file, target, CHUNK_BYTES)
+        os.replace(target.name, os.path.join(self.directory, key))
+
+    def read(self, key: str) -> bytes:
+        with open(os.path.join(self.directory, key), "rb") as f:
+            return f.read()
+
+    def url(self, key: str) -> str:
+        return f"{self.public_url}/{key}"
+
+
+class AttachmentFiles(StaticFiles):
+    """The files of LocalStorage, a browser shows them as images and never runs them as a page"""
+
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        response.headers["Content-Security-Policy"] = "default-src 'none'; sandbox"
+        return response
+
+
+class UploadLimitMiddleware:
+    """
+    Rejects multipart bodies above the attachment limit with 413 while they arrive.
+    Starlette receives and spools the whole form before the route runs, store_upload would be too late.
+    """
+
+    def __init__(self, app: ASGIApp, max_bytes: int = ATTACHMENT_MAX_BYTES + FORM_FIELDS_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        headers = Headers(scope=scope)
+        if scope["type"] != "http" or not headers.get("content-type", "").startswith("multipart/form-data"):
+            await self.app(scope, receive, send)
+            return
+
+        content_length = headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({"detail": f"The request is bigger than {self.max_bytes} bytes"},
+                                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            # without Content-Length, or a client that sends more than it announced
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                        detail=f"The request is bigger than {self.max_bytes} bytes")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def create_storage(backend: str) -> Storage:
+    match backend:
+        case "gcs":
+            return GcsStorage(STORAGE_BUCKET, GCS_CREDENTIALS_FILE, STORAGE_PUBLIC_URL)
+        case "minio":
+            return MinioStorage(MINIO_ENDPOINT_URL, MINIO_ACCESS_KEY, MINIO_SECRET_KEY, STORAGE_BUCKET, MINIO_SECURE,
+                                STORAGE_PUBLIC_URL)
+        case "local":
+            return LocalStorage(STORAGE_LOCAL_DIRECTORY, STORAGE_PUBLIC_URL)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+storage = create_storage(STORAGE_BACKEND)
+
+
+def attachment_key(digest: str, content_type: str) -> str:
+    """sha256 of the content plus the extension of its type, the uploaded filename is not trusted"""
+    return f"{digest}{IMAGE_EXTENSIONS[content_type]}"
+
+
+async def url_for_model(key: str, content_type: str) -> str:
+    """URL of a stored image for the model, a data URL while the storage can't be downloaded from outside"""
+    if storage.reachable:
+        return storage.url(key)
+    content = await run_in_executor(None, storage.read, key)
+    return f"data:{content_type};base64,{base64.b64encode(content).decode()}"
+
+
+async def store_upload(upload: UploadFile, max_bytes: int = ATTACHMENT_MAX_BYTES) -> Optional[StoredAttachment]:
+    """
+    Copies the upload in chunks into a spooled temporary file while hashing it. None for an empty upload.
+    The form was received completely before, max_bytes only bounds what is stored, UploadLimitMiddleware
+    bounds what is received.
+    """
+    content_type = (upload.content_type or "").lower()
+    if content_type not in IMAGE_EXTENSIONS:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail=f"Attachments are images: {', '.join(IMAGE_EXTENSIONS)}")
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as spool:
+        while chunk := await upload.read(CHUNK_BYTES):
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"The attachment is bigger than {max_bytes} bytes")
+            digest.update(chunk)
+            if size > SPOOL_BYTES:
+                # the spool is (or now rolls over to) a file on disk
+                await run_in_executor(None, spool.write, chunk)
+            else:
+                spool.write(chunk)
+        if size == 0:
+            return None
+
+        key = attachment_key(digest.hexdigest(), content_type)
+        deduplicated = await run_in_executor(None, storage.exists, key)
+        if not deduplicated:
+            await run_in_executor(None, storage.put, key, spool, size, content_type)
+        model_key, model_type = key, content_type
+        if IMAGE_PREPROCESS_ENABLED:
+            variant_key = await store_model_variant(digest.hexdigest(), spool)
+            if variant_key is not None:
+                model_key, model_type = variant_key, "image/webp"
+    return StoredAttachment(key=key, url=storage.url(key), size=size, content_type=content_type,
+                            deduplicated=deduplicated, model_url=await url_for_model(model_key, model_type))
+
+
+async def store_model_variant(digest: str, spool: BinaryIO) -> Optional[str]:
+    """
+    The variant is stored next to the original and made only once per content and settings.
+    Returns its key, None when the image couldn't be prepared.
+    """
+    key = f"{digest}.{VARIANT}.webp"
+    if await run_in_executor(None, storage.exists, key):
+        return key
+    spool.seek(0)
+    prepared = await prepare_image_in_pool(await run_in_executor(None, spool.read))
+    if prepared is None:
+        return None
+    await run_in_executor(None, storage.put, key, io.BytesIO(prepared.content), len(prepared.content),
+                          prepared.content_type)
+    return key
@@ -0,0 +1,84 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger("planspiegel.tracing")
+
+
+@dataclass
+class Span:
+    """OpenTelemetry-like span: one timed stage of a trace"""
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    attributes: Dict[str, object] = field(default_factory=dict)
+    start: float = field(default_factory=time.time)
+    end: Optional[float] = None
+    status: str = "ok"
+    error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+
+current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+# finished spans, newest last
+recent_spans: deque[Span] = deque(maxlen=2000)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Starts a child of the current span (or a new trace).
+    The context is inherited by asyncio tasks, use run_in_executor() to carry it into threads.
+    """
+    parent = current_span.get()
+    new_span = Span(name=name,
+                    trace_id=parent.trace_id if parent else os.urandom(16).hex(),
+                    span_id=os.urandom(8).hex(),
+                    parent_id=parent.span_id if parent else None,
+                    attributes=attributes)
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.status = "error"
+        new_span.error = str(e) or type(e).__name__
+        raise
+    finally:
+        new_span.end = time.time()
+        current_span.reset(token)
+        recent_spans.append(new_span)
+        logger.debug(json.dumps(asdict(new_span), default=str))
+
+
+async def run_in_executor(executor, fn: Callable, *args):
+    """loop.run_in_executor that keeps the trace and records the worker part as a span"""
+    context = contextvars.copy_context()
+
+    def call():
+        with span(f"worker.{fn.__name__}", thread=threading.current_thread().name):
+            return fn(*args)
+
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, call)
+
+
+def spans_by_trace(limit: int = 50) -> Dict[str, list]:
+    traces: Dict[str, list] = {}
+    for finished in reversed(recent_spans):
+        if finished.trace_id not in traces:
+            if len(traces) >= limit:
+                continue
+            traces[finished.trace_id] = []
+        traces[finished.trace_id].append({**asdict(finished), "duration": finished.duration})
+    return traces
@@ -1,8 +1,11 @@
 import asyncio
 import base64
 import os
+import signal
+from typing import Dict, Optional, Tuple
 from urllib.parse import urljoin, urlparse
 
+import orjson
 from fastapi import UploadFile
 from pydantic import HttpUrl, ValidationError
 
@@ -53,9 +56,43 @@ def run_async_in_sync(coro, *args, **kwargs):
     return asyncio.run(coro(*args, **kwargs))
 
 
+async def communicate_or_kill(process: asyncio.subprocess.Process) -> Tuple[bytes, bytes]:
+    """
+    process.communicate(), if the caller is cancelled the process is killed with all its children.
+    The process must be started with start_new_session=True, its group is killed.
+    """
+    try:
+        return await process.communicate()
+    except asyncio.CancelledError:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await asyncio.shield(process.wait())
+        raise
+
+
 async def get_base64_from_upload(file: UploadFile):
     file_content = await file.read()
     if file_content:
         base64_string = base64.b64encode(file_content).decode("utf-8")
         return f"data:{file.content_type};base64,{base64_string}"
     return None
+
+
+def dumps_with_raw_json(data: dict, raw_fields: Dict[str, Optional[str | bytes]]) -> bytes:
+    """
+    orjson.dumps(data) plus fields whose values are already serialized JSON,
+    e.g. the text of a JSON column, so they are sent without decoding and re-encoding
+    """
+    body = orjson.dumps(data)
+    parts = [body[:-1]]
+    for i, (name, raw) in enumerate(raw_fields.items()):
+        separator = b"," if len(body) > 2 or i > 0 else b""
+        if raw is None:
+            raw = b"null"
+        elif isinstance(raw, str):
+            raw = raw.encode()
+        parts.append(separator + orjson.dumps(name) + b":" + raw)
+    parts.append(b"}")
+    return b"".join(parts)
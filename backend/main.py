@@ -1,32 +1,70 @@
 from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Response, APIRouter, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from redis.exceptions import RedisError
-from sqlalchemy.sql import text
 from starlette.middleware.sessions import SessionMiddleware
 
+from ai.agent import close_openai_clients
+from ai.answer_cache import answer_cache
+from ai.batch import router as batch_router
 from ai.chat import router as chat_router
+from ai.gateway import llm_gateway
+from ai.providers import llm_providers
+from ai.summary import checkup_summaries
 # routers
-from auth import router as auth_router
+from auth import router as auth_router, verify_internal
 from checks.cookies import router as cookies_router
 from checks.lighthouse import router as lighthouse_router
 from checks.network import router as network_router
 from checks.scan_ports import router as scan_ports_router
 from checks.technologies import router as technologies_router
-from constants import SESSION_SECRET_KEY
-# from lib.minio_storage import setup_minio
+from monitoring import router as monitoring_router
+from constants import SESSION_SECRET_KEY, COMPRESSION_MINIMUM_SIZE, COMPRESSION_GZIP_LEVEL, \
+    COMPRESSION_BROTLI_QUALITY, COMPRESSION_EXECUTOR_MIN_SIZE, LOOP_MONITOR_ENABLED, LOOP_MONITOR_STRICT, \
+    LOOP_MONITOR_THRESHOLD, CHECK_ABANDONED_HOURS
+from lib.admission import admission
+from lib.cancellation import checkup_cancellation
+from lib.compression import CompressionMiddleware
+from lib.images import shutdown_image_pool
+from lib.loop_monitor import loop_monitor, LoopMonitorMiddleware
+from lib.rate_limit import rate_limiter, RateLimitHeadersMiddleware
 # dbs
-from lib.postgres_db import yield_db
-from lib.redis_db import redis_for_token_cancellation, redis_for_session
+from lib.postgres_db import ping_db, db_session
+from lib.redis_db import redis_for_token_cancellation, redis_for_session, redis_for_checks
+from lib.single_flight import single_flight
+from lib.storage import storage, LocalStorage, AttachmentFiles, UploadLimitMiddleware
+from lib.tracing import spans_by_trace, run_in_executor
+from models import db_fail_abandoned_checks
+
+
+async def fail_abandoned_checks():
+    try:
+        async with db_session() as db:
+            failed = await db_fail_abandoned_checks(datetime.now() - timedelta(hours=CHECK_ABANDONED_HOURS), db=db)
+        if failed:
+            print(f"[fail_abandoned_checks] {failed} checks older than {CHECK_ABANDONED_HOURS}h failed")
+    except Exception as e:
+        print(f"[fail_abandoned_checks] failed: {e}")
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     # Start-up
-    # setup_minio()
+    await run_in_executor(None, storage.setup)
+    await fail_abandoned_checks()
+    if LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+    checkup_cancellation.start()
     yield
     # Shutdown
+    await checkup_cancellation.stop()
+    await loop_monitor.stop()
+    shutdown_image_pool()
+    await close_openai_clients()
 
 
 app = FastAPI(
@@ -41,6 +79,7 @@ app = FastAPI(
     docs_url="/docs",
     openapi_url="/api/openapi.json",
     root_path="/api",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -59,12 +98,30 @@ origins = [
     "https://planspiegel.com:8000"
 ]
 
+# innermost, the route of a request is known once the router matched it
+app.add_middleware(LoopMonitorMiddleware, strict=LOOP_MONITOR_STRICT, threshold=LOOP_MONITOR_THRESHOLD)
+
+# attachments above the limit are rejected while they arrive, not after the form was spooled
+app.add_middleware(UploadLimitMiddleware)
+
+# the RateLimit-* headers of the rate limited routes, also on the responses the routes build themselves
+app.add_middleware(RateLimitHeadersMiddleware)
+
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=COMPRESSION_MINIMUM_SIZE,
+    gzip_level=COMPRESSION_GZIP_LEVEL,
+    brotli_quality=COMPRESSION_BROTLI_QUALITY,
+    executor_minimum_size=COMPRESSION_EXECUTOR_MIN_SIZE,
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["GET", "HEAD", "PUT", "PATCH", "POST", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["RateLimit-Limit", "RateLimit-Remaining", "RateLimit-Reset", "RateLimit-Policy", "Retry-After"],
 )
 
 if not SESSION_SECRET_KEY:
@@ -81,13 +138,12 @@ def read_root():
 async def healthz():
     try:
         # Check connection for PostgreSQL
-        async for session in yield_db():
-            await session.execute(text("SELECT 1"))
-            break
+        await ping_db()
 
         # Check connection for Redis
         await redis_for_session.ping()
         await redis_for_token_cancellation.ping()
+        await redis_for_checks.ping()
 
         return {"status": "ok"}
     except RedisError as redis_error:
@@ -96,10 +152,76 @@ async def healthz():
         return {"status": "error", "service": "postgres", "details": str(postgres_error)}
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+# stats of this process, for operators only
+internal = APIRouter(dependencies=[Depends(verify_internal)])
+
+
+@internal.get("/traces", description="spans of the latest traces, newest first")
+async def traces(limit: int = 50):
+    return spans_by_trace(limit)
+
+
+@internal.get("/admission", description="live slot usage and queue depth per check type")
+async def admission_stats():
+    return admission.stats()
+
+
+@internal.get("/cancellation", description="checks of this process by checkup and how many were cancelled")
+async def cancellation_stats():
+    return checkup_cancellation.stats()
+
+
+@internal.get("/loop-monitor", description="event loop lag and the latest callbacks that blocked the loop, with stacks")
+async def loop_monitor_stats():
+    return loop_monitor.stats()
+
+
+@internal.get("/answer-cache", description="entries and hit rate of the chat answer cache")
+async def answer_cache_stats():
+    return answer_cache.stats()
+
+
+@internal.get("/summaries", description="batched checkup summaries: waiting checkups, tokens and seconds of the last")
+async def summaries_stats():
+    return checkup_summaries.stats()
+
+
+@internal.get("/llm-gateway", description="queued LLM requests by priority, waits, retries and tokens")
+async def llm_gateway_stats():
+    return llm_gateway.stats()
+
+
+@internal.get("/llm-providers", description="completions, errors, hedges and first token latency by provider")
+async def llm_providers_stats():
+    return llm_providers.stats()
+
+
+@internal.get("/rate-limit", description="window of the rate limiter and how often it counted without Redis")
+async def rate_limit_stats():
+    return rate_limiter.stats()
+
+
+@internal.get("/single-flight", description="how many check runs were executed and how many were coalesced")
+async def single_flight_stats():
+    return single_flight.stats()
+
+
+app.include_router(internal, tags=["internal"])
 app.include_router(auth_router, prefix="/auth", tags=["auth"])
 app.include_router(cookies_router, prefix="/checks", tags=["checks"])
 app.include_router(scan_ports_router, prefix="/checks", tags=["checks"])
 app.include_router(lighthouse_router, prefix="/checks", tags=["checks"])
 app.include_router(technologies_router, prefix="/checks", tags=["checks"])
 app.include_router(network_router, prefix="/checks", tags=["checks"])
+app.include_router(batch_router, tags=["chat"])
 app.include_router(chat_router, tags=["chat"])
+app.include_router(monitoring_router, prefix="/monitoring", tags=["monitoring"])
+
+if isinstance(storage, LocalStorage):
+    # the other backends serve the attachments themselves
+    app.mount("/attachments", AttachmentFiles(directory=storage.directory, check_dir=False), name="attachments")
@@ -0,0 +1,26 @@
+"""Check status queued
+
+Revision ID: a3c1f2d4e5b6
+Revises: 6461ffb796f6
+Create Date: 2026-10-19 10:12:41.218331
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3c1f2d4e5b6'
+down_revision: Union[str, None] = '6461ffb796f6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TYPE checkstatus ADD VALUE IF NOT EXISTS 'QUEUED' AFTER 'CREATED'")
+
+
+def downgrade() -> None:
+    # PostgreSQL can't drop a value from an enum, queued checks fall back to created
+    op.execute("UPDATE checks SET status = 'CREATED' WHERE status = 'QUEUED'")
@@ -0,0 +1,30 @@
+"""Checkup recheck: previous checkup and check results diff
+
+Revision ID: b7d2e9f1c3a8
+Revises: a3c1f2d4e5b6
+Create Date: 2026-10-19 13:05:17.402918
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7d2e9f1c3a8'
+down_revision: Union[str, None] = 'a3c1f2d4e5b6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('checkups', sa.Column('previous_checkup_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('checkups_previous_checkup_id_fkey', 'checkups', 'checkups',
+                          ['previous_checkup_id'], ['checkup_id'])
+    op.add_column('checks', sa.Column('results_diff', sa.JSON(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('checks', 'results_diff')
+    op.drop_constraint('checkups_previous_checkup_id_fkey', 'checkups', type_='foreignkey')
+    op.drop_column('checkups', 'previous_checkup_id')
@@ -0,0 +1,40 @@
+"""Monitoring schedules
+
+Revision ID: c4e8a1b2d9f7
+Revises: b7d2e9f1c3a8
+Create Date: 2026-10-19 15:42:03.118764
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e8a1b2d9f7'
+down_revision: Union[str, None] = 'b7d2e9f1c3a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('monitoring_schedules',
+        sa.Column('schedule_id', sa.Integer(), nullable=False),
+        sa.Column('url', sa.String(), nullable=False),
+        sa.Column('interval', sa.Enum('DAILY', 'WEEKLY', name='monitoringinterval'), nullable=False),
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('is_active', sa.Boolean(), nullable=False),
+        sa.Column('next_run_at', sa.DateTime(), nullable=False),
+        sa.Column('last_run_at', sa.DateTime(), nullable=True),
+        sa.Column('last_checkup_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.user_id'], ),
+        sa.ForeignKeyConstraint(['last_checkup_id'], ['checkups.checkup_id'], ),
+        sa.PrimaryKeyConstraint('schedule_id')
+    )
+    op.create_index('ix_monitoring_schedules_due', 'monitoring_schedules', ['is_active', 'next_run_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_monitoring_schedules_due', table_name='monitoring_schedules')
+    op.drop_table('monitoring_schedules')
+    sa.Enum(name='monitoringinterval').drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,38 @@
+"""Checkup batches
+
+Revision ID: d5f9b3c7e1a2
+Revises: c4e8a1b2d9f7
+Create Date: 2026-10-19 17:20:48.905316
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5f9b3c7e1a2'
+down_revision: Union[str, None] = 'c4e8a1b2d9f7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('checkup_batches',
+        sa.Column('batch_id', sa.Integer(), nullable=False),
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('total_checkups', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.user_id'], ),
+        sa.PrimaryKeyConstraint('batch_id')
+    )
+    op.add_column('checkups', sa.Column('batch_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('checkups_batch_id_fkey', 'checkups', 'checkup_batches', ['batch_id'], ['batch_id'])
+    op.create_index('ix_checkups_batch_id', 'checkups', ['batch_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_checkups_batch_id', table_name='checkups')
+    op.drop_constraint('checkups_batch_id_fkey', 'checkups', type_='foreignkey')
+    op.drop_column('checkups', 'batch_id')
+    op.drop_table('checkup_batches')
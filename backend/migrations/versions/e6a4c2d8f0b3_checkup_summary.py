@@ -0,0 +1,25 @@
+"""Checkup summary: executive summary over all checks of a checkup
+
+Revision ID: e6a4c2d8f0b3
+Revises: d5f9b3c7e1a2
+Create Date: 2026-10-19 16:42:08.519306
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'e6a4c2d8f0b3'
+down_revision: Union[str, None] = 'd5f9b3c7e1a2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('checkups', sa.Column('summary', sa.Text(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('checkups', 'summary')
@@ -0,0 +1,26 @@
+"""Check status cancelled
+
+Revision ID: f7b5d3e9a1c4
+Revises: e6a4c2d8f0b3
+Create Date: 2026-10-19 18:03:27.604112
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f7b5d3e9a1c4'
+down_revision: Union[str, None] = 'e6a4c2d8f0b3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TYPE checkstatus ADD VALUE IF NOT EXISTS 'CANCELLED' AFTER 'FAILED'")
+
+
+def downgrade() -> None:
+    # PostgreSQL can't drop a value from an enum, cancelled checks fall back to failed
+    op.execute("UPDATE checks SET status = 'FAILED' WHERE status = 'CANCELLED'")
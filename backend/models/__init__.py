@@ -3,3 +3,5 @@ from .check import *
 from .checkup import *
 from .message import *
 from .user import *
+from .monitoring import *
+from .batch import *
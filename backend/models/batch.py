@@ -0,0 +1,119 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from pydantic import BaseModel, ConfigDict
+from sqlalchemy import Column, ForeignKey, Integer, select, DateTime, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped
+
+from lib.postgres_db import Base
+from models import CheckupDB, CheckDB, ChatDB, CheckType, CheckStatus
+
+
+class CheckupBatch(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    batch_id: int
+    owner_id: int
+    created_at: datetime
+    total_checkups: int
+
+
+class CheckupBatchProgress(BaseModel):
+    batch_id: int
+    created_at: datetime
+    total_checkups: int
+    # checkups whose checks are all completed or failed
+    finished_checkups: int
+    checks: Dict[CheckStatus, int]
+    checkup_ids: List[int]
+    is_finished: bool
+
+
+class CheckupBatchDB(Base):
+    __tablename__ = "checkup_batches"
+    batch_id: Mapped[int] = Column(Integer, primary_key=True)
+    owner_id: Mapped[int] = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    created_at: Mapped[datetime] = Column(DateTime, nullable=False)
+    total_checkups: Mapped[int] = Column(Integer, nullable=False)
+
+    def to_pydantic(self) -> CheckupBatch:
+        return CheckupBatch.model_validate(self)
+
+
+async def db_save_checkup_batch(owner_id: int, urls: List[str],
+                                db: AsyncSession) -> Tuple[CheckupBatch, List[Tuple[CheckupDB, List[CheckDB]]]]:
+    """Saves a batch with a checkup per url, their queued checks and chats in one transaction.
+
+    Checkups, checks and chats are bulk inserted, one statement each.
+
+    Args:
+        owner_id: user that starts the batch
+        urls: urls to check
+        db: A database session object.
+
+    Raises:
+        Exception: If an error occurs while saving the batch.
+    """
+    now = datetime.now()
+    try:
+        batch = CheckupBatchDB(owner_id=owner_id, created_at=now, total_checkups=len(urls))
+        db.add(batch)
+        await db.flush()
+
+        checkups = (await db.scalars(
+            insert(CheckupDB).returning(CheckupDB, sort_by_parameter_order=True),
+            [{"url": url, "owner_id": owner_id, "batch_id": batch.batch_id, "created_at": now} for url in urls],
+        )).all()
+        checks = (await db.scalars(
+            insert(CheckDB).returning(CheckDB, sort_by_parameter_order=True),
+            [{"check_type": check_type, "checkup_id": checkup.checkup_id, "status": CheckStatus.QUEUED}
+             for checkup in checkups for check_type in CheckType],
+        )).all()
+        await db.execute(insert(ChatDB), [{"check_id": check.check_id} for check in checks])
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        raise Exception(f"Error saving checkup batch: {e}") from e
+
+    checks_by_checkup = defaultdict(list)
+    for check in checks:
+        checks_by_checkup[check.checkup_id].append(check)
+    return batch.to_pydantic(), [(checkup, checks_by_checkup[checkup.checkup_id]) for checkup in checkups]
+
+
+async def db_checkup_batch_by_id(batch_id: int, db: AsyncSession) -> CheckupBatch | None:
+    result = await db.execute(select(CheckupBatchDB).where(CheckupBatchDB.batch_id == batch_id))
+    batch_dbo = result.scalars().first()
+    return batch_dbo.to_pydantic() if batch_dbo else None
+
+
+async def db_check_statuses_by_batch_id(batch_id: int, db: AsyncSession) -> Dict[int, List[CheckStatus]]:
+    """Check statuses of every checkup of the batch, by checkup_id"""
+    result = await db.execute(
+        select(CheckupDB.checkup_id, CheckDB.status)
+        .join(CheckDB, CheckDB.checkup_id == CheckupDB.checkup_id)
+        .where(CheckupDB.batch_id == batch_id)
+        .order_by(CheckupDB.checkup_id)
+    )
+    statuses = defaultdict(list)
+    for checkup_id, check_status in result.all():
+        statuses[checkup_id].append(check_status)
+    return dict(statuses)
+
+
+def batch_progress(batch: CheckupBatch, statuses: Dict[int, List[CheckStatus]]) -> CheckupBatchProgress:
+    finished = sum(all(check_status.is_final for check_status in checks) for checks in statuses.values())
+    counts = defaultdict(int)
+    for checks in statuses.values():
+        for check_status in checks:
+            counts[check_status] += 1
+    return CheckupBatchProgress(
+        batch_id=batch.batch_id,
+        created_at=batch.created_at,
+        total_checkups=batch.total_checkups,
+        finished_checkups=finished,
+        checks=counts,
+        checkup_ids=list(statuses),
+        is_finished=finished == batch.total_checkups,
+    )
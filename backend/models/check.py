@@ -2,12 +2,14 @@ from enum import Enum
 from typing import Optional
 
 from pydantic import BaseModel, ConfigDict
-from sqlalchemy import Column, JSON, ForeignKey, Enum as SqlEnum, Integer, select, String
+from sqlalchemy import Column, JSON, ForeignKey, Enum as SqlEnum, Integer, select, String, cast, Text, Row, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship, Mapped
 
 from lib.postgres_db import Base
-from models import Chat
+from lib.response_cache import response_cache, check_key, checkup_key
+from lib.utils import dumps_with_raw_json
+from models import Chat, ChatDB
 
 
 class CheckType(str, Enum):
@@ -20,12 +22,18 @@ class CheckType(str, Enum):
 
 class CheckStatus(str, Enum):
     """
-    created -> running -> done || failed
+    created -> queued -> running -> done || failed || cancelled
     """
     CREATED = "created"
+    QUEUED = "queued"
     RUNNING = "running"
     COMPLETED = "completed"
     FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    @property
+    def is_final(self) -> bool:
+        return self in (CheckStatus.COMPLETED, CheckStatus.FAILED, CheckStatus.CANCELLED)
 
 
 class Check(BaseModel):
@@ -35,8 +43,12 @@ class Check(BaseModel):
     status: CheckStatus
     results: Optional[dict] = None
     results_description: Optional[str] = None
+    # recheck: changes against the same check of the previous checkup
+    results_diff: Optional[dict] = None
     checkup_id: Optional[int] = None
     chat: Optional[Chat] = None
+    # position in the admission queue while the check is QUEUED
+    queue_position: Optional[int] = None
 
 
 class CheckDB(Base):
@@ -46,6 +58,7 @@ class CheckDB(Base):
     status: Mapped[CheckStatus] = Column(SqlEnum(CheckStatus), nullable=False, default=CheckStatus.CREATED)
     results = Column(JSON)
     results_description: Mapped[str] = Column(String)
+    results_diff = Column(JSON)
     checkup_id: Mapped[int] = Column(Integer, ForeignKey("checkups.checkup_id"))
     checkup = relationship("CheckupDB", back_populates="checks")
     # CheckDB 1:1 ChatDB
@@ -75,52 +88,97 @@ async def db_save_check(check: CheckDB, db: AsyncSession) -> Check:
     return check.to_pydantic()
 
 
-async def db_complete_check_with_results(check: CheckDB, results, results_description: str, db: AsyncSession) -> Check:
-    """Update a check object to the database.
+async def db_update_unfinished_check(check: CheckDB, values: dict, db: AsyncSession) -> Check:
+    """Updates a check only while its status isn't final, e.g. a cancelled check stays cancelled.
 
     Args:
-        check: The CheckDB object to be saved.
-        results: check result
-        results_description: short version from LLM
+        check: The CheckDB object to be updated, it is refreshed with the stored row.
+        values: new column values
         db: A database session object.
 
     Raises:
         Exception: If an error occurs while updating the check.
     """
+    unfinished = [check_status for check_status in CheckStatus if not check_status.is_final]
     try:
-        check.results = results
-        check.results_description = results_description
-        check.status = CheckStatus.COMPLETED
-        db.add(check)
+        await db.execute(
+            update(CheckDB)
+            .where(CheckDB.check_id == check.check_id, CheckDB.status.in_(unfinished))
+            .values(**values)
+        )
         await db.commit()
+        db.add(check)
         await db.refresh(check)
     except Exception as e:
         raise Exception(f"Error updating check: {e}") from e
 
+    await response_cache.invalidate(check_key(check.check_id), checkup_key(check.checkup_id))
     return check.to_pydantic()
 
 
+async def db_update_check_status(check: CheckDB, check_status: CheckStatus, db: AsyncSession) -> Check:
+    """Update a check status in the database, a finished check keeps its status.
+
+    Args:
+        check: The CheckDB object to be updated.
+        check_status: new status
+        db: A database session object.
+    """
+    return await db_update_unfinished_check(check, {"status": check_status}, db=db)
+
+
+async def db_complete_check_with_results(check: CheckDB, results, results_description: str, db: AsyncSession,
+                                         results_diff: dict | None = None) -> Check:
+    """Update a check object to the database, unless it was cancelled or finished meanwhile.
+
+    Args:
+        check: The CheckDB object to be saved.
+        results: check result
+        results_description: short version from LLM
+        db: A database session object.
+        results_diff: changes against the previous run, only for rechecks
+    """
+    return await db_update_unfinished_check(check, {
+        "results": results,
+        "results_description": results_description,
+        "results_diff": results_diff,
+        "status": CheckStatus.COMPLETED,
+    }, db=db)
+
+
 async def db_complete_check_with_failure(check: CheckDB, failure, db: AsyncSession) -> Check:
-    """Update a check object to the database.
+    """Update a check object to the database, unless it was cancelled or finished meanwhile.
 
     Args:
         check: The CheckDB object to be saved.
         failure: exception
         db: A database session object.
+    """
+    return await db_update_unfinished_check(check, {"results": failure, "status": CheckStatus.FAILED}, db=db)
 
-    Raises:
-        Exception: If an error occurs while updating the check.
+
+async def db_cancel_checks(checkup_id: int, db: AsyncSession) -> int:
+    """Marks the unfinished checks of a checkup as cancelled.
+
+    Args:
+        checkup_id: The checkup whose checks are cancelled.
+        db: A database session object.
+
+    Returns:
+        The number of cancelled checks, finished ones keep their status.
     """
-    try:
-        check.results = failure
-        check.status = CheckStatus.FAILED
-        db.add(check)
-        await db.commit()
-        await db.refresh(check)
-    except Exception as e:
-        raise Exception(f"Error updating check: {e}") from e
+    unfinished = [check_status for check_status in CheckStatus if not check_status.is_final]
+    result = await db.execute(
+        update(CheckDB)
+        .where(CheckDB.checkup_id == checkup_id, CheckDB.status.in_(unfinished))
+        .values(status=CheckStatus.CANCELLED)
+        .returning(CheckDB.check_id)
+    )
+    check_ids = result.scalars().all()
+    await db.commit()
 
-    return check.to_pydantic()
+    await response_cache.invalidate(*[check_key(check_id) for check_id in check_ids], checkup_key(checkup_id))
+    return len(check_ids)
 
 
 async def db_check_by_id(check_id: int, db: AsyncSession) -> Check:
@@ -130,3 +188,40 @@ async def db_check_by_id(check_id: int, db: AsyncSession) -> Check:
     )
     check_dbo = result.scalars().first()
     return check_dbo.to_pydantic()
+
+
+# region RAW JSON
+def select_checks_json():
+    """Check columns with results as the stored JSON text, so they are never decoded"""
+    return (
+        select(CheckDB.check_id, CheckDB.check_type, CheckDB.status, CheckDB.results_description,
+               CheckDB.checkup_id, ChatDB.chat_id, cast(CheckDB.results, Text).label("results_json"),
+               cast(CheckDB.results_diff, Text).label("results_diff_json"))
+        .outerjoin(ChatDB, ChatDB.check_id == CheckDB.check_id)
+    )
+
+
+def check_row_to_json(row: Row, queue_position: Optional[int] = None) -> bytes:
+    """Same JSON as Check.model_dump_json(), built around the raw results"""
+    chat = {"chat_id": row.chat_id, "check_id": row.check_id, "messages": []} if row.chat_id is not None else None
+    return dumps_with_raw_json({
+        "check_id": row.check_id,
+        "check_type": row.check_type.value,
+        "status": row.status.value,
+        "results_description": row.results_description,
+        "checkup_id": row.checkup_id,
+        "chat": chat,
+        "queue_position": queue_position,
+    }, {"results": row.results_json, "results_diff": row.results_diff_json})
+
+
+async def db_check_json_row_by_id(check_id: int, db: AsyncSession) -> Row | None:
+    result = await db.execute(select_checks_json().where(CheckDB.check_id == check_id))
+    return result.first()
+
+
+async def db_check_json_rows_by_checkup_id(checkup_id: int, db: AsyncSession) -> list[Row]:
+    result = await db.execute(select_checks_json().where(CheckDB.checkup_id == checkup_id)
+                              .order_by(CheckDB.check_id))
+    return list(result.all())
+# endregion
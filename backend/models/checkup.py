@@ -2,12 +2,14 @@ from datetime import datetime
 from typing import Optional, List
 
 from pydantic import BaseModel, ConfigDict
-from sqlalchemy import Column, String, ForeignKey, Integer, select, DateTime
+from sqlalchemy import Column, String, ForeignKey, Integer, select, DateTime, Text, update, and_
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship, Mapped, joinedload
 
 from lib.postgres_db import Base
-from models import Check
+from lib.response_cache import response_cache, checkup_key, check_key
+from lib.utils import extract_hostname
+from models import Check, CheckDB, CheckStatus
 
 
 class Checkup(BaseModel):
@@ -15,17 +17,26 @@ class Checkup(BaseModel):
     url: str
     checkup_id: Optional[int] = None
     owner_id: Optional[int] = None
+    # recheck: the checkup of the same hostname the checks are compared with
+    previous_checkup_id: Optional[int] = None
+    # set for checkups started by POST /checkups/batch
+    batch_id: Optional[int] = None
     created_at: Optional[datetime] = None
+    # executive summary over all checks, from the batched summarisation
+    summary: Optional[str] = None
     checks: Optional[List[Check]] = None
 
 
 class CheckupDB(Base):
     __tablename__ = "checkups"
     checkup_id: Mapped[int] = Column(Integer, primary_key=True)
-    created_at: Mapped[datetime] = Column(DateTime, default=datetime.now(), nullable=False)
+    created_at: Mapped[datetime] = Column(DateTime, default=datetime.now, nullable=False)
     url: Mapped[str] = Column(String)
     owner_id: Mapped[int] = Column(Integer, ForeignKey("users.user_id"))
     owner = relationship("UserDB", back_populates="checkups")
+    previous_checkup_id: Mapped[int] = Column(Integer, ForeignKey("checkups.checkup_id"), nullable=True)
+    batch_id: Mapped[int] = Column(Integer, ForeignKey("checkup_batches.batch_id"), nullable=True, index=True)
+    summary: Mapped[str] = Column(Text, nullable=True)
     checks = relationship("CheckDB", back_populates="checkup", lazy="noload")
 
     def to_pydantic(self) -> Checkup:
@@ -33,7 +44,10 @@ class CheckupDB(Base):
             url=self.url,
             checkup_id=self.checkup_id,
             owner_id=self.owner_id,
+            previous_checkup_id=self.previous_checkup_id,
+            batch_id=self.batch_id,
             created_at=self.created_at,
+            summary=self.summary,
             checks=[check.to_pydantic() for check in self.checks] if self.checks else None,
         )
 
@@ -58,6 +72,25 @@ async def db_save_checkup(checkup: CheckupDB, db: AsyncSession) -> Checkup:
     return checkup.to_pydantic()
 
 
+async def db_update_checkup_summary(checkup_id: int, summary: str, db: AsyncSession):
+    """Saves the executive summary of a checkup.
+
+    Args:
+        checkup_id: the summarised checkup
+        summary: executive summary over all its checks
+        db: A database session object.
+
+    Raises:
+        Exception: If an error occurs while updating the checkup.
+    """
+    try:
+        await db.execute(update(CheckupDB).where(CheckupDB.checkup_id == checkup_id).values(summary=summary))
+        await db.commit()
+    except Exception as e:
+        raise Exception(f"Error updating checkup summary: {e}") from e
+    await response_cache.invalidate(checkup_key(checkup_id))
+
+
 async def db_checkups_by_user_id(user_id: int, db: AsyncSession) -> List[Checkup]:
     """Retrieves checkup objects for the user.
 
@@ -74,19 +107,88 @@ async def db_checkups_by_user_id(user_id: int, db: AsyncSession) -> List[Checkup
     return [checkup.to_pydantic() for checkup in checkup_dbos]
 
 
-async def db_checkup_by_id(checkup_id: int, db: AsyncSession) -> Checkup | None:
+async def db_checkup_by_id(checkup_id: int, db: AsyncSession, with_checks: bool = True) -> Checkup | None:
     """Retrieves checkup objects for the user.
 
     Args:
         checkup_id: user that checkups belong
         db: A database session object.
+        with_checks: load the checks with their results
     """
-    result = await db.execute(
-        select(CheckupDB)
-        .where(CheckupDB.checkup_id == checkup_id)
-        .options(joinedload(CheckupDB.checks)))
+    query = select(CheckupDB).where(CheckupDB.checkup_id == checkup_id)
+    if with_checks:
+        query = query.options(joinedload(CheckupDB.checks))
+    result = await db.execute(query)
     checkup_dbo = result.scalars().first()
     if checkup_dbo is None:
         return None
 
     return checkup_dbo.to_pydantic()
+
+
+async def db_checkup_owner_and_check(checkup_id: int, check_id: int, db: AsyncSession) -> tuple[int, bool] | None:
+    """Owner of the checkup and whether the check belongs to it, None if there is no such checkup.
+
+    Args:
+        checkup_id: checkup of the check
+        check_id: check that should belong to the checkup
+        db: A database session object.
+    """
+    result = await db.execute(
+        select(CheckupDB.owner_id, CheckDB.check_id)
+        .outerjoin(CheckDB, and_(CheckDB.checkup_id == CheckupDB.checkup_id, CheckDB.check_id == check_id))
+        .where(CheckupDB.checkup_id == checkup_id)
+    )
+    row = result.first()
+    if row is None:
+        return None
+    return row.owner_id, row.check_id is not None
+
+
+async def db_last_checkup_by_hostname(user_id: int, hostname: str, db: AsyncSession) -> Checkup | None:
+    """Retrieves the latest checkup of the user for the hostname, with its checks.
+
+    Args:
+        user_id: user that checkups belong
+        hostname: hostname of the checked url, e.g. planspiegel.com
+        db: A database session object.
+    """
+    result = await db.execute(
+        select(CheckupDB.checkup_id, CheckupDB.url)
+        .where(CheckupDB.owner_id == user_id, CheckupDB.url.contains(hostname))
+        # ids grow with the creation, also for rows of the same second
+        .order_by(CheckupDB.checkup_id.desc())
+    )
+    # contains() also matches e.g. a subdomain or the hostname in the path
+    for checkup_id, url in result.all():
+        if extract_hostname(url) == hostname:
+            return await db_checkup_by_id(checkup_id, db=db)
+    return None
+
+
+async def db_fail_abandoned_checks(created_before: datetime, db: AsyncSession) -> int:
+    """Marks the unfinished checks of checkups created before the time as failed.
+
+    A check stays queued or running when the process that ran it stopped, nothing would finish it.
+
+    Args:
+        created_before: checkups created earlier are not run anymore
+        db: A database session object.
+
+    Returns:
+        The number of failed checks.
+    """
+    unfinished = [check_status for check_status in CheckStatus if not check_status.is_final]
+    result = await db.execute(
+        update(CheckDB)
+        .where(CheckDB.status.in_(unfinished),
+               CheckDB.checkup_id.in_(select(CheckupDB.checkup_id).where(CheckupDB.created_at < created_before)))
+        .values(status=CheckStatus.FAILED, results={"exception": "abandoned, the process running it stopped"})
+        .returning(CheckDB.check_id, CheckDB.checkup_id)
+    )
+    rows = result.all()
+    await db.commit()
+
+    await response_cache.invalidate(*{key for row in rows for key in (check_key(row.check_id),
+                                                                      checkup_key(row.checkup_id))})
+    return len(rows)
@@ -0,0 +1,185 @@
+import random
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Optional, List
+
+from pydantic import BaseModel, ConfigDict
+from sqlalchemy import Column, String, ForeignKey, Integer, select, DateTime, Boolean, Enum as SqlEnum, func, Index
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped
+
+from lib.postgres_db import Base
+
+
+class MonitoringInterval(str, Enum):
+    DAILY = "daily"
+    WEEKLY = "weekly"
+
+    @property
+    def period(self) -> timedelta:
+        return timedelta(days=1) if self == MonitoringInterval.DAILY else timedelta(weeks=1)
+
+
+class MonitoringSchedule(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    schedule_id: int
+    url: str
+    interval: MonitoringInterval
+    owner_id: int
+    is_active: bool
+    next_run_at: datetime
+    last_run_at: Optional[datetime] = None
+    last_checkup_id: Optional[int] = None
+
+
+class MonitoringScheduleDB(Base):
+    __tablename__ = "monitoring_schedules"
+    schedule_id: Mapped[int] = Column(Integer, primary_key=True)
+    url: Mapped[str] = Column(String, nullable=False)
+    interval: Mapped[MonitoringInterval] = Column(SqlEnum(MonitoringInterval), nullable=False)
+    owner_id: Mapped[int] = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    is_active: Mapped[bool] = Column(Boolean, nullable=False, default=True)
+    next_run_at: Mapped[datetime] = Column(DateTime, nullable=False)
+    last_run_at: Mapped[datetime] = Column(DateTime, nullable=True)
+    last_checkup_id: Mapped[int] = Column(Integer, ForeignKey("checkups.checkup_id"), nullable=True)
+
+    # the scheduler looks up due schedules by this index
+    __table_args__ = (Index("ix_monitoring_schedules_due", "is_active", "next_run_at"),)
+
+    def to_pydantic(self) -> MonitoringSchedule:
+        return MonitoringSchedule.model_validate(self)
+
+
+def next_run_after(moment: datetime, interval: MonitoringInterval, jitter: timedelta) -> datetime:
+    """Next run one interval later, spread by a random jitter so schedules created together don't run together"""
+    return moment + interval.period + random.uniform(0, 1) * jitter
+
+
+async def db_save_monitoring_schedule(schedule: MonitoringScheduleDB, db: AsyncSession) -> MonitoringSchedule:
+    """Saves a monitoring schedule object to the database.
+
+    Args:
+        schedule: The MonitoringScheduleDB object to be saved.
+        db: A database session object.
+
+    Raises:
+        Exception: If an error occurs while saving the schedule.
+    """
+    try:
+        db.add(schedule)
+        await db.commit()
+        await db.refresh(schedule)
+    except Exception as e:
+        raise Exception(f"Error saving monitoring schedule: {e}") from e
+
+    return schedule.to_pydantic()
+
+
+async def db_delete_monitoring_schedule(schedule: MonitoringScheduleDB, db: AsyncSession):
+    """Deletes a monitoring schedule from the database.
+
+    Args:
+        schedule: The MonitoringScheduleDB object to be deleted.
+        db: A database session object.
+
+    Raises:
+        Exception: If an error occurs while deleting the schedule.
+    """
+    try:
+        await db.delete(schedule)
+        await db.commit()
+    except Exception as e:
+        raise Exception(f"Error deleting monitoring schedule: {e}") from e
+
+
+async def db_monitoring_schedules_by_user_id(user_id: int, db: AsyncSession) -> List[MonitoringSchedule]:
+    """Retrieves monitoring schedules of the user.
+
+    Args:
+        user_id: user that schedules belong
+        db: A database session object.
+    """
+    result = await db.execute(
+        select(MonitoringScheduleDB)
+        .where(MonitoringScheduleDB.owner_id == user_id)
+        .order_by(MonitoringScheduleDB.schedule_id)
+    )
+    return [schedule.to_pydantic() for schedule in result.scalars().all()]
+
+
+async def db_count_monitoring_schedules_by_user_id(user_id: int, db: AsyncSession) -> int:
+    result = await db.execute(select(func.count()).where(MonitoringScheduleDB.owner_id == user_id))
+    return result.scalar_one()
+
+
+async def db_monitoring_schedule_dbo_by_id(schedule_id: int, db: AsyncSession) -> MonitoringScheduleDB | None:
+    result = await db.execute(select(MonitoringScheduleDB).where(MonitoringScheduleDB.schedule_id == schedule_id))
+    return result.scalars().first()
+
+
+async def db_claim_due_monitoring_schedules(limit: int, jitter: timedelta,
+                                           db: AsyncSession) -> List[MonitoringSchedule]:
+    """Claims due schedules for one scheduler replica and moves them to their next run.
+
+    Rows are locked with FOR UPDATE SKIP LOCKED, so replicas claiming at the same time
+    get disjoint batches, and after the commit the claimed rows aren't due anymore.
+
+    Args:
+        limit: maximum schedules in the batch
+        jitter: maximum random delay added to the next run
+        db: A database session object.
+
+    Raises:
+        Exception: If an error occurs while claiming the schedules.
+    """
+    now = datetime.now()
+    try:
+        result = await db.execute(
+            select(MonitoringScheduleDB)
+            .where(MonitoringScheduleDB.is_active.is_(True), MonitoringScheduleDB.next_run_at <= now)
+            .order_by(MonitoringScheduleDB.next_run_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        schedule_dbos = result.scalars().all()
+        # copies before the update, next_run_at is the time the run was due
+        schedules = [schedule.to_pydantic() for schedule in schedule_dbos]
+        for schedule in schedule_dbos:
+            schedule.last_run_at = now
+            schedule.next_run_at = next_run_after(now, schedule.interval, jitter)
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        raise Exception(f"Error claiming monitoring schedules: {e}") from e
+
+    return schedules
+
+
+async def db_set_monitoring_schedule_checkup(schedule_id: int, checkup_id: int, db: AsyncSession):
+    """Remembers the checkup started by the latest run of the schedule.
+
+    Args:
+        schedule_id: schedule that started the checkup
+        checkup_id: the started checkup
+        db: A database session object.
+
+    Raises:
+        Exception: If an error occurs while updating the schedule.
+    """
+    try:
+        schedule = await db_monitoring_schedule_dbo_by_id(schedule_id, db=db)
+        if schedule is not None:
+            schedule.last_checkup_id = checkup_id
+            await db.commit()
+    except Exception as e:
+        raise Exception(f"Error updating monitoring schedule: {e}") from e
+
+
+async def db_count_due_monitoring_schedules(db: AsyncSession) -> int:
+    """Due schedules that no scheduler has claimed yet, the backlog of the scheduler"""
+    result = await db.execute(
+        select(func.count())
+        .select_from(MonitoringScheduleDB)
+        .where(MonitoringScheduleDB.is_active.is_(True), MonitoringScheduleDB.next_run_at <= datetime.now())
+    )
+    return result.scalar_one()
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from pydantic import BaseModel, Field
+
+from auth import verify_jwt, TokenDataFulfilled
+from constants import SCHEDULER_NEXT_RUN_JITTER_MINUTES, SCHEDULES_PER_USER, RATE_LIMIT_CHECKUP_COST, \
+    QUOTA_SCAN_MINUTES_PER_DAY
+from lib.postgres_db import yield_db
+from lib.rate_limit import charge_user, enforce_quota
+from lib.utils import extract_hostname
+from models import MonitoringSchedule, MonitoringScheduleDB, MonitoringInterval, db_save_monitoring_schedule, \
+    db_monitoring_schedules_by_user_id, db_monitoring_schedule_dbo_by_id, db_delete_monitoring_schedule, \
+    db_count_monitoring_schedules_by_user_id, next_run_after
+
+# Schedules are run by scheduler.py, a separate process
+
+
+# region Types
+class CreateScheduleRequest(BaseModel):
+    url: str = Field(default="https://planspiegel-landing.vercel.app/")
+    interval: MonitoringInterval = Field(default=MonitoringInterval.WEEKLY)
+    # first run right away instead of after one interval
+    run_now: bool = Field(default=False)
+
+
+class UpdateScheduleRequest(BaseModel):
+    interval: Optional[MonitoringInterval] = None
+    is_active: Optional[bool] = None
+
+
+# endregion
+
+# region Router
+router = APIRouter()
+
+
+async def assure_schedule_belongs_to_user(user_id: int, schedule_id: int, db) -> MonitoringScheduleDB:
+    schedule = await db_monitoring_schedule_dbo_by_id(schedule_id, db=db)
+    if schedule is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This schedule doesn't exist")
+    if schedule.owner_id != user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="This schedule belongs to the different user")
+    return schedule
+
+
+@router.post("/schedules", response_model=MonitoringSchedule, status_code=status.HTTP_201_CREATED,
+             description="re-scan the url daily or weekly")
+async def create_schedule(request: CreateScheduleRequest, http_request: Request,
+                          user: TokenDataFulfilled = Depends(verify_jwt), db=Depends(yield_db)):
+    if extract_hostname(request.url) is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid url: {request.url}")
+    if await db_count_monitoring_schedules_by_user_id(user.sub, db=db) >= SCHEDULES_PER_USER:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"At most {SCHEDULES_PER_USER} schedules per user")
+    if request.run_now:
+        # the first run is a checkup started right away
+        await enforce_quota("create_schedule", "scan_seconds", QUOTA_SCAN_MINUTES_PER_DAY * 60, user.sub)
+        await charge_user(http_request, "create_schedule", user.sub, RATE_LIMIT_CHECKUP_COST)
+
+    now = datetime.now()
+    next_run_at = now if request.run_now else next_run_after(
+        now, request.interval, timedelta(minutes=SCHEDULER_NEXT_RUN_JITTER_MINUTES))
+    schedule_dbo = MonitoringScheduleDB(url=request.url, interval=request.interval, owner_id=user.sub,
+                                        is_active=True, next_run_at=next_run_at)
+    return await db_save_monitoring_schedule(schedule_dbo, db=db)
+
+
+@router.get("/schedules", response_model=List[MonitoringSchedule])
+async def get_schedules(user: TokenDataFulfilled = Depends(verify_jwt), db=Depends(yield_db)):
+    return await db_monitoring_schedules_by_user_id(user.sub, db=db)
+
+
+@router.patch("/schedules/{schedule_id}", response_model=MonitoringSchedule,
+              description="change the interval or pause/resume the schedule")
+async def update_schedule(schedule_id: int, request: UpdateScheduleRequest,
+                          user: TokenDataFulfilled = Depends(verify_jwt), db=Depends(yield_db)):
+    schedule_dbo = await assure_schedule_belongs_to_user(user.sub, schedule_id, db)
+    if request.interval is not None and request.interval != schedule_dbo.interval:
+        schedule_dbo.interval = request.interval
+        schedule_dbo.next_run_at = next_run_after(schedule_dbo.last_run_at or datetime.now(), request.interval,
+                                                  timedelta(minutes=SCHEDULER_NEXT_RUN_JITTER_MINUTES))
+    if request.is_active is not None:
+        schedule_dbo.is_active = request.is_active
+    return await db_save_monitoring_schedule(schedule_dbo, db=db)
+
+
+@router.delete("/schedules/{schedule_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_schedule(schedule_id: int, user: TokenDataFulfilled = Depends(verify_jwt), db=Depends(yield_db)):
+    schedule_dbo = await assure_schedule_belongs_to_user(user.sub, schedule_id, db)
+    await db_delete_monitoring_schedule(schedule_dbo, db=db)
+
+# endregion
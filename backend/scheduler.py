@@ -0,0 +1,115 @@
+"""
+Monitoring scheduler, runs the due monitoring schedules as rechecks.
+
+    python scheduler.py
+
+Every replica claims its own batch of due schedules with FOR UPDATE SKIP LOCKED,
+so any number of replicas can run next to each other. Checks run in this process
+and wait for the same admission limits as checks started from the API.
+Metrics are served on SCHEDULER_METRICS_PORT.
+"""
+import asyncio
+import random
+import signal
+import time
+from datetime import datetime, timedelta
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from ai.chat import create_checkup, check_tasks
+from constants import SCHEDULER_TICK_SECONDS, SCHEDULER_BATCH_SIZE, SCHEDULER_BATCH_SPREAD_SECONDS, \
+    SCHEDULER_NEXT_RUN_JITTER_MINUTES, SCHEDULER_MAX_QUEUED_CHECKS, SCHEDULER_METRICS_PORT
+from lib.admission import admission
+from lib.cancellation import checkup_cancellation
+from lib.postgres_db import db_session
+from lib.tracing import span
+from models import MonitoringSchedule, db_claim_due_monitoring_schedules, db_set_monitoring_schedule_checkup, \
+    db_count_due_monitoring_schedules
+
+# region METRICS
+SCHEDULER_TICK_DURATION = Histogram("planspiegel_scheduler_tick_seconds",
+                                    "Time to claim a batch and start its checkups",
+                                    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120))
+SCHEDULER_RUN_DELAY = Histogram("planspiegel_scheduler_run_delay_seconds",
+                                "How late a scheduled run started compared to its next_run_at",
+                                buckets=(1, 10, 60, 300, 900, 3600, 6 * 3600, 24 * 3600))
+SCHEDULER_RUNS = Counter("planspiegel_scheduler_runs_total", "Scheduled checkups by result (started, failed)",
+                         ["result"])
+SCHEDULER_BACKLOG = Gauge("planspiegel_scheduler_backlog", "Due schedules not claimed by any replica yet")
+SCHEDULER_SKIPPED_TICKS = Counter("planspiegel_scheduler_skipped_ticks_total",
+                                  "Ticks without a new batch because too many checks wait for admission")
+
+
+# endregion
+
+
+def queued_checks() -> int:
+    return sum(slots["queued"] for slots in admission.stats().values())
+
+
+async def run_schedule(schedule: MonitoringSchedule):
+    SCHEDULER_RUN_DELAY.observe(max((datetime.now() - schedule.next_run_at).total_seconds(), 0))
+    try:
+        with span("scheduled_checkup", schedule_id=schedule.schedule_id):
+            async with db_session() as db:
+                checkup = await create_checkup(schedule.url, schedule.owner_id, recheck=True, db=db)
+                await db_set_monitoring_schedule_checkup(schedule.schedule_id, checkup.checkup_id, db=db)
+        SCHEDULER_RUNS.labels("started").inc()
+        print(f"[scheduler] schedule {schedule.schedule_id} started checkup {checkup.checkup_id}")
+    except Exception as e:
+        SCHEDULER_RUNS.labels("failed").inc()
+        print(f"[scheduler] schedule {schedule.schedule_id} failed: {e}")
+
+
+async def tick():
+    async with db_session() as db:
+        SCHEDULER_BACKLOG.set(await db_count_due_monitoring_schedules(db))
+
+    # backpressure: claimed schedules would only wait in the admission queue of this replica
+    if queued_checks() >= SCHEDULER_MAX_QUEUED_CHECKS:
+        SCHEDULER_SKIPPED_TICKS.inc()
+        return
+
+    with SCHEDULER_TICK_DURATION.time():
+        async with db_session() as db:
+            schedules = await db_claim_due_monitoring_schedules(
+                SCHEDULER_BATCH_SIZE, timedelta(minutes=SCHEDULER_NEXT_RUN_JITTER_MINUTES), db=db)
+
+        # spread the batch so its checks don't hit the targets and the scanners at the same moment
+        for schedule in schedules:
+            await run_schedule(schedule)
+            await asyncio.sleep(random.uniform(0, SCHEDULER_BATCH_SPREAD_SECONDS / max(len(schedules), 1)))
+
+
+async def main():
+    start_http_server(SCHEDULER_METRICS_PORT)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # scheduled checkups are cancelled by their users like any other
+    checkup_cancellation.start()
+    print(f"[scheduler] started, metrics on :{SCHEDULER_METRICS_PORT}")
+    while not stop.is_set():
+        started_at = time.monotonic()
+        try:
+            await tick()
+        except Exception as e:
+            print(f"[scheduler] tick failed: {e}")
+        # replicas started together drift apart
+        delay = SCHEDULER_TICK_SECONDS - (time.monotonic() - started_at) + random.uniform(0, 5)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=max(delay, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    # the started checks finish, their schedules are already moved to the next run
+    print(f"[scheduler] stopping, waiting for {len(check_tasks)} checks")
+    if check_tasks:
+        await asyncio.wait(list(check_tasks))
+    await checkup_cancellation.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
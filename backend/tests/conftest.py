@@ -0,0 +1,4 @@
+import os
+
+# requests of the tests (tests/test_main.py) fail when they block the event loop, see lib/loop_monitor.py
+os.environ.setdefault("LOOP_MONITOR_STRICT", "true")
@@ -0,0 +1,44 @@
+import asyncio
+from types import SimpleNamespace
+
+import ai.chat
+from lib.admission import CheckAdmission
+from models import CheckType
+
+
+class NotCancelled:
+    async def is_cancelled(self, checkup_id: int) -> bool:
+        return False
+
+
+class RunAlone:
+    """Single flight without other callers, fn runs in the caller"""
+
+    async def do(self, key, fn, on_follow=None):
+        return await fn(), True
+
+
+def test_check_cancelled_between_grant_and_resume_gives_its_slot_back(monkeypatch):
+    admission = CheckAdmission(capacity={"lighthouse": 1}, per_user=2)
+    monkeypatch.setattr(ai.chat, "admission", admission)
+    monkeypatch.setattr(ai.chat, "checkup_cancellation", NotCancelled())
+    monkeypatch.setattr(ai.chat, "single_flight", RunAlone())
+    check = SimpleNamespace(check_id=2, check_type=CheckType.LIGHTHOUSE)
+    checkup = SimpleNamespace(checkup_id=1, url="https://example.com")
+
+    async def run():
+        admission.enqueue("lighthouse", 1, 1)
+        slot = admission.enqueue("lighthouse", 1, 2)
+        task = asyncio.create_task(ai.chat.run_check_traced(check, checkup, 1, slot))
+        await asyncio.sleep(0)
+        assert admission.stats()["lighthouse"]["queued"] == 1
+        # the first check ends and grants its slot, the waiting check is cancelled before it resumes
+        admission.release("lighthouse", 1)
+        assert slot.done()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return task
+
+    assert asyncio.run(run()).cancelled()
+    assert admission.stats()["lighthouse"] == {"capacity": 1, "running": 0, "queued": 0}
+    assert admission.running_by_user == {}
@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+from ai.answer_cache import AnswerCache
+
+RESULTS = '{"open_ports": [22, 443]}'
+WORDS = ["which", "ports", "are", "open", "is", "my", "spf", "ok", "record", "valid", "the"]
+
+
+def bag_of_words(text: str) -> list[float]:
+    words = text.split()
+    return [float(words.count(word)) for word in WORDS]
+
+
+def ask(cache: AnswerCache, question: str, results: str = RESULTS):
+    return asyncio.run(cache.lookup("scan_ports", results, question))
+
+
+def answer(cache: AnswerCache, question: str, text: str, results: str = RESULTS, ttl: int | None = None):
+    asyncio.run(cache.store(ask(cache, question, results), text, ttl))
+
+
+def test_same_and_similar_questions_on_identical_results():
+    cache = AnswerCache(max_entries=10, ttl=60, similarity=0.8, embed=bag_of_words)
+    answer(cache, "Which ports are open?", "22 and 443")
+
+    assert ask(cache, "  which ports are OPEN ").answer == "22 and 443"
+    similar = ask(cache, "which ports are open ok")
+    assert similar.answer == "22 and 443" and 0.8 <= similar.similarity < 1
+    assert ask(cache, "is my spf ok").answer is None
+    assert ask(cache, "Which ports are open?", results='{"open_ports": [22]}').answer is None
+    assert cache.stats()["requests"] == {"exact": 1, "similar": 1, "miss": 3, "bypass": 0}
+
+
+def test_ttl_and_lru_eviction():
+    cache = AnswerCache(max_entries=2, ttl=60, similarity=0.99, embed=bag_of_words)
+    answer(cache, "which ports are open", "expired", ttl=1)
+    cache.entries[next(iter(cache.entries))].expires_at = time.monotonic() - 1
+    assert ask(cache, "which ports are open").answer is None
+
+    answer(cache, "which ports are open", "ports")
+    answer(cache, "is my spf ok", "spf")
+    ask(cache, "which ports are open")
+    answer(cache, "is the spf record valid", "record")
+
+    assert ask(cache, "is my spf ok").answer is None
+    assert ask(cache, "which ports are open").answer == "ports"
+    assert cache.stats()["evicted"] == 1
+
+
+def test_failing_embeddings_still_match_the_same_question():
+    def broken(text: str) -> list[float]:
+        raise ConnectionError("embeddings are down")
+
+    cache = AnswerCache(max_entries=10, ttl=60, similarity=0.8, embed=broken)
+    answer(cache, "Which ports are open?", "22 and 443")
+
+    assert ask(cache, "which ports are open").answer == "22 and 443"
+    assert ask(cache, "which ports are open ok").answer is None
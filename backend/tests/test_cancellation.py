@@ -0,0 +1,135 @@
+import asyncio
+import os
+
+from redis.exceptions import ConnectionError
+
+from lib.single_flight import SingleFlight
+from lib.utils import communicate_or_kill
+
+
+class FakeRedis:
+    """The commands of the single flight, in a dict"""
+
+    def __init__(self):
+        self.values = {}
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    async def expire(self, key, seconds):
+        return key in self.values
+
+
+class DownRedis:
+    """Every command fails, as when Redis is not reachable"""
+
+    def __getattr__(self, name):
+        async def command(*args, **kwargs):
+            raise ConnectionError("Redis is down")
+        return command
+
+
+def processes_of_group(pgid: int) -> list:
+    """Processes of the group that are still alive, zombies are dead already"""
+    alive = []
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # pid (comm) state ppid pgrp ...
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[2]) == pgid and fields[0] not in ("Z", "X"):
+            alive.append(int(pid))
+    return alive
+
+
+def test_cancelled_subprocess_is_killed_with_its_children():
+    async def run():
+        process = await asyncio.create_subprocess_exec(
+            "bash", "-c", "sleep 30 & sleep 30 & wait",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        task = asyncio.create_task(communicate_or_kill(process))
+        await asyncio.sleep(0.2)
+        assert len(processes_of_group(process.pid)) == 3
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return process
+
+    process = asyncio.run(run())
+    assert process.returncode == -9
+    assert processes_of_group(process.pid) == []
+
+
+def test_cancelled_leader_cancels_its_execution_without_followers():
+    single_flight = SingleFlight(FakeRedis(), lock_ttl=60, result_ttl=60)
+    cancelled = asyncio.Event()
+
+    async def check():
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def run():
+        leader = asyncio.create_task(single_flight.do("single-flight:lighthouse:example.com", check))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        return leader
+
+    assert asyncio.run(run()).cancelled()
+    assert cancelled.is_set()
+    assert single_flight.local == {}
+
+
+def test_cancelled_leader_keeps_the_execution_for_its_followers():
+    single_flight = SingleFlight(FakeRedis(), lock_ttl=60, result_ttl=60)
+
+    async def check():
+        await asyncio.sleep(0.1)
+        return {"audits": {}}
+
+    async def run():
+        key = "single-flight:lighthouse:example.com"
+        leader = asyncio.create_task(single_flight.do(key, check))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(single_flight.do(key, check))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        return leader, await follower
+
+    leader, followed = asyncio.run(run())
+    assert leader.cancelled()
+    assert followed == ({"audits": {}}, False)
+
+
+def test_execution_runs_uncoalesced_across_workers_while_redis_is_down():
+    single_flight = SingleFlight(DownRedis(), lock_ttl=60, result_ttl=60)
+    runs = []
+
+    async def check():
+        runs.append(1)
+        await asyncio.sleep(0.05)
+        return {"audits": {}}
+
+    async def run():
+        key = "single-flight:lighthouse:example.com"
+        return await asyncio.gather(single_flight.do(key, check), single_flight.do(key, check))
+
+    # callers in the same process still share the execution
+    assert asyncio.run(run()) == [({"audits": {}}, True), ({"audits": {}}, False)]
+    assert len(runs) == 1
+    assert single_flight.local == {}
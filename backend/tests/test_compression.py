@@ -0,0 +1,56 @@
+import asyncio
+import gzip
+import threading
+from types import SimpleNamespace
+
+from lib.compression import CompressionMiddleware
+from lib.response_cache import json_response_with_etag
+
+
+def json_app(body: bytes, etag: str):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json"), (b"etag", etag.encode())]})
+        await send({"type": "http.response.body", "body": body})
+    return app
+
+
+async def call(app, accept_encoding: str) -> list:
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", accept_encoding.encode())]}
+    await app(scope, None, send)
+    return sent
+
+
+def test_large_body_is_compressed_off_the_loop_with_an_etag_per_encoding():
+    body = b'{"audits": "' + b"a" * 4096 + b'"}'
+    middleware = CompressionMiddleware(json_app(body, '"abc"'), minimum_size=1024, executor_minimum_size=2048)
+    threads = []
+    compress_body = middleware.compress_body
+
+    def recording_compress_body(*args):
+        threads.append(threading.current_thread())
+        return compress_body(*args)
+
+    middleware.compress_body = recording_compress_body
+    sent = asyncio.run(call(middleware, "gzip"))
+
+    headers = dict(sent[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert headers[b"etag"] == b'W/"abc-gzip"'
+    assert gzip.decompress(sent[1]["body"]) == body
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_compressed_etag_matches_the_uncompressed_body():
+    def request(if_none_match: str):
+        return SimpleNamespace(headers={"if-none-match": if_none_match})
+
+    response = json_response_with_etag(request('W/"abc-gzip"'), b"{}", etag='"abc"')
+    assert response.status_code == 304
+    assert response.headers["etag"] == 'W/"abc-gzip"'
+    assert json_response_with_etag(request('W/"abd-gzip"'), b"{}", etag='"abc"').status_code == 200
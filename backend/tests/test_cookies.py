@@ -0,0 +1,30 @@
+import asyncio
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import checks.cookies
+from checks.cookies import router, scan_done_events
+
+app = FastAPI()
+app.include_router(router)
+client = TestClient(app)
+
+
+def test_callback_needs_the_secret_and_an_object(monkeypatch):
+    monkeypatch.setattr(checks.cookies, "COOKIE_SCANNER_CALLBACK_SECRET", "s3cret")
+    event = asyncio.Event()
+    monkeypatch.setitem(scan_done_events, "scan-1", event)
+
+    assert client.post("/cookies/callback", json={"identifier": "scan-1"}).status_code == 401
+    assert client.post("/cookies/callback?token=wrong", json={"identifier": "scan-1"}).status_code == 401
+    assert not event.is_set()
+
+    assert client.post("/cookies/callback?token=s3cret", json=["scan-1"]).status_code == 400
+    assert client.post("/cookies/callback?token=s3cret", json={"identifier": "scan-1"}).status_code == 200
+    assert event.is_set()
+
+
+def test_callback_is_disabled_without_a_secret(monkeypatch):
+    monkeypatch.setattr(checks.cookies, "COOKIE_SCANNER_CALLBACK_SECRET", None)
+    assert client.post("/cookies/callback", json={"identifier": "scan-1"}).status_code == 403
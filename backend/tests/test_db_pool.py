@@ -0,0 +1,47 @@
+import asyncio
+import os
+import time
+
+from prometheus_client import REGISTRY
+from sqlalchemy import text
+
+from constants import POSTGRES_POOL_SIZE, POSTGRES_MAX_OVERFLOW
+from lib.postgres_db import engine, db_session
+
+# concurrent units of work we expect from one API process at peak
+TARGET_CONCURRENCY = int(os.getenv("DB_LOAD_TEST_CONCURRENCY", "200"))
+
+
+async def unit_of_work():
+    async with db_session() as db:
+        await db.execute(text("SELECT pg_sleep(0.05)"))
+
+
+async def run_load(concurrency: int):
+    started_at = time.monotonic()
+    results = await asyncio.gather(*[unit_of_work() for _ in range(concurrency)], return_exceptions=True)
+    elapsed = time.monotonic() - started_at
+    await engine.dispose()
+    return results, elapsed
+
+
+def pool_timeouts() -> float:
+    return REGISTRY.get_sample_value("planspiegel_db_pool_timeouts_total") or 0
+
+
+def test_pool_survives_target_concurrency():
+    """
+    Runs TARGET_CONCURRENCY short units of work at once against the real database.
+    Connections are limited to pool_size + max_overflow, the rest must wait and get one in time.
+    """
+    timeouts_before = pool_timeouts()
+
+    results, elapsed = asyncio.run(run_load(TARGET_CONCURRENCY))
+
+    errors = [result for result in results if isinstance(result, BaseException)]
+    assert not errors, f"{len(errors)} of {TARGET_CONCURRENCY} units of work failed, first: {errors[0]!r}"
+    assert pool_timeouts() == timeouts_before, "Pool timeouts happened at the target concurrency"
+
+    # every wave of max connections takes ~50 ms
+    waves = -(-TARGET_CONCURRENCY // (POSTGRES_POOL_SIZE + POSTGRES_MAX_OVERFLOW))
+    print(f"{TARGET_CONCURRENCY} units of work in {elapsed:.2f}s ({waves} waves)")
@@ -0,0 +1,15 @@
+from checks.diff import diff_cookie
+
+
+def test_cookie_providers_by_category_and_as_list():
+    previous = {"gdpr_compliant": True,
+                "provider": {"analytics": {"urls": [{"url": "https://www.google-analytics.com"}]}}}
+    current = {"gdpr_compliant": False,
+               "provider": [{"category": "analytics", "urls": [{"url": "https://www.google-analytics.com"}]},
+                            {"category": "marketing", "urls": [{"url": "https://connect.facebook.net"}]}]}
+
+    diff = diff_cookie(previous, current)
+
+    assert diff["gdpr_compliant"] == {"previous": True, "current": False}
+    assert diff["new_providers"] == ["marketing: https://connect.facebook.net"]
+    assert diff["removed_providers"] == []
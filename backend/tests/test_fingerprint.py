@@ -0,0 +1,122 @@
+import asyncio
+import shutil
+import ssl
+import subprocess
+
+import pytest
+
+import checks.fingerprint
+from checks.fingerprint import fingerprint_port, fingerprint_ports, fingerprint_cache, cache_fingerprint
+
+
+async def serve(handler, ssl_context: ssl.SSLContext | None = None) -> tuple[asyncio.Server, int]:
+    server = await asyncio.start_server(handler, "127.0.0.1", 0, ssl=ssl_context)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def ssh_handler(reader, writer):
+    writer.write(b"SSH-2.0-OpenSSH_9.6\r\n")
+    await writer.drain()
+    writer.close()
+
+
+async def http_handler(reader, writer):
+    await reader.readuntil(b"\r\n\r\n")
+    writer.write(b"HTTP/1.1 301 Moved Permanently\r\nServer: nginx/1.25.3\r\nLocation: https://localhost/\r\n\r\n")
+    await writer.drain()
+    writer.close()
+
+
+async def redis_handler(reader, writer):
+    await reader.readline()
+    writer.write(b"-ERR unknown command 'HEAD'\r\n")
+    await writer.drain()
+    writer.close()
+
+
+def self_signed_context(tmp_path) -> ssl.SSLContext:
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is not installed")
+    cert, key = tmp_path / "cert.pem", tmp_path / "key.pem"
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "30", "-subj", "/CN=localhost",
+                    "-keyout", str(key), "-out", str(cert)], check=True, capture_output=True)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def test_banner_and_probe_services():
+    fingerprint_cache.clear()
+
+    async def run():
+        servers = [await serve(handler) for handler in (ssh_handler, http_handler, redis_handler)]
+        try:
+            return await fingerprint_ports("127.0.0.1", [port for _, port in servers], "localhost")
+        finally:
+            for server, _ in servers:
+                server.close()
+
+    ssh, http, redis = asyncio.run(run())
+
+    assert ssh["service"] == "ssh" and ssh["product"] == "SSH-2.0-OpenSSH_9.6" and ssh["secure"] is True
+    assert http["service"] == "http" and http["product"] == "nginx/1.25.3" and http["tls"] is None
+    assert http["redirects_to_https"] and http["secure"] is True
+    assert redis["service"] == "redis" and redis["secure"] is False
+
+
+def test_tls_with_untrusted_certificate(tmp_path):
+    fingerprint_cache.clear()
+    context = self_signed_context(tmp_path)
+
+    async def tls_http_handler(reader, writer):
+        await http_handler(reader, writer)
+
+    async def run():
+        server, port = await serve(tls_http_handler, context)
+        try:
+            return await fingerprint_port("127.0.0.1", port, "localhost")
+        finally:
+            server.close()
+
+    info = asyncio.run(run())
+
+    assert info["service"] == "https"
+    assert info["tls"]["version"] in ("TLSv1.2", "TLSv1.3")
+    assert info["tls"]["trusted"] is False and info["tls"]["verify_error"]
+    assert info["tls"]["legacy_versions"] == []
+    assert info["secure"] is False and info["assessment"].startswith("Untrusted certificate")
+
+
+def test_results_are_cached_per_address_port_and_hostname():
+    fingerprint_cache.clear()
+
+    async def run():
+        server, port = await serve(ssh_handler)
+        first = await fingerprint_port("127.0.0.1", port, "localhost")
+        server.close()
+        await server.wait_closed()
+        # nothing listens anymore, the answer comes from the cache, but not for another virtual host
+        return (first, await fingerprint_port("127.0.0.1", port, "localhost"),
+                await fingerprint_port("127.0.0.1", port, "example.com"))
+
+    first, second, other_host = asyncio.run(run())
+
+    assert second is first
+    assert second["service"] == "ssh"
+    assert other_host["error"] and other_host["banner"] is None
+
+
+def test_fingerprint_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(checks.fingerprint, "FINGERPRINT_CACHE_MAX_ENTRIES", 3)
+    fingerprint_cache.clear()
+    cache_fingerprint(("192.0.2.1", 0, "example.com"), {"port": 0})
+    fingerprint_cache[("192.0.2.9", 22, "expired.example.com")] = (0.0, {})
+    for port in range(1, 3):
+        cache_fingerprint(("192.0.2.1", port, "example.com"), {"port": port})
+    # the expired entry goes before the oldest one
+    assert list(fingerprint_cache) == [("192.0.2.1", port, "example.com") for port in (0, 1, 2)]
+
+    cache_fingerprint(("192.0.2.1", 3, "example.com"), {"port": 3})
+    assert list(fingerprint_cache) == [("192.0.2.1", port, "example.com") for port in (1, 2, 3)]
+    fingerprint_cache.clear()
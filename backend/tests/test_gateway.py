@@ -0,0 +1,146 @@
+import asyncio
+
+from ai.gateway import LlmGateway, Priority, Usage, record_usage
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after: str):
+        super().__init__("Rate limit reached")
+        self.response = type("Response", (), {"headers": {"retry-after": retry_after}})()
+
+
+class FakeRedis:
+    def __init__(self):
+        self.scripts = []
+
+    async def eval(self, script, numkeys, *keys_and_args):
+        self.scripts.append(keys_and_args[numkeys:])
+
+
+class LocalGateway(LlmGateway):
+    """The budget opens when the test says so, instead of in Redis"""
+
+    def __init__(self, **kwargs):
+        super().__init__(FakeRedis(), tokens_per_minute=1000, requests_per_minute=10, background_share=0.8,
+                         max_retries=2, **kwargs)
+        self.open = asyncio.Event()
+        self.settled = []
+        self.refunded = []
+
+    async def reserve(self, priority: Priority, tokens: int) -> float:
+        return 0.0 if self.open.is_set() else 0.01
+
+    async def settle(self, priority: Priority, user_id, estimate: int, usage: Usage):
+        self.settled.append((priority, user_id, estimate, usage.prompt_tokens + usage.completion_tokens))
+
+    async def refund(self, tokens: int):
+        self.refunded.append(tokens)
+
+
+def test_interactive_requests_go_before_queued_background_ones():
+    async def run():
+        gateway = LocalGateway()
+        granted = []
+
+        async def request(name: str, priority: Priority):
+            await gateway.acquire(priority, 100)
+            granted.append(name)
+
+        tasks = [asyncio.create_task(request("summary 1", Priority.BACKGROUND)),
+                 asyncio.create_task(request("summary 2", Priority.BACKGROUND))]
+        await asyncio.sleep(0.03)
+        tasks.append(asyncio.create_task(request("chat", Priority.INTERACTIVE)))
+        await asyncio.sleep(0.03)
+        assert gateway.queued() == {"interactive": 1, "background": 2}
+        gateway.open.set()
+        await asyncio.gather(*tasks)
+        return granted, gateway.stats()
+
+    granted, stats = asyncio.run(run())
+    assert granted == ["chat", "summary 1", "summary 2"]
+    assert stats["requests"] == {"interactive": 1, "background": 2}
+
+
+def test_rate_limited_request_pauses_the_budget_and_is_repeated():
+    attempts = []
+
+    async def completion(question: str) -> str:
+        attempts.append(question)
+        if len(attempts) == 1:
+            raise RateLimitError(retry_after="0.05")
+        record_usage(type("CompletionUsage", (), {"prompt_tokens": 30, "completion_tokens": 12})())
+        return "22 and 443"
+
+    async def run():
+        gateway = LocalGateway()
+        gateway.open.set()
+        answer = await gateway.call(Priority.INTERACTIVE, 7, 500, completion, "Which ports are open?")
+        return answer, gateway
+
+    answer, gateway = asyncio.run(run())
+    assert answer == "22 and 443"
+    assert len(attempts) == 2 and gateway.retries == 1
+    # the retry-after of the response paused the shared budget
+    assert gateway.redis.scripts == [(0.05,)]
+    assert gateway.settled == [(Priority.INTERACTIVE, 7, 500, 0), (Priority.INTERACTIVE, 7, 500, 42)]
+
+
+def test_other_errors_are_not_repeated():
+    async def completion():
+        raise ValueError("invalid image")
+
+    async def run():
+        gateway = LocalGateway()
+        gateway.open.set()
+        try:
+            await gateway.call(Priority.BACKGROUND, None, 100, completion)
+        except ValueError:
+            return gateway.retries
+        raise AssertionError("the error was swallowed")
+
+    assert asyncio.run(run()) == 0
+
+
+def test_stream_closed_by_its_reader_is_settled():
+    closed = asyncio.Event()
+
+    async def completion():
+        try:
+            for part in ("22", " and", " 443"):
+                yield part
+        finally:
+            closed.set()
+
+    async def run():
+        gateway = LocalGateway()
+        gateway.open.set()
+        stream = gateway.stream(Priority.INTERACTIVE, 7, 500, completion)
+        first = await anext(stream)
+        # e.g. the client disconnected
+        await stream.aclose()
+        return first, gateway
+
+    first, gateway = asyncio.run(run())
+    assert first == "22"
+    assert closed.is_set()
+    assert gateway.settled == [(Priority.INTERACTIVE, 7, 500, 0)]
+
+
+def test_waiter_cancelled_after_the_grant_refunds_its_reservation():
+    async def run():
+        gateway = LocalGateway()
+        waiter = asyncio.create_task(gateway.acquire(Priority.BACKGROUND, 300))
+        await asyncio.sleep(0.03)
+        request = gateway.queue[0]
+        gateway.open.set()
+        # granted by the dispatcher, cancelled before the waiter ran again
+        while not request.granted.done():
+            await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return gateway
+
+    gateway = asyncio.run(run())
+    assert gateway.refunded == [300]
@@ -0,0 +1,66 @@
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import lib.images
+from lib.images import prepare_image, prepare_image_in_pool, vision_tokens
+
+
+def jpeg_with_exif(width: int, height: int, orientation: int) -> bytes:
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    exif[0x010F] = "PhoneMaker"
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 30, 30)).save(output, "JPEG", exif=exif)
+    return output.getvalue()
+
+
+def test_prepared_image_is_oriented_downscaled_and_without_metadata():
+    # stored sideways: 2532x1170 pixels shown as 1170x2532
+    prepared = prepare_image(jpeg_with_exif(2532, 1170, 6), max_long_side=1024, max_short_side=768)
+
+    assert (prepared.original_width, prepared.original_height) == (1170, 2532)
+    assert (prepared.width, prepared.height) == (473, 1024)
+    with Image.open(io.BytesIO(prepared.content)) as image:
+        assert image.format == "WEBP"
+        assert image.size == (473, 1024)
+        assert not image.getexif()
+        assert "icc_profile" not in image.info
+
+
+def test_small_transparent_image_keeps_size_and_alpha():
+    output = io.BytesIO()
+    Image.new("RGBA", (300, 200), (0, 0, 0, 0)).save(output, "PNG")
+
+    prepared = prepare_image(output.getvalue())
+
+    assert (prepared.width, prepared.height) == (300, 200)
+    with Image.open(io.BytesIO(prepared.content)) as image:
+        assert image.mode == "RGBA"
+
+
+def test_not_an_image():
+    assert prepare_image(b"%PDF-1.7 not an image") is None
+
+
+def test_vision_tokens():
+    assert vision_tokens(1920, 1080) == 85 + 170 * 6
+    assert vision_tokens(1024, 576) == 85 + 170 * 4
+    assert vision_tokens(300, 200) == 85 + 170
+
+
+def exit_worker(content: bytes):
+    os._exit(1)
+
+
+def test_broken_pool_falls_back_to_the_original_and_is_replaced(monkeypatch):
+    broken = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork"))
+    monkeypatch.setattr(lib.images, "pool", broken)
+    monkeypatch.setattr(lib.images, "prepare_image", exit_worker)
+
+    assert asyncio.run(prepare_image_in_pool(b"image")) is None
+    assert lib.images.pool is None
@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+import pytest
+
+from lib.loop_monitor import LoopMonitor, LoopMonitorMiddleware, LoopBlockedError, Stall
+
+
+def blocking_handler():
+    time.sleep(0.3)
+
+
+async def blocking_app(scope, receive, send):
+    scope["endpoint"] = blocking_app
+    blocking_handler()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def sleeping_app(scope, receive, send):
+    scope["endpoint"] = sleeping_app
+    await asyncio.sleep(0.3)
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def call(app, path: str = "/") -> list:
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await app({"type": "http", "method": "GET", "path": path}, receive, send)
+    return sent
+
+
+def test_blocking_route_is_captured_with_stack_and_route():
+    monitor = LoopMonitor(interval=0.02, threshold=0.1)
+
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        await call(LoopMonitorMiddleware(blocking_app))
+        await asyncio.sleep(0.1)
+        await monitor.stop()
+
+    asyncio.run(run())
+
+    assert len(monitor.stalls) == 1
+    stall = monitor.stalls[0]
+    assert stall.route == "GET blocking_app"
+    assert "blocking_handler" in stall.stack
+    assert 0.15 < stall.duration < 1
+    assert monitor.max_lag > 0.15
+
+
+def test_awaiting_route_is_not_a_stall():
+    monitor = LoopMonitor(interval=0.02, threshold=0.1)
+
+    async def run():
+        monitor.start()
+        await call(LoopMonitorMiddleware(sleeping_app))
+        await monitor.stop()
+
+    asyncio.run(run())
+
+    assert len(monitor.stalls) == 0
+
+
+def test_strict_mode_fails_the_blocking_request():
+    app = LoopMonitorMiddleware(blocking_app, strict=True, threshold=0.1)
+
+    with pytest.raises(LoopBlockedError, match="GET blocking_app"):
+        asyncio.run(call(app))
+
+    sent = asyncio.run(call(LoopMonitorMiddleware(sleeping_app, strict=True, threshold=0.1)))
+    assert sent[0]["status"] == 200
+
+
+def test_stack_of_a_route_is_printed_once_per_interval(capsys):
+    monitor = LoopMonitor(interval=0.02, threshold=0.1, stack_log_seconds=60)
+    for route in ("GET /a", "GET /a", "GET /b"):
+        monitor.finish(Stall(route=route, started_at=time.time(), stack="stack of the loop\n"), 0.2)
+
+    printed = capsys.readouterr().out
+    assert printed.count("stack of the loop") == 2
+    assert "GET /a blocked the event loop for 0.200s, stack in GET /loop-monitor" in printed
+    assert len(monitor.stalls) == 3
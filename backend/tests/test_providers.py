@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+import pytest
+
+from ai.providers import Provider, ProviderPool, parse_providers
+from benchmarks.fakes import FakeServices, free_port
+
+MESSAGES = [{"role": "user", "content": "Which ports are open?"}]
+
+
+@pytest.fixture
+def servers():
+    """A slow and a fast OpenAI compatible server, time to the first token 1.5s and 0.05s"""
+    slow = FakeServices(openai_seconds=1.5, openai_token_seconds=0.001, answer_tokens=5).start()
+    fast = FakeServices(openai_seconds=0.05, openai_token_seconds=0.001, answer_tokens=5).start()
+    yield slow, fast
+    slow.stop()
+    fast.stop()
+
+
+def provider(name: str, services: FakeServices) -> Provider:
+    return Provider(name, services.url(path="/v1"), "test", "gpt-4o-mini")
+
+
+def test_late_first_token_is_hedged_and_the_slow_request_cancelled(servers):
+    slow, fast = servers
+    pool = ProviderPool([provider("slow", slow), provider("fast", fast)], hedge_after=0.2)
+
+    async def run():
+        started_at = time.perf_counter()
+        completion = await pool.complete(MESSAGES, hedge=True)
+        seconds = time.perf_counter() - started_at
+        await pool.close()
+        return completion, seconds
+
+    completion, seconds = asyncio.run(run())
+    assert completion.provider == "fast"
+    assert completion.content.split() == fast.answer
+    assert completion.usage["completion_tokens"] == 5
+    assert seconds < 1.0
+    assert pool.counts["fast"]["hedges_won"] == 1
+    assert pool.latency(pool.providers[1]).samples and not pool.latency(pool.providers[0]).samples
+
+
+def test_without_hedging_the_first_provider_answers(servers):
+    slow, fast = servers
+    pool = ProviderPool([provider("slow", slow), provider("fast", fast)], hedge_after=0.2)
+
+    async def run():
+        parts = [part async for part in pool.stream(MESSAGES)]
+        await pool.close()
+        return parts
+
+    assert "".join(asyncio.run(run())).split() == slow.answer
+    assert pool.counts["slow"]["completions"] == 1 and pool.counts["fast"]["completions"] == 0
+
+
+def test_a_single_provider_is_not_hedged(servers):
+    slow, _ = servers
+    pool = ProviderPool([provider("slow", slow)], hedge_after=0.2)
+
+    async def run():
+        completion = await pool.complete(MESSAGES, hedge=True)
+        await pool.close()
+        return completion
+
+    assert asyncio.run(run()).provider == "slow"
+    assert slow.requests["openai"] == 1
+    assert pool.counts["slow"]["hedges_won"] == pool.counts["slow"]["hedges_lost"] == 0
+
+
+def test_failing_provider_fails_over_to_the_next(servers):
+    _, fast = servers
+    down = Provider("down", f"http://127.0.0.1:{free_port()}/v1", "test", "gpt-4o-mini")
+    pool = ProviderPool([down, provider("fast", fast)], hedge_after=5)
+
+    async def run():
+        completion = await pool.complete(MESSAGES)
+        await pool.close()
+        return completion
+
+    assert asyncio.run(run()).provider == "fast"
+    assert pool.counts["down"]["errors"] == 1
+
+
+def test_providers_setting():
+    providers = parse_providers("openai||gpt-4o-mini,local|http://localhost:8080/v1|qwen2.5-7b-instruct",
+                                api_key="key", base_url=None, model="gpt-4o-mini")
+    assert [(p.name, p.base_url, p.model) for p in providers] == [
+        ("openai", None, "gpt-4o-mini"), ("local", "http://localhost:8080/v1", "qwen2.5-7b-instruct")]
+    assert [p.name for p in parse_providers("", api_key="key", base_url=None, model="gpt-4o-mini")] == ["openai"]
@@ -0,0 +1,88 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from redis.exceptions import ConnectionError
+
+import lib.rate_limit
+from constants import RATE_LIMIT_POINTS
+from lib.rate_limit import SlidingWindowLimiter, DailyUsage, RateLimitHeadersMiddleware, RateLimitDecision, \
+    charge_user
+
+
+class DownRedis:
+    """Every command fails, as when Redis is not reachable"""
+
+    async def eval(self, *args):
+        raise ConnectionError("Redis is down")
+
+    async def hget(self, *args):
+        raise ConnectionError("Redis is down")
+
+    def pipeline(self, **kwargs):
+        raise ConnectionError("Redis is down")
+
+
+def test_sliding_window_counts_the_rest_of_the_previous_window():
+    limiter = SlidingWindowLimiter(DownRedis(), window=60)
+
+    async def run():
+        start = 600.0  # the start of a window
+        decisions = [await limiter.hit("user:1", 20, 100, now=start + second) for second in range(6)]
+        # half of the previous window still counts: 50 of 100 points, 40 more fit
+        halfway = [await limiter.hit("user:1", 20, 100, now=start + 90) for _ in range(3)]
+        return decisions, halfway
+
+    decisions, halfway = asyncio.run(run())
+    assert [decision.allowed for decision in decisions] == [True] * 5 + [False]
+    assert decisions[4].remaining == 0 and decisions[5].retry_after == 55
+    assert [decision.allowed for decision in halfway] == [True, True, False]
+    # the rejected 20 points fit once only 40 points of the previous window count, 6s later
+    assert halfway[2].retry_after == 6
+    assert limiter.fallbacks == 9
+
+
+def test_daily_usage_is_kept_in_the_process_while_redis_is_down():
+    usage = DailyUsage(DownRedis())
+
+    async def run():
+        await usage.add("scan_seconds", 1, 90.5)
+        await usage.add("scan_seconds", 1, 30)
+        return await usage.get("scan_seconds", 1), await usage.get("scan_seconds", 2)
+
+    assert asyncio.run(run()) == (120.5, 0)
+
+
+def test_headers_of_the_decision_are_added_to_the_response():
+    decision = RateLimitDecision(allowed=True, limit=120, remaining=100, reset=30, retry_after=0, window=60)
+    sent = []
+
+    async def app(scope, receive, send):
+        scope["state"]["rate_limit"] = decision
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(RateLimitHeadersMiddleware(app)({"type": "http", "state": {}}, None, send))
+    assert dict(sent[0]["headers"]) == {b"content-type": b"text/plain", b"ratelimit-limit": b"120",
+                                        b"ratelimit-remaining": b"100", b"ratelimit-reset": b"30",
+                                        b"ratelimit-policy": b"120;w=60"}
+
+
+def test_cost_above_the_limit_takes_the_whole_window(monkeypatch):
+    monkeypatch.setattr(lib.rate_limit, "rate_limiter", SlidingWindowLimiter(DownRedis(), window=60))
+    request = SimpleNamespace(state=SimpleNamespace())
+
+    async def run():
+        # a batch of 100 urls costs more than the window has
+        await charge_user(request, "start_checkup_batch", 1, 20 + 2 * 100)
+        assert request.state.rate_limit.remaining == 0
+        await charge_user(request, "start_checkup", 1, 20)
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(run())
+    assert error.value.status_code == 429
+    assert request.state.rate_limit.limit == RATE_LIMIT_POINTS
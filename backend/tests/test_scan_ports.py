@@ -0,0 +1,29 @@
+import asyncio
+import errno
+import os
+import socket
+
+import checks.scan_ports
+from checks.scan_ports import cache_addresses, dns_cache, scan_address
+
+
+def test_dns_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(checks.scan_ports, "DNS_CACHE_MAX_ENTRIES", 3)
+    dns_cache.clear()
+    for index in range(5):
+        cache_addresses(f"host{index}.example.com", [(socket.AF_INET, f"192.0.2.{index}")])
+
+    assert list(dns_cache) == ["host2.example.com", "host3.example.com", "host4.example.com"]
+    dns_cache.clear()
+
+
+def test_scan_stops_on_other_socket_errors(monkeypatch):
+    async def out_of_descriptors(family, address, port, timeout):
+        raise OSError(errno.EMFILE, os.strerror(errno.EMFILE))
+
+    monkeypatch.setattr(checks.scan_ports, "probe_port", out_of_descriptors)
+
+    result = asyncio.run(scan_address(socket.AF_INET, "192.0.2.1", [22, 80, 443]))
+
+    assert result.open_ports == []
+    assert result.error == f"Scan stopped: [Errno {errno.EMFILE}] {os.strerror(errno.EMFILE)}"
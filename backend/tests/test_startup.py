@@ -0,0 +1,12 @@
+from benchmarks.startup import import_times, LAZY_MODULES
+
+# seconds for `import main` in a fresh interpreter, most of it is fastapi, pydantic and sqlalchemy
+IMPORT_BUDGET = 3.0
+
+
+def test_api_imports_without_heavy_dependencies_and_within_budget():
+    times = import_times("main")
+
+    assert [name for name in LAZY_MODULES if name in times] == []
+    slowest = sorted(times.items(), key=lambda item: -item[1][1])[:10]
+    assert times["main"][1] / 1e6 < IMPORT_BUDGET, f"slowest imports (us): {slowest}"
@@ -0,0 +1,106 @@
+import asyncio
+import hashlib
+import io
+import os
+
+import pytest
+from fastapi import FastAPI, HTTPException, UploadFile
+from fastapi.testclient import TestClient
+from starlette.datastructures import Headers
+
+import lib.storage
+from lib.storage import LocalStorage, UploadLimitMiddleware, store_upload
+
+
+def upload(content: bytes, filename: str = "screenshot.png", content_type: str = "image/png") -> UploadFile:
+    return UploadFile(io.BytesIO(content), filename=filename, headers=Headers({"content-type": content_type}))
+
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch) -> LocalStorage:
+    storage = LocalStorage(str(tmp_path), "http://files.local")
+    storage.setup()
+    monkeypatch.setattr(lib.storage, "storage", storage)
+    return storage
+
+
+def test_same_content_is_stored_once(local_storage):
+    content = os.urandom(3 * 1024 * 1024 + 17)
+
+    first = asyncio.run(store_upload(upload(content)))
+    second = asyncio.run(store_upload(upload(content, filename="again.png")))
+
+    digest = hashlib.sha256(content).hexdigest()
+    assert first.key == second.key == f"{digest}.png"
+    assert first.url == f"http://files.local/{digest}.png"
+    assert (first.deduplicated, second.deduplicated) == (False, True)
+    assert first.size == len(content)
+    with open(os.path.join(local_storage.directory, first.key), "rb") as f:
+        assert f.read() == content
+    assert os.listdir(local_storage.directory) == [first.key]
+
+
+def test_too_large_and_empty_uploads(local_storage):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(store_upload(upload(b"x" * 2048), max_bytes=1024))
+    assert error.value.status_code == 413
+
+    assert asyncio.run(store_upload(upload(b""))) is None
+    assert os.listdir(local_storage.directory) == []
+
+
+def test_only_images_are_stored(local_storage):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(store_upload(upload(b"<script>alert(1)</script>", filename="x.html", content_type="text/html")))
+    assert error.value.status_code == 415
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(store_upload(upload(b"<svg onload='alert(1)'/>", filename="x.svg", content_type="image/svg+xml")))
+    assert error.value.status_code == 415
+
+    # the extension comes from the type, not from the filename
+    stored = asyncio.run(store_upload(upload(b"not really a png", filename="x.html")))
+    assert stored.key.endswith(".png")
+    assert os.listdir(local_storage.directory) == [stored.key]
+
+
+def test_model_gets_the_image_inline_without_a_public_url(tmp_path, monkeypatch):
+    storage = LocalStorage(str(tmp_path))
+    storage.setup()
+    monkeypatch.setattr(lib.storage, "storage", storage)
+
+    stored = asyncio.run(store_upload(upload(b"not really a png")))
+    assert stored.url.startswith("/api/attachments/")
+    assert stored.model_url == "data:image/png;base64,bm90IHJlYWxseSBhIHBuZw=="
+
+
+def test_upload_above_the_limit_is_rejected_while_it_arrives():
+    app = FastAPI()
+    received = []
+
+    @app.post("/upload")
+    async def receive_upload(file: UploadFile):
+        received.append(file.filename)
+
+    client = TestClient(UploadLimitMiddleware(app, max_bytes=1024))
+    assert client.post("/upload", files={"file": ("small.png", b"x" * 100)}).status_code == 200
+    assert client.post("/upload", files={"file": ("big.png", b"x" * 2048)}).status_code == 413
+    assert received == ["small.png"]
+
+    # without Content-Length the body is counted
+    chunks = [b"--b\r\nContent-Disposition: form-data; name=\"file\"; filename=\"big.png\"\r\n\r\n",
+              b"x" * 2048, b"\r\n--b--\r\n"]
+    sent = []
+
+    async def receive():
+        chunk = chunks.pop(0)
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/upload", "query_string": b"", "root_path": "",
+             "headers": [(b"content-type", b"multipart/form-data; boundary=b")]}
+    asyncio.run(UploadLimitMiddleware(app, max_bytes=1024)(scope, receive, send))
+    assert sent[0]["status"] == 413
+    assert received == ["small.png"]
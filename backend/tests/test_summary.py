@@ -0,0 +1,138 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+import ai.summary
+from ai.summary import CheckupSummaries
+from models import CheckType
+
+
+@pytest.fixture
+def llm(monkeypatch) -> dict:
+    """Records the summary calls instead of asking the model, and the saved executive summaries"""
+    calls = {"batch": [], "single": [], "saved": {}}
+
+    async def checkup_summary(results_by_check_type):
+        calls["batch"].append(sorted(check_type.value for check_type in results_by_check_type))
+        checks = {check_type.value: f"batched {check_type.value}" for check_type in results_by_check_type}
+        return {"checks": checks, "executive_summary": "all good"}, {"prompt_tokens": 1000, "completion_tokens": 200}
+
+    async def check_summary(results, check_type):
+        calls["single"].append(check_type.value)
+        return f"single {check_type.value}"
+
+    async def save_summary(checkup_id, summary, db):
+        calls["saved"][checkup_id] = summary
+
+    @asynccontextmanager
+    async def session():
+        yield None
+
+    # the calls go straight to the fakes, without the budget of the gateway in Redis
+    monkeypatch.setattr(ai.summary.llm_gateway, "enabled", False)
+    monkeypatch.setattr(ai.summary, "get_agent_checkup_summary_response", checkup_summary)
+    monkeypatch.setattr(ai.summary, "get_agent_check_summary_response", check_summary)
+    monkeypatch.setattr(ai.summary, "db_update_checkup_summary", save_summary)
+    monkeypatch.setattr(ai.summary, "db_session", session)
+    return calls
+
+
+def test_checks_of_a_checkup_are_summarised_in_one_call(llm):
+    summaries = CheckupSummaries(wait=5)
+
+    async def run():
+        summaries.expect(1, [CheckType.COOKIE, CheckType.SCAN_PORTS, CheckType.TECHNOLOGIES])
+        cookie = asyncio.create_task(summaries.summarize(1, CheckType.COOKIE, {"cookies": []}))
+        await asyncio.sleep(0.01)
+        # a failed check doesn't hold the batch back
+        summaries.withdraw(1, CheckType.TECHNOLOGIES)
+        ports = await summaries.summarize(1, CheckType.SCAN_PORTS, {"open_ports": [443]})
+        return await cookie, ports
+
+    assert asyncio.run(run()) == ("batched cookie", "batched scan_ports")
+    assert llm["batch"] == [["cookie", "scan_ports"]]
+    assert llm["single"] == []
+    assert llm["saved"] == {1: "all good"}
+    report = summaries.stats()["checkups"][0]
+    assert report["prompt_tokens"] == 1000 and report["single_prompt_tokens"] > report["prompt_tokens"]
+
+
+def test_stragglers_and_checkups_without_batch_are_summarised_alone(llm):
+    summaries = CheckupSummaries(wait=0.05)
+
+    async def run():
+        summaries.expect(2, [CheckType.COOKIE, CheckType.SCAN_PORTS])
+        cookie = await summaries.summarize(2, CheckType.COOKIE, {"cookies": []})
+        ports = await summaries.summarize(2, CheckType.SCAN_PORTS, {"open_ports": [443]})
+        other = await summaries.summarize(3, CheckType.COOKIE, {"cookies": []})
+        return cookie, ports, other
+
+    assert asyncio.run(run()) == ("batched cookie", "single scan_ports", "single cookie")
+    assert llm["batch"] == [["cookie"]]
+    assert llm["single"] == ["scan_ports", "cookie"]
+    assert summaries.stats()["waiting_checkups"] == 0
+
+
+def test_failed_batch_falls_back_to_one_call_per_check(llm, monkeypatch):
+    async def broken(results_by_check_type):
+        raise TimeoutError("the model timed out")
+
+    monkeypatch.setattr(ai.summary, "get_agent_checkup_summary_response", broken)
+    summaries = CheckupSummaries(wait=5)
+
+    async def run():
+        summaries.expect(4, [CheckType.COOKIE, CheckType.SCAN_PORTS])
+        return await asyncio.gather(summaries.summarize(4, CheckType.COOKIE, {"cookies": []}),
+                                    summaries.summarize(4, CheckType.SCAN_PORTS, {"open_ports": []}))
+
+    assert asyncio.run(run()) == ["single cookie", "single scan_ports"]
+    assert llm["saved"] == {}
+    assert summaries.stats()["checkups"][0]["error"] == "the model timed out"
+
+
+def test_cancelled_checkup_is_not_summarised(llm):
+    summaries = CheckupSummaries(wait=5)
+
+    async def run():
+        summaries.expect(5, [CheckType.COOKIE, CheckType.SCAN_PORTS])
+        cookie = asyncio.create_task(summaries.summarize(5, CheckType.COOKIE, {"cookies": []}))
+        await asyncio.sleep(0.01)
+        summaries.cancel(5)
+        await asyncio.gather(cookie, return_exceptions=True)
+        # a check that was already past the cancellation is summarised alone
+        return cookie, await summaries.summarize(5, CheckType.SCAN_PORTS, {"open_ports": []})
+
+    cookie, ports = asyncio.run(run())
+    assert cookie.cancelled() and ports == "single scan_ports"
+    assert llm["batch"] == [] and summaries.stats()["waiting_checkups"] == 0
+
+
+def test_answer_without_an_object_of_checks_falls_back_to_one_call_per_check(llm, monkeypatch):
+    async def listed(results_by_check_type):
+        return {"checks": ["batched cookie"], "executive_summary": None}, {}
+
+    monkeypatch.setattr(ai.summary, "get_agent_checkup_summary_response", listed)
+    summaries = CheckupSummaries(wait=5)
+
+    async def run():
+        summaries.expect(6, [CheckType.COOKIE])
+        return await summaries.summarize(6, CheckType.COOKIE, {"cookies": []})
+
+    assert asyncio.run(run()) == "single cookie"
+    assert summaries.stats()["checkups"][0]["error"] == "checks of the answer are a list, not an object"
+
+
+def test_waiters_of_a_broken_batch_get_an_error(llm, monkeypatch):
+    async def broken(self, batch):
+        raise KeyError("cookie")
+
+    monkeypatch.setattr(CheckupSummaries, "summarize_batch", broken)
+    summaries = CheckupSummaries(wait=5)
+
+    async def run():
+        summaries.expect(7, [CheckType.COOKIE])
+        return await asyncio.wait_for(summaries.summarize(7, CheckType.COOKIE, {"cookies": []}), 1)
+
+    with pytest.raises(RuntimeError, match="summary batch of checkup 7 failed"):
+        asyncio.run(run())
@@ -67,7 +67,9 @@ export default function URLPage() {
 
       const allChecksCompleted = data.state.data.checks?.every(
         (check: ICheck) =>
-          check.status === "completed" || check.status === "failed"
+          check.status === "completed" ||
+          check.status === "failed" ||
+          check.status === "cancelled"
       );
 
       return allChecksCompleted ? false : 5000;
@@ -106,7 +108,9 @@ export default function URLPage() {
       setIsAllCompleted(
         checkupsData.data.checks?.every(
           (check: ICheck) =>
-            check.status === "completed" || check.status === "failed"
+            check.status === "completed" ||
+            check.status === "failed" ||
+            check.status === "cancelled"
         )
       );
 